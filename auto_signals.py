@@ -1,15 +1,25 @@
 # auto_signals.py
 
 import asyncio
-import random
+import json
+import os
 import logging
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
 from decimal import Decimal
-from typing import Optional, Sequence, List, Tuple
+from typing import Dict, List, Optional, Sequence, Tuple
 from datetime import datetime
 
-import aiohttp
+import numpy as np
 from aiogram import Bot
 
+import http_client
+import indicators
+from cache import SingleFlight
+from governor import PRIORITY_BACKGROUND, ApiGovernor, check_response
+from market_data import MarketDataCache
+
 logger = logging.getLogger(__name__)
 
 # --- ТИХИЕ ЧАСЫ (по твоему локальному времени) ---
@@ -22,6 +32,17 @@ QUIET_HOURS_UTC_OFFSET = 2   # сдвиг от UTC (Киев зимой +2, ле
 # --- CoinGecko ---
 
 COINGECKO_API_BASE = "https://api.coingecko.com/api/v3"
+COINGECKO_TIMEOUT = 10    # таймаут одного запроса, секунды
+
+# Квота CoinGecko (бесплатный план — около 30 запросов в минуту)
+COINGECKO_RATE = 0.4      # запросов в секунду в среднем
+COINGECKO_BURST = 5       # весь скан AUTO_SIGNALS_SYMBOLS (4 пары) уходит одной пачкой
+
+coingecko_api = ApiGovernor("coingecko", COINGECKO_RATE, COINGECKO_BURST)
+
+# Локальный кэш часовых закрытий (market_data/) и склейка одновременных обновлений одной монеты
+market_cache = MarketDataCache()
+coingecko_requests = SingleFlight(ttl=0)
 
 # Маппинг наших пар на CoinGecko ID
 COINGECKO_IDS = {
@@ -38,61 +59,196 @@ SLOW_EMA_PERIOD = 50      # медленная EMA (фильтр тренда)
 ATR_PERIOD = 14           # сколько последних интервалов для волатильности
 
 # Фильтры по тренду и волатильности
-MIN_TREND_PCT = Decimal("0.3")  # минимальная сила тренда относительно EMA50 (в %)
-MIN_ATR_PCT = Decimal("0.2")    # слишком низкая вола (менее 0.2% за свечу) — не торгуем
-MAX_ATR_PCT = Decimal("6")      # слишком бешеная вола (более 6% за свечу) — тоже не лезем
+MIN_TREND_PCT = 0.3   # минимальная сила тренда относительно EMA50 (в %)
+MIN_ATR_PCT = 0.2     # слишком низкая вола (менее 0.2% за свечу) — не торгуем
+MAX_ATR_PCT = 6.0     # слишком бешеная вола (более 6% за свечу) — тоже не лезем
+IDEAL_ATR_PCT = 1.0   # при выборе лучшей пары: вола, которую считаем самой удобной
+
+# Потоковое состояние индикаторов по парам (переживает перезапуск бота)
+INDICATOR_STATE_PATH = "indicator_state.json"
+
+_indicator_states: Optional[Dict[str, indicators.StreamState]] = None
+
+# --- Пул процессов для расчёта индикаторов ---
+# Математика по сотням пар в event loop тормозит обработку сообщений, поэтому
+# при большом скане пачки пар уходят в отдельные процессы.
+
+SIGNAL_EVAL_PROCESSES = 2      # процессов в пуле; 0 — всегда считать прямо в event loop
+SIGNAL_EVAL_BATCH = 64         # пар в одной задаче пула (меньше задач — меньше накладных)
+SIGNAL_EVAL_POOL_MIN = 32      # при меньшем числе пар пул не нужен: пересылка дороже расчёта
+
+_eval_pool: Optional[ProcessPoolExecutor] = None
 
 
 # ---------- ЗАГРУЗКА СВЕЧ ИЗ COINGECKO (через market_chart) ----------
 
-async def fetch_coingecko_market_chart(coin_id: str, days: int = 3) -> Optional[List[Tuple[int, Decimal]]]:
+async def _request_market_chart(
+    coin_id: str,
+    path: str,
+    params: Dict[str, object],
+    priority: int,
+) -> Optional[Tuple[np.ndarray, np.ndarray]]:
     """
-    Берём исторический график с CoinGecko:
-    /coins/{id}/market_chart?vs_currency=usd&days=3
+    GET к CoinGecko и разбор "prices" в (метки времени в мс int64, цены float64).
+    Пустой "prices" — пустые массивы (за период точек нет), None — ошибка или битый ответ.
+    """
+    url = f"{COINGECKO_API_BASE}/coins/{coin_id}/{path}"
+    params = {"vs_currency": "usd", **params}
+
+    async def request():
+        async with http_client.session().get(
+            url, params=params, timeout=http_client.timeout(COINGECKO_TIMEOUT)
+        ) as resp:
+            check_response(resp)  # 429/5xx — повтор через coingecko_api
+            if resp.status != 200:
+                logger.warning("CoinGecko %s %s status %s", path, coin_id, resp.status)
+                return None
+            return await resp.json()
+
+    try:
+        data = await coingecko_api.call(request, priority=priority)
+    except Exception as e:
+        logger.error("Error fetching CoinGecko %s for %s: %s", path, coin_id, e)
+        return None
+    if data is None:
+        return None
+
+    prices = data.get("prices")
+    if prices is None:
+        return None
+    if not prices:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+
+    try:
+        raw = np.array(prices, dtype=np.float64).reshape(-1, 2)
+    except (TypeError, ValueError):
+        # битые точки (null и т.п.) — отбрасываем по одной
+        raw = np.array(
+            [p for p in prices if isinstance(p, (list, tuple)) and len(p) == 2 and None not in p],
+            dtype=np.float64,
+        ).reshape(-1, 2)
+    raw = raw[np.isfinite(raw).all(axis=1)]
+    if not len(raw):
+        return None
+
+    return raw[:, 0].astype(np.int64), indicators.as_series(raw[:, 1])
+
 
-    Для 1–90 дней CoinGecko на бесплатном плане даёт данные с часовым шагом —
-    нам этого достаточно, чтобы посчитать EMA и волатильность по закрытиям.
+async def _refresh_market_data(coin_id: str, days: int, since_ms: int, priority: int) -> bool:
     """
-    url = f"{COINGECKO_API_BASE}/coins/{coin_id}/market_chart"
-    params = {
-        "vs_currency": "usd",
-        "days": days,
-    }
+    Дотянуть кэш монеты до текущего момента. Если в кэше есть точки за нужное окно —
+    запрашиваем только дельту с последней точки (market_chart/range), иначе всё окно.
+    False — только если запрос не удался; пустая дельта оставляет кэш как есть.
+    """
+    last_ts = market_cache.last_ts(coin_id)
+    if last_ts is None or last_ts < since_ms:
+        market_cache.full_fetches += 1
+        fetched = await _request_market_chart(coin_id, "market_chart", {"days": days}, priority)
+    else:
+        market_cache.delta_fetches += 1
+        # с начала следующего часа после последней точки — первая точка часа ляжет ровно в сетку
+        step = market_cache.step_ms
+        params = {"from": (last_ts // step + 1) * step // 1000, "to": int(time.time())}
+        fetched = await _request_market_chart(coin_id, "market_chart/range", params, priority)
+    if fetched is None:
+        return False
+    if not len(fetched[0]):
+        # новых точек ещё нет (например, в начале часа) — отдаём то, что есть в кэше;
+        # без кэша fetch_coingecko_market_chart всё равно вернёт None
+        logger.info("CoinGecko returned no new points for %s, using cached series", coin_id)
+        return True
+    try:
+        market_cache.update(coin_id, *fetched)
+    except OSError as e:
+        logger.error("Cannot write market data cache for %s: %s", coin_id, e)
+        return False
+    return True
+
+
+async def fetch_coingecko_market_chart(
+    coin_id: str,
+    days: int = 3,
+    priority: int = PRIORITY_BACKGROUND,
+) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+    """
+    Часовые закрытия монеты за days дней + текущая цена последней точкой.
+    Возвращает (метки времени в мс int64, цены float64).
 
-    async with aiohttp.ClientSession() as session:
-        try:
-            async with session.get(url, params=params, timeout=10) as resp:
-                if resp.status != 200:
-                    logger.warning("CoinGecko market_chart %s status %s", coin_id, resp.status)
-                    return None
-                data = await resp.json()
-        except Exception as e:
-            logger.error("Error fetching CoinGecko market_chart for %s: %s", coin_id, e)
+    Данные берутся из market_cache: пока они моложе MARKET_DATA_TTL, в CoinGecko
+    не ходим; иначе докачиваем только то, что появилось после последней точки.
+    Полный /coins/{id}/market_chart?days=N — только для пустого или устаревшего кэша
+    (для 2–90 дней CoinGecko на бесплатном плане даёт часовой шаг).
+    """
+    since_ms = int((time.time() - days * 86400) * 1000)
+    if market_cache.is_fresh(coin_id):
+        market_cache.fresh_hits += 1
+    else:
+        refreshed = await coingecko_requests.do(
+            coin_id,
+            lambda: _refresh_market_data(coin_id, days, since_ms, priority),
+        )
+        if not refreshed:
             return None
 
-    prices = data.get("prices")
-    if not prices or len(prices) < 10:
+    series = market_cache.series(coin_id, since_ms)
+    if series is None or len(series[0]) < 10:
         return None
+    return series
 
-    series: List[Tuple[int, Decimal]] = []
-    for ts, price in prices:
+
+# ---------- ПОТОКОВОЕ СОСТОЯНИЕ ИНДИКАТОРОВ ----------
+
+def _load_indicator_states() -> Dict[str, indicators.StreamState]:
+    """Состояния из INDICATOR_STATE_PATH; битый или отсутствующий файл — с чистого листа."""
+    try:
+        with open(INDICATOR_STATE_PATH, encoding="utf-8") as f:
+            raw = json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        logger.warning("Indicator state %s is unreadable, reseeding: %s", INDICATOR_STATE_PATH, e)
+        return {}
+    states = {}
+    for coin_id, data in raw.items():
         try:
-            ts_int = int(ts)
-            p_dec = Decimal(str(price))
-        except Exception:
-            continue
-        series.append((ts_int, p_dec))
+            states[coin_id] = indicators.StreamState.from_dict(
+                data, FAST_EMA_PERIOD, SLOW_EMA_PERIOD, ATR_PERIOD
+            )
+        except (KeyError, TypeError, ValueError):
+            logger.warning("Indicator state for %s is broken, reseeding", coin_id)
+    return states
 
-    if len(series) < 10:
-        return None
 
-    return series
+def _save_indicator_states() -> None:
+    """Записать состояния атомарно: во временный файл и переименовать."""
+    if _indicator_states is None:
+        return
+    tmp_path = INDICATOR_STATE_PATH + ".tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({coin_id: s.to_dict() for coin_id, s in _indicator_states.items()}, f)
+        os.replace(tmp_path, INDICATOR_STATE_PATH)
+    except OSError as e:
+        logger.error("Cannot save indicator state: %s", e)
+
+
+def indicator_state(coin_id: str) -> indicators.StreamState:
+    """Состояние пары (при первом обращении все состояния читаются с диска)."""
+    global _indicator_states
+    if _indicator_states is None:
+        _indicator_states = _load_indicator_states()
+    state = _indicator_states.get(coin_id)
+    if state is None:
+        state = indicators.StreamState(FAST_EMA_PERIOD, SLOW_EMA_PERIOD, ATR_PERIOD)
+        _indicator_states[coin_id] = state
+    return state
 
 
 # ---------- ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ----------
 
-def _format_price(p: Decimal) -> str:
+def _format_price(value: float) -> str:
     """Формат цены с разумным количеством знаков."""
+    p = Decimal(repr(value))
     if p >= Decimal("100"):
         q = p.quantize(Decimal("0.1"))
     elif p >= Decimal("1"):
@@ -104,125 +260,179 @@ def _format_price(p: Decimal) -> str:
     return str(q)
 
 
-def _format_pct(x: Decimal) -> str:
+def _format_pct(value: float) -> str:
     """Формат процента с 2 знаками."""
-    q = x.quantize(Decimal("0.01"))
+    q = Decimal(repr(value)).quantize(Decimal("0.01"))
     return str(q)
 
 
-def _ema(values: Sequence[Decimal], period: int) -> Optional[Decimal]:
-    """Классическая EMA по списку значений."""
-    if len(values) < period:
-        return None
-    alpha = Decimal("2") / Decimal(period + 1)
-    ema_val = values[0]
-    for v in values[1:]:
-        ema_val = (v - ema_val) * alpha + ema_val
-    return ema_val
-
+# ---------- ПУЛ ПРОЦЕССОВ ----------
 
-def _atr_like(values: Sequence[Decimal], period: int) -> Optional[Decimal]:
+def eval_pool() -> Optional[ProcessPoolExecutor]:
     """
-    Простейший ATR-подобный показатель:
-    среднее абсолютное изменение между соседними закрытиями за N последних интервалов.
-    Не классический ATR, но даёт адекватную оценку волатильности.
+    Пул создаётся при первом большом скане. Процессы запускаются через spawn:
+    fork процесса с event loop и потоками базы небезопасен, а воркеру нужен
+    только indicators.py с NumPy. spawn заново импортирует главный модуль (bot.py)
+    в каждом воркере — это разовая цена на старте, на импорте бот ничего не запускает.
     """
-    if len(values) <= period:
-        return None
-    diffs = []
-    for i in range(-period, 0):
-        try:
-            prev_v = values[i - 1]
-            cur_v = values[i]
-        except IndexError:
-            continue
-        diffs.append(abs(cur_v - prev_v))
-    if not diffs:
+    global _eval_pool
+    if SIGNAL_EVAL_PROCESSES <= 0:
         return None
-    return sum(diffs, Decimal("0")) / Decimal(len(diffs))
+    if _eval_pool is None:
+        _eval_pool = ProcessPoolExecutor(
+            max_workers=SIGNAL_EVAL_PROCESSES,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+    return _eval_pool
 
 
-# ---------- ПОСТРОЕНИЕ СИГНАЛА ПО СВЕЧАМ + EMA + ВОЛАТИЛЬНОСТИ ----------
+def close_eval_pool() -> None:
+    """Остановить пул (вызывается в on_shutdown)."""
+    global _eval_pool
+    if _eval_pool is not None:
+        _eval_pool.shutdown(wait=True, cancel_futures=True)
+        _eval_pool = None
 
-async def build_auto_signal_text(
-    symbols: Sequence[str],
-    enabled: bool,
-) -> Optional[str]:
+
+def _eval_job(coin_id: str, ts: np.ndarray, closes: np.ndarray) -> tuple:
     """
-    Генерация авто-сигнала на основе:
-    • исторических данных с CoinGecko (серия закрытий)
-    • EMA20 / EMA50 (тренд)
-    • ATR-подобной волатильности за 14 интервалов
-    • фильтров по тренду и волатильности
+    Задача для indicators.evaluate_batch. Если серия стыкуется с состоянием, отправляем
+    только хвост от точки стыка — воркеру этого хватает, а пересылается несколько точек.
     """
-    if not enabled:
-        return None
+    state = indicator_state(coin_id)
+    if state.last_ts is not None:
+        i = int(np.searchsorted(ts, state.last_ts))
+        if i < len(ts) - 1 and int(ts[i]) == state.last_ts:
+            ts, closes = ts[i:], closes[i:]
+    return state.to_dict() if state.count else None, ts, closes
+
+
+async def _evaluate_jobs(jobs: List[tuple]) -> List[tuple]:
+    """Посчитать пачками в пуле процессов (fan-out/fan-in) или прямо здесь, если пар мало."""
+    periods = (FAST_EMA_PERIOD, SLOW_EMA_PERIOD, ATR_PERIOD)
+    filters = (MIN_TREND_PCT, MIN_ATR_PCT, MAX_ATR_PCT)
+    pool = eval_pool() if len(jobs) >= SIGNAL_EVAL_POOL_MIN else None
+    if pool is None:
+        return indicators.evaluate_batch(jobs, periods, filters)
+
+    loop = asyncio.get_running_loop()
+    batches = [jobs[i:i + SIGNAL_EVAL_BATCH] for i in range(0, len(jobs), SIGNAL_EVAL_BATCH)]
+    parts = await asyncio.gather(
+        *(loop.run_in_executor(pool, indicators.evaluate_batch, batch, periods, filters) for batch in batches)
+    )
+    return [result for part in parts for result in part]
 
-    symbols = list(symbols) or ["BTCUSDT"]
-    pair = random.choice(symbols)
 
+# ---------- СКАНЕР ПАР ----------
+
+async def _fetch_pair(pair: str, priority: int) -> Optional[Tuple[str, np.ndarray, np.ndarray]]:
     coin_id = COINGECKO_IDS.get(pair)
     if not coin_id:
         logger.warning("No CoinGecko ID for pair %s", pair)
         return None
 
     # Берём ~3 дня истории, там будут почасовые точки
-    series = await fetch_coingecko_market_chart(coin_id, days=3)
-    if not series:
+    series = await fetch_coingecko_market_chart(coin_id, days=3, priority=priority)
+    if series is None:
         return None
+    return (coin_id, *series)
 
-    closes = [p for _, p in series]
-    if len(closes) < max(SLOW_EMA_PERIOD, ATR_PERIOD) + 5:
-        # мало данных, лучше ничего не давать, чем городить мусор
-        return None
 
-    last_close = closes[-1]
+async def scan_symbols(
+    symbols: Sequence[str],
+    priority: int = PRIORITY_BACKGROUND,
+) -> List[Tuple[float, str, indicators.Setup]]:
+    """
+    Оценить все пары и вернуть прошедшие фильтры как (score, пара, сетап), лучшие первыми:
+    • серии закрытий с CoinGecko загружаются одновременно; ошибка одной пары не мешает остальным
+    • по каждой паре докатывается состояние EMA20 / EMA50 / ATR за 14 интервалов
+      (при разрыве — пересборка) и применяются фильтры по тренду и волатильности;
+      при большом числе пар — в пуле процессов (_evaluate_jobs)
+    """
+    fetched = await asyncio.gather(
+        *(_fetch_pair(pair, priority) for pair in symbols),
+        return_exceptions=True,
+    )
+    ready = []
+    for pair, item in zip(symbols, fetched):
+        if isinstance(item, Exception):
+            logger.error("Auto signal scan failed for %s: %s", pair, item)
+        elif item is not None:
+            ready.append((pair, item))
+    if not ready:
+        return []
+
+    results = await _evaluate_jobs([_eval_job(*item) for _, item in ready])
+
+    candidates = []
+    for (pair, (coin_id, _, _)), (data, setup, reseeded) in zip(ready, results):
+        _indicator_states[coin_id] = indicators.StreamState.from_dict(
+            data, FAST_EMA_PERIOD, SLOW_EMA_PERIOD, ATR_PERIOD
+        )
+        if reseeded:
+            logger.info("Indicator state for %s reseeded", coin_id)
+        if setup is None:
+            continue
+        value = indicators.score(setup, MIN_TREND_PCT, MIN_ATR_PCT, MAX_ATR_PCT, IDEAL_ATR_PCT)
+        candidates.append((value, pair, setup))
+    _save_indicator_states()
+
+    candidates.sort(key=lambda item: item[0], reverse=True)
+    logger.info(
+        "Auto signal scan: %s/%s pairs qualified%s",
+        len(candidates),
+        len(symbols),
+        "".join(f", {pair} {value:.2f}" for value, pair, _ in candidates[:5]),
+    )
+    return candidates
+
 
-    ema_fast = _ema(closes, FAST_EMA_PERIOD)
-    ema_slow = _ema(closes, SLOW_EMA_PERIOD)
-    if ema_fast is None or ema_slow is None:
+# ---------- ПОСТРОЕНИЕ СИГНАЛА ПО СВЕЧАМ + EMA + ВОЛАТИЛЬНОСТИ ----------
+
+async def build_auto_signal_text(
+    symbols: Sequence[str],
+    enabled: bool,
+    priority: int = PRIORITY_BACKGROUND,
+) -> Optional[str]:
+    """
+    Сканирует все пары сразу и даёт сигнал по лучшей из прошедших фильтры
+    (сильнее тренд, удобнее волатильность). None — ни одна пара не подошла.
+    """
+    if not enabled:
         return None
 
-    atr = _atr_like(closes, ATR_PERIOD)
-    if atr is None or atr <= 0:
+    symbols = list(symbols) or ["BTCUSDT"]
+    candidates = await scan_symbols(symbols, priority)
+    if not candidates:
         return None
+    _, pair, setup = candidates[0]
+    return _render_signal(pair, setup)
 
-    # Сила тренда относительно медленной EMA
-    trend_pct = (last_close - ema_slow) / last_close * Decimal("100")
-    # Средняя волатильность в процентах
-    atr_pct = atr / last_close * Decimal("100")
 
-    # Фильтр по волатильности
-    if atr_pct < MIN_ATR_PCT or atr_pct > MAX_ATR_PCT:
-        # либо слишком скучно, либо слишком бешено — пропускаем
-        return None
+def _render_signal(pair: str, setup: indicators.Setup) -> str:
+    """Текст сигнала: идея, вход, стоп и тейки от ATR."""
+    direction = setup.direction
+    last_close, atr = setup.last_close, setup.atr
+    trend_pct, atr_pct = setup.trend_pct, setup.atr_pct
 
-    direction = None
     idea_lines = []
-
-    # Фильтр по тренду: цена + EMA20 + EMA50 должны смотреть в одну сторону
-    if trend_pct > MIN_TREND_PCT and ema_fast > ema_slow:
-        direction = "long"
+    if direction == "long":
         idea_lines.append("🟢 Идея: LONG по тренду (цена выше EMA, бычий наклон).")
-    elif trend_pct < -MIN_TREND_PCT and ema_fast < ema_slow:
-        direction = "short"
-        idea_lines.append("🔴 Идея: SHORT по тренду (цена ниже EMA, медвежий наклон).")
     else:
-        # тренд слабый/размазанный — не даём сигнал
-        return None
+        idea_lines.append("🔴 Идея: SHORT по тренду (цена ниже EMA, медвежий наклон).")
 
     # Разные настройки для BTC/ETH и альтов
     if pair in ("BTCUSDT", "ETHUSDT"):
-        sl_mult = Decimal("1.5")   # стоп ~1.5 ATR
-        tp1_mult = Decimal("1.5")  # TP1 ~1.5 ATR
-        tp2_mult = Decimal("3")    # TP2 ~3 ATR
+        sl_mult = 1.5   # стоп ~1.5 ATR
+        tp1_mult = 1.5  # TP1 ~1.5 ATR
+        tp2_mult = 3.0  # TP2 ~3 ATR
     else:
-        sl_mult = Decimal("1.8")   # альты агрессивнее
-        tp1_mult = Decimal("2")
-        tp2_mult = Decimal("4")
+        sl_mult = 1.8   # альты агрессивнее
+        tp1_mult = 2.0
+        tp2_mult = 4.0
 
     entry_mid = last_close
-    entry_zone = atr * Decimal("0.5")  # вход диапазоном ≈ пол-ATR
+    entry_zone = atr * 0.5  # вход диапазоном ≈ пол-ATR
 
     if direction == "long":
         entry_low = entry_mid - entry_zone
@@ -0,0 +1,249 @@
+# benchmarks/bench_db.py
+#
+# Задержка event loop и латентность хэндлеров под конкурентной нагрузкой:
+#   before  — прежний код (0b3f956): sqlite3.connect на каждый вызов, журнал DELETE,
+#             всё прямо в event loop
+#   sync    — нынешние синхронные хелперы (постоянное WAL-соединение) в event loop
+#   async   — async-слой (db.read / db.write), как его используют хэндлеры
+# Главная метрика — задержка event loop (loop lag): пока он стоит, бот не разбирает
+# апдейты никого из пользователей. Каждый режим работает на своей копии засеянной базы.
+#
+# Запуск:  python benchmarks/bench_db.py [--users 2000] [--requests 2000] [--rate 500]
+#                                        [--dir /path/on/real/disk] [--synchronous FULL]
+
+import argparse
+import asyncio
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+from decimal import ROUND_DOWN, Decimal
+from types import SimpleNamespace
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def _fake_message(tg_id: int):
+    return SimpleNamespace(from_user=SimpleNamespace(id=tg_id, username=f"u{tg_id}", first_name="Bench"))
+
+
+# --- эталон: прежние хелперы из bot.py (соединение на каждый вызов) ---
+
+
+class Baseline:
+    def __init__(self, path: str):
+        self.path = path
+
+    def connect(self):
+        return sqlite3.connect(self.path)
+
+    def get_user_by_tg(self, user_id: int):
+        conn = self.connect()
+        cur = conn.cursor()
+        cur.execute(
+            """
+            SELECT id, user_id, username, first_name,
+                   referrer_id, balance, total_earned, full_access
+            FROM users WHERE user_id = ?
+            """,
+            (user_id,),
+        )
+        row = cur.fetchone()
+        conn.close()
+        return row
+
+    def count_referrals(self, user_db_id: int):
+        conn = self.connect()
+        cur = conn.cursor()
+        cur.execute("SELECT COUNT(*) FROM users WHERE referrer_id = ?", (user_db_id,))
+        lvl1 = cur.fetchone()[0]
+        cur.execute(
+            "SELECT COUNT(*) FROM users WHERE referrer_id IN (SELECT id FROM users WHERE referrer_id = ?)",
+            (user_db_id,),
+        )
+        lvl2 = cur.fetchone()[0]
+        conn.close()
+        return lvl1, lvl2
+
+    def get_signals_until(self, user_db_id: int):
+        conn = self.connect()
+        cur = conn.cursor()
+        cur.execute("SELECT active_until FROM signals_access WHERE user_id = ?", (user_db_id,))
+        row = cur.fetchone()
+        conn.close()
+        if not row or not row[0]:
+            return None
+        return datetime.strptime(row[0], "%Y-%m-%d %H:%M:%S")
+
+    def get_progress(self, user_db_id: int, course: str) -> int:
+        conn = self.connect()
+        cur = conn.cursor()
+        cur.execute("SELECT module_index FROM progress WHERE user_id = ? AND course = ?", (user_db_id, course))
+        row = cur.fetchone()
+        conn.close()
+        return row[0] if row else -1
+
+    def create_purchase(self, user_db_id: int, product_code: str, base_price: Decimal) -> int:
+        tail = Decimal(random.randint(1, 999)) / Decimal("1000")
+        amount = (base_price + tail).quantize(Decimal("0.000"), rounding=ROUND_DOWN)
+        conn = self.connect()
+        cur = conn.cursor()
+        created_at = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+        cur.execute(
+            "INSERT INTO purchases (user_id, product_code, amount, status, created_at) VALUES (?, ?, ?, 'pending', ?)",
+            (user_db_id, product_code, float(amount), created_at),
+        )
+        conn.commit()
+        purchase_id = cur.lastrowid
+        conn.close()
+        return purchase_id
+
+
+def _copy_db(src: str, dst: str, journal_mode: str = None):
+    with sqlite3.connect(src) as source, sqlite3.connect(dst) as target:
+        source.backup(target)
+        if journal_mode:
+            target.execute(f"PRAGMA journal_mode={journal_mode}")
+    source.close()
+    target.close()
+
+
+def _seed(bot, users: int):
+    prev = None
+    for tg_id in range(1, users + 1):
+        prev = bot.get_or_create_user(_fake_message(tg_id), prev if tg_id % 3 else None)
+
+
+def _pct(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+async def _run(handler, requests: int, rate: float, users: int):
+    """
+    Открытая нагрузка: запросы приходят с частотой rate/сек независимо от того,
+    успевает ли бот. Латентность считается от момента «прихода» апдейта,
+    поэтому время, пока event loop заблокирован, тоже попадает в замер.
+    """
+    latencies = []
+    lags = []
+    stop = False
+
+    async def heartbeat():
+        # насколько опаздывает event loop (то, что видит polling)
+        while not stop:
+            t = time.perf_counter()
+            await asyncio.sleep(0.001)
+            lags.append(time.perf_counter() - t - 0.001)
+
+    async def one(i, arrived):
+        await handler(1 + i % users, i)
+        latencies.append(time.perf_counter() - arrived)
+
+    hb = asyncio.create_task(heartbeat())
+    tasks = []
+    started = time.perf_counter()
+    for i in range(requests):
+        arrived = started + i / rate
+        delay = arrived - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(one(i, arrived)))
+    await asyncio.gather(*tasks)
+    wall = time.perf_counter() - started
+    stop = True
+    await hb
+    return latencies, lags, wall
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--rate", type=float, default=500, help="входящих апдейтов в секунду")
+    parser.add_argument("--write-every", type=int, default=5, help="каждый N-й запрос создаёт покупку")
+    parser.add_argument("--dir", default=None, help="где создать базу (важно: tmpfs не делает реальный fsync)")
+    parser.add_argument("--synchronous", default=None, help="переопределить PRAGMA synchronous (например FULL)")
+    args = parser.parse_args()
+
+    if args.synchronous:
+        import db
+
+        db.SQLITE_PRAGMAS = tuple(
+            (name, args.synchronous if name == "synchronous" else value) for name, value in db.SQLITE_PRAGMAS
+        )
+
+    workdir = tempfile.mkdtemp(prefix="bench_db_", dir=args.dir)
+    os.chdir(workdir)  # bot.DB_PATH относительный — база создаётся во временной папке
+    import bot
+
+    bot.init_db()
+    _seed(bot, args.users)
+    bot.db.close()
+    seeded = os.path.join(workdir, "seeded.db")
+    _copy_db(bot.DB_PATH, seeded)
+
+    baseline = Baseline(os.path.join(workdir, "before.db"))
+
+    async def handler_before(tg_id, i):
+        row = baseline.get_user_by_tg(tg_id)
+        user_db_id = row[0]
+        baseline.count_referrals(user_db_id)
+        baseline.get_signals_until(user_db_id)
+        baseline.get_progress(user_db_id, "crypto")
+        baseline.get_progress(user_db_id, "traffic")
+        if i % args.write_every == 0:
+            baseline.create_purchase(user_db_id, "package", Decimal("100"))
+
+    async def handler_sync(tg_id, i):
+        row = bot.get_user_by_tg(tg_id)
+        user_db_id = row[0]
+        bot.count_referrals(user_db_id)
+        bot.get_signals_until(user_db_id)
+        bot.get_progress(user_db_id, "crypto")
+        bot.get_progress(user_db_id, "traffic")
+        if i % args.write_every == 0:
+            bot.create_purchase(user_db_id, "package", Decimal("100"))
+
+    async def handler_async(tg_id, i):
+        row = await bot.get_user_by_tg_async(tg_id)
+        user_db_id = row[0]
+        await bot.count_referrals_async(user_db_id)
+        await bot.get_signals_until_async(user_db_id)
+        await bot.get_progress_async(user_db_id, "crypto")
+        await bot.get_progress_async(user_db_id, "traffic")
+        if i % args.write_every == 0:
+            await bot.create_purchase_async(user_db_id, "package", Decimal("100"))
+
+    print(
+        f"users={args.users} requests={args.requests} rate={args.rate:.0f}/s "
+        f"write_every={args.write_every} synchronous={args.synchronous or 'default'} db={workdir}"
+    )
+    modes = (
+        ("before", handler_before, "before.db", "DELETE"),
+        ("sync", handler_sync, "sync.db", None),
+        ("async (after)", handler_async, "async.db", None),
+    )
+    for name, handler, path, journal_mode in modes:
+        _copy_db(seeded, os.path.join(workdir, path), journal_mode)
+        bot.db.close()
+        bot.db.path = os.path.join(workdir, path)
+        bot.user_cache.clear()
+        bot.load_pending_tails()
+        latencies, lags, wall = asyncio.run(_run(handler, args.requests, args.rate, args.users))
+        print(
+            f"{name:14} loop lag p99={_pct(lags, 0.99) * 1000:7.2f} ms max={max(lags) * 1000:7.2f} ms  "
+            f"latency p50={statistics.median(latencies) * 1000:7.2f} ms p99={_pct(latencies, 0.99) * 1000:7.2f} ms  "
+            f"rps={args.requests / wall:8.0f}"
+        )
+
+    bot.db.close()
+
+
+if __name__ == "__main__":
+    main()
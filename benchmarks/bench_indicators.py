@@ -0,0 +1,132 @@
+# benchmarks/bench_indicators.py
+#
+# Индикаторы авто-сигналов: прежняя реализация на Decimal (циклы по списку)
+# против indicators.py на NumPy. Считается и стоимость подготовки данных:
+# ответ CoinGecko (список [ts, price]) -> Decimal(str(price)) против -> float64.
+# Печатает время на серию, ускорение и максимальную относительную ошибку.
+#
+# Запуск:  python benchmarks/bench_indicators.py [--points 10000] [--series 20]
+
+import argparse
+import os
+import random
+import sys
+import time
+from decimal import Decimal
+from typing import Optional, Sequence
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import indicators  # noqa: E402
+from auto_signals import ATR_PERIOD, FAST_EMA_PERIOD, MAX_ATR_PCT, MIN_ATR_PCT, MIN_TREND_PCT, SLOW_EMA_PERIOD  # noqa: E402
+
+
+# --- эталон: прежний код из auto_signals.py ---
+
+def _ema(values: Sequence[Decimal], period: int) -> Optional[Decimal]:
+    if len(values) < period:
+        return None
+    alpha = Decimal("2") / Decimal(period + 1)
+    ema_val = values[0]
+    for v in values[1:]:
+        ema_val = (v - ema_val) * alpha + ema_val
+    return ema_val
+
+
+def _atr_like(values: Sequence[Decimal], period: int) -> Optional[Decimal]:
+    if len(values) <= period:
+        return None
+    diffs = []
+    for i in range(-period, 0):
+        diffs.append(abs(values[i] - values[i - 1]))
+    return sum(diffs, Decimal("0")) / Decimal(len(diffs))
+
+
+def _decimal_setup(prices):
+    closes = [Decimal(str(p)) for _, p in prices]
+    last_close = closes[-1]
+    ema_fast = _ema(closes, FAST_EMA_PERIOD)
+    ema_slow = _ema(closes, SLOW_EMA_PERIOD)
+    atr = _atr_like(closes, ATR_PERIOD)
+    trend_pct = (last_close - ema_slow) / last_close * Decimal("100")
+    atr_pct = atr / last_close * Decimal("100")
+    return ema_fast, ema_slow, atr, trend_pct, atr_pct
+
+
+def _numpy_setup(prices):
+    closes = indicators.as_series(np.array(prices, dtype=np.float64)[:, 1])
+    last_close = float(closes[-1])
+    ema_fast = indicators.ema(closes, FAST_EMA_PERIOD)
+    ema_slow = indicators.ema(closes, SLOW_EMA_PERIOD)
+    atr = indicators.atr_like(closes, ATR_PERIOD)
+    trend_pct = (last_close - ema_slow) / last_close * 100.0
+    atr_pct = atr / last_close * 100.0
+    return ema_fast, ema_slow, atr, trend_pct, atr_pct
+
+
+def _decision(values) -> Optional[str]:
+    """Та же логика фильтров, что в indicators.evaluate, по готовым значениям."""
+    ema_fast, ema_slow, atr, trend_pct, atr_pct = (float(v) for v in values)
+    if atr <= 0 or atr_pct < MIN_ATR_PCT or atr_pct > MAX_ATR_PCT:
+        return None
+    if trend_pct > MIN_TREND_PCT and ema_fast > ema_slow:
+        return "long"
+    if trend_pct < -MIN_TREND_PCT and ema_fast < ema_slow:
+        return "short"
+    return None
+
+
+def _random_walk(points: int, start: float, vol: float):
+    """Серия в формате CoinGecko market_chart: [[ts_ms, price], ...]."""
+    ts = 1_700_000_000_000
+    price = start
+    out = []
+    for i in range(points):
+        price *= 1 + random.gauss(0.0002, vol)
+        out.append([ts + i * 3_600_000, price])
+    return out
+
+
+def _timed(fn, data):
+    started = time.perf_counter()
+    result = [fn(prices) for prices in data]
+    return result, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--points", type=int, default=10_000, help="точек в серии")
+    parser.add_argument("--series", type=int, default=20, help="сколько серий прогнать")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    starts = (65000.0, 3400.0, 150.0, 0.45, 0.000012)
+    data = [_random_walk(args.points, starts[i % len(starts)], 0.01) for i in range(args.series)]
+
+    dec_results, dec_time = _timed(_decimal_setup, data)
+    np_results, np_time = _timed(_numpy_setup, data)
+
+    names = ("ema_fast", "ema_slow", "atr", "trend_pct", "atr_pct")
+    worst = dict.fromkeys(names, 0.0)
+    for dec, fast in zip(dec_results, np_results):
+        for name, ref, got in zip(names, dec, fast):
+            ref = float(ref)
+            err = abs(got - ref) / abs(ref) if ref else abs(got)
+            worst[name] = max(worst[name], err)
+    same = sum(_decision(d) == _decision(f) for d, f in zip(dec_results, np_results))
+
+    print(f"series={args.series} points={args.points}")
+    print(f"  decimal: {dec_time / args.series * 1000:8.2f} ms/series")
+    print(f"  numpy:   {np_time / args.series * 1000:8.2f} ms/series")
+    print(f"  speedup: {dec_time / np_time:8.1f}x")
+    for name in names:
+        print(f"  max rel err {name:10s} {worst[name]:.2e}")
+    print(f"  same decision: {same}/{args.series}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+# benchmarks/bench_scan.py
+#
+# Пропускная способность этапа оценки сканера (auto_signals._evaluate_jobs):
+# расчёт прямо в event loop против пула процессов. Кроме пар в секунду печатается
+# максимальная задержка event loop во время скана — именно она показывает,
+# насколько скан тормозит обработку сообщений бота.
+#
+# Режимы серий:
+#   cold — состояния нет, каждая пара пересобирается по всей серии (первый скан, разрыв)
+#   warm — состояние есть, в задачу уходит только хвост от точки стыка
+#
+# Запуск:  python benchmarks/bench_scan.py [--symbols 400] [--points 72] [--processes 1,2,4]
+
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import auto_signals  # noqa: E402
+import indicators  # noqa: E402
+
+
+def _series(points: int):
+    ts = np.arange(points, dtype=np.int64) * 3_600_000 + 1_700_000_000_000
+    steps = 1 + np.random.normal(random.uniform(-0.003, 0.003), random.uniform(0.002, 0.02), points)
+    return ts, indicators.as_series(random.uniform(0.01, 50000) * np.cumprod(steps))
+
+
+def _jobs(symbols: int, points: int, warm: bool):
+    periods = (auto_signals.FAST_EMA_PERIOD, auto_signals.SLOW_EMA_PERIOD, auto_signals.ATR_PERIOD)
+    jobs = []
+    for _ in range(symbols):
+        ts, closes = _series(points)
+        if not warm:
+            jobs.append((None, ts, closes))
+            continue
+        # состояние по всему, кроме двух последних часов; в задачу — стык, новый час и текущая цена
+        state = indicators.StreamState(*periods)
+        state.seed(ts[:-3], closes[:-3])
+        jobs.append((state.to_dict(), ts[-4:], closes[-4:]))
+    return jobs
+
+
+async def _measure(jobs, rounds: int):
+    """(пар в секунду, максимальная задержка event loop в мс)."""
+    lag = 0.0
+    running = True
+
+    async def ticker():
+        nonlocal lag
+        while running:
+            started = time.perf_counter()
+            await asyncio.sleep(0.001)
+            lag = max(lag, time.perf_counter() - started - 0.001)
+
+    tick = asyncio.ensure_future(ticker())
+    await asyncio.sleep(0.01)
+    started = time.perf_counter()
+    for _ in range(rounds):
+        await auto_signals._evaluate_jobs(jobs)
+    elapsed = time.perf_counter() - started
+    running = False
+    await tick
+    return len(jobs) * rounds / elapsed, lag * 1000
+
+
+async def _run(args):
+    modes = [("loop", 0)] + [(f"pool x{n}", n) for n in args.processes]
+    for warm in (False, True):
+        jobs = _jobs(args.symbols, args.points, warm)
+        print(f"{'warm' if warm else 'cold'}: symbols={args.symbols} points={args.points}")
+        for name, processes in modes:
+            auto_signals.close_eval_pool()
+            auto_signals.SIGNAL_EVAL_PROCESSES = processes
+            await auto_signals._evaluate_jobs(jobs)  # прогрев: старт процессов пула, импорт NumPy
+            rate, lag = await _measure(jobs, args.rounds)
+            print(f"  {name:8s} {rate:10.0f} symbols/s   max loop lag {lag:7.1f} ms")
+    auto_signals.close_eval_pool()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--symbols", type=int, default=400)
+    parser.add_argument("--points", type=int, default=72, help="точек в серии (3 дня по часу = 72)")
+    parser.add_argument("--processes", default="1,2,4", help="размеры пула через запятую")
+    parser.add_argument("--batch", type=int, default=auto_signals.SIGNAL_EVAL_BATCH)
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+    args.processes = [int(n) for n in args.processes.split(",") if n]
+
+    random.seed(1)
+    np.random.seed(1)
+    os.chdir(tempfile.mkdtemp(prefix="bench_scan_"))
+    auto_signals.SIGNAL_EVAL_BATCH = args.batch
+    auto_signals.SIGNAL_EVAL_POOL_MIN = 0
+    asyncio.run(_run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+# benchmarks/fake_trongrid.py
+#
+# Локальный фейк TronGrid (/v1/accounts/{address}/transactions/trc20) и прогон
+# фонового поиска оплат на пуле кошельков против него: заявки раскладываются
+# по кошелькам, на каждую «приходит» перевод точной суммы, poll_payments()
+# должен зачесть всё ровно один раз.
+#
+# Запуск:  python benchmarks/fake_trongrid.py [--wallets 4] [--purchases 2000]
+#                                             [--assignment least_loaded|round_robin] [--noise 500]
+
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import Counter
+from types import SimpleNamespace
+
+from aiohttp import web
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+class FakeTronGrid:
+    """
+    Минимальная копия TronGrid для TRC20-истории кошелька: min_timestamp,
+    order_by=block_timestamp,asc, limit и постраничный fingerprint (здесь — смещение).
+    """
+
+    def __init__(self):
+        self.transfers = {}  # адрес -> [tx, ...] по возрастанию block_timestamp
+        self.requests = Counter()
+        self._seq = 0
+        self._runner = None
+        self.url = None
+
+    def add_transfer(self, to_address: str, value: int, block_timestamp: int = None, decimals: int = 6) -> str:
+        self._seq += 1
+        tx = {
+            "transaction_id": f"fake{self._seq:08d}",
+            "from": "TFAKEPAYER",
+            "to": to_address,
+            "value": str(value),
+            "block_timestamp": block_timestamp or int(time.time() * 1000),
+            "token_info": {"address": "TFAKEUSDT", "decimals": decimals},
+        }
+        txs = self.transfers.setdefault(to_address, [])
+        txs.append(tx)
+        txs.sort(key=lambda item: item["block_timestamp"])
+        return tx["transaction_id"]
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        address = request.match_info["address"]
+        self.requests[address] += 1
+        min_ts = int(request.query.get("min_timestamp", 0))
+        limit = int(request.query.get("limit", 20))
+        offset = int(request.query.get("fingerprint") or 0)
+
+        txs = [tx for tx in self.transfers.get(address, []) if tx["block_timestamp"] >= min_ts]
+        page = txs[offset:offset + limit]
+        meta = {}
+        if offset + limit < len(txs):
+            meta["fingerprint"] = str(offset + limit)
+        return web.json_response({"data": page, "success": True, "meta": meta})
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        app = web.Application()
+        app.router.add_get("/v1/accounts/{address}/transactions/trc20", self._handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://{host}:{port}"
+        return self.url
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+
+def _fake_message(tg_id: int):
+    return SimpleNamespace(from_user=SimpleNamespace(id=tg_id, username=f"u{tg_id}", first_name="Fake"))
+
+
+async def _run(bot, args):
+    fake = FakeTronGrid()
+    bot.TRONGRID_API_URL = await fake.start()
+
+    async def send_message(*_, **__):
+        return None
+
+    bot.bot.send_message = send_message
+
+    # заявки от разных пользователей, чтобы не срабатывало переиспользование открытой заявки
+    purchases = []
+    for tg_id in range(1, args.purchases + 1):
+        user_db_id = await bot.get_or_create_user_async(_fake_message(tg_id))
+        product, price = random.choice(list(bot.PRODUCT_PRICES.items()))
+        purchase_id = await bot.create_purchase_async(user_db_id, product, price)
+        purchases.append(await bot.get_purchase_async(purchase_id))
+
+    for row in purchases:
+        fake.add_transfer(row[8], row[7])
+    for _ in range(args.noise):
+        # посторонние переводы: суммы, не совпадающие ни с одной заявкой
+        fake.add_transfer(random.choice(bot.WALLET_ADDRESSES), random.randint(1, 10 ** 6) * 7 + 3)
+
+    started = time.perf_counter()
+    settled = await bot.poll_payments()
+    elapsed = time.perf_counter() - started
+    again = await bot.poll_payments()
+
+    paid = bot.db.fetchone("SELECT COUNT(*) FROM purchases WHERE status = 'paid'")[0]
+    per_wallet = Counter(row[8] for row in purchases)
+    print(
+        f"wallets={len(bot.WALLET_ADDRESSES)} assignment={bot.WALLET_ASSIGNMENT} "
+        f"purchases={len(purchases)} noise={args.noise}"
+    )
+    for wallet in bot.WALLET_ADDRESSES:
+        print(f"  {wallet}: purchases={per_wallet[wallet]:5d} trongrid_requests={fake.requests[wallet]}")
+    print(f"settled={settled} paid_in_db={paid} second_pass={again} poll={elapsed:.2f}s")
+    await bot.http_client.close()
+    await fake.stop()
+
+    ok = settled == paid == len(purchases) and again == 0
+    print("OK" if ok else "MISMATCH")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--wallets", type=int, default=4)
+    parser.add_argument("--purchases", type=int, default=2000)
+    parser.add_argument("--assignment", default="least_loaded", choices=("least_loaded", "round_robin"))
+    parser.add_argument("--noise", type=int, default=500, help="посторонних переводов")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="fake_trongrid_")
+    os.chdir(workdir)  # bot.DB_PATH относительный — база создаётся во временной папке
+    import bot
+
+    bot.WALLET_ADDRESSES = [f"TFAKEWALLET{i:02d}" for i in range(args.wallets)]
+    bot.WALLET_ASSIGNMENT = args.assignment
+    bot.init_db()
+    bot.load_pending_tails()
+
+    ok = asyncio.run(_run(bot, args))
+    bot.db.close()
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
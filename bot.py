@@ -1,13 +1,27 @@
 import logging
 import sqlite3
 import asyncio
-import random
+import itertools
 from decimal import Decimal, ROUND_DOWN
 from datetime import datetime, timedelta
+from typing import Dict, NamedTuple, Optional, Sequence, Tuple
 
-import aiohttp
 from aiogram import Bot, Dispatcher, executor, types
-from auto_signals import auto_signals_worker, build_auto_signal_text
+from auto_signals import (
+    auto_signals_worker,
+    build_auto_signal_text,
+    close_eval_pool,
+    coingecko_api,
+    coingecko_requests,
+    market_cache,
+)
+from cache import LRUCache, SingleFlight
+from db import Database
+from events import EventBus
+from governor import PRIORITY_USER, ApiGovernor, check_response
+import http_client
+from leaderboard import LEADERBOARD_PERIODS, ReferralLeaderboard
+from tails import TailAllocator, TailsExhausted
 from aiogram.types import (
     ReplyKeyboardMarkup,
     KeyboardButton,
@@ -16,6 +30,7 @@ from aiogram.types import (
     CallbackQuery,
 )
 from aiogram.contrib.middlewares.logging import LoggingMiddleware
+from aiogram.utils.exceptions import BotBlocked, ChatNotFound, UserDeactivated
 
 # ---------------------------------------------------------------------------
 # НАСТРОЙКИ 
@@ -34,6 +49,16 @@ TRONGRID_API_KEY = "b33b8d65-10c9-4f7b-99e0-ab47f3bbb60f"
 # TODO: сюда вставь свой TRON-кошелёк, на который люди отправляют USDT (TRC20)
 WALLET_ADDRESS = "TXLAQ63Xg1NAzckPwKHvzw7CSEmLMEqcdj"
 
+# Пул кошельков для приёма оплат: каждой заявке назначается один из них.
+# У каждого кошелька свои хвосты сумм (по 999 на продукт) и свой курсор синхронизации.
+# Кошелёк можно убрать из списка — уже выданные на него заявки всё равно опрашиваются
+WALLET_ADDRESSES = [WALLET_ADDRESS]
+# Выбор кошелька для новой заявки: "least_loaded" (меньше всего открытых заявок) или "round_robin"
+WALLET_ASSIGNMENT = "least_loaded"
+
+# Адрес API TronGrid (для проверки на локальном фейке — см. benchmarks/fake_trongrid.py)
+TRONGRID_API_URL = "https://api.trongrid.io"
+
 # Стандартный контракт USDT TRC20 (можно не менять)
 USDT_CONTRACT = "TXLAQ63Xg1NAzckPwKHvzw7CSEmLMEqcdj"
 
@@ -66,11 +91,68 @@ PRICE_RENEWAL = Decimal("50")    # продление сигналов
 LEVEL1_PERCENT = Decimal("0.5")  # 50%
 LEVEL2_PERCENT = Decimal("0.1")  # 10%
 
+# Базовая цена продукта, к которой добавляется уникальный хвост суммы
+PRODUCT_PRICES = {
+    "package": PRICE_PACKAGE,
+    "renewal": PRICE_RENEWAL,
+}
+
+# Суммы платежей сравниваются в целых микро-USDT (6 знаков, как у USDT TRC20)
+USDT_DECIMALS = 6
+USDT_UNIT = 10 ** USDT_DECIMALS
+# Шаг хвоста суммы — 0.001 USDT
+TAIL_UNIT = USDT_UNIT // 1000
+
 DB_PATH = "database.db"
 
 # Антиспам (минимальный интервал между сообщениями)
 ANTISPAM_SECONDS = 1.2
 
+# Как часто фоновый опрос TronGrid ищет оплаты по ожидающим заявкам (секунды)
+PAYMENTS_POLL_SECONDS = 20
+
+# Локальный журнал TRC20-переводов: за сколько дней подтянуть историю при первом запуске
+# и сколько переводов просить у TronGrid за одну страницу (максимум API — 200)
+TRC20_BACKFILL_DAYS = 7
+TRC20_PAGE_LIMIT = 200
+
+# Одинаковые запросы к TronGrid склеиваются, а ответ живёт в памяти столько секунд
+TRONGRID_CACHE_TTL = 5
+
+# Квоты внешних API: запросов в секунду и сколько можно отправить пачкой
+# (с запасом от лимитов тарифа; CoinGecko — в auto_signals.py)
+TRONGRID_RATE = 10
+TRONGRID_BURST = 10
+BINANCE_RATE = 5
+BINANCE_BURST = 5
+# Таймаут одного запроса к Binance, секунды (TronGrid — общий HTTP_TIMEOUT из http_client.py)
+BINANCE_TIMEOUT = 10
+
+# Как часто топ партнёров в памяти сверяется с БД (секунды)
+LEADERBOARD_REFRESH_SECONDS = 600
+
+# Сколько часов живёт неоплаченная заявка; потом она истекает, а её хвост освобождается.
+# Повторное нажатие «оплатить» в этот срок отдаёт ту же заявку, а не создаёт новую
+PURCHASE_TTL_HOURS = 24
+# Истёкшие заявки старше стольких дней переносятся в purchases_archive
+PURCHASE_ARCHIVE_DAYS = 30
+# Как часто запускается чистка заявок (секунды)
+PURCHASE_EXPIRY_INTERVAL = 600
+# Сколько минут после показанного срока заявка ещё ждёт оплату: перевод, отправленный
+# в последний момент, успевает подтвердиться и попасть в журнал до истечения
+PURCHASE_GRACE_MINUTES = 60
+# Допуск на расхождение часов сервера и сети Tron: перевод может оказаться раньше
+# заявки не больше чем на столько (сумму до создания заявки узнать нельзя)
+PAYMENT_CLOCK_SKEW_MINUTES = 5
+# Сколько помнить уже показанные админу переводы без заявки (секунды) и сколько их держать:
+# с запасом на все переводы кошельков за окно сверки, иначе вытесненные придут админу снова
+UNMATCHED_REPORT_TTL = 7 * 24 * 3600
+UNMATCHED_REPORT_CACHE_SIZE = 200_000
+
+# Кэш строк пользователей (get_user_by_tg): сколько держим и сколько секунд живёт запись
+USER_CACHE_SIZE = 10000
+USER_CACHE_TTL = 300
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
@@ -82,119 +164,378 @@ dp.middleware.setup(LoggingMiddleware())
 # БАЗА ДАННЫХ
 # ---------------------------------------------------------------------------
 
+db = Database(DB_PATH)
 
-def db_connect():
-    return sqlite3.connect(DB_PATH)
+# Кэш строк users по Telegram ID. Все хелперы, которые меняют эти поля,
+# сбрасывают запись после коммита; TTL страхует от правок в обход бота.
+user_cache = LRUCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+# Переводы без заявки, о которых уже сообщили (tx_id -> True)
+unmatched_reported = LRUCache(UNMATCHED_REPORT_CACHE_SIZE, UNMATCHED_REPORT_TTL)
 
+# Занятые хвосты сумм ожидающих заявок по (кошелёк, продукт);
+# пересобирается из БД при старте (load_pending_tails)
+tails = TailAllocator()
+_wallet_rr = itertools.count()
 
-def init_db():
-    conn = db_connect()
-    cur = conn.cursor()
+# Побочные эффекты (уведомления, топ партнёров) — через outbox после коммита, см. раздел СОБЫТИЯ
+event_bus = EventBus(db)
 
-    # Пользователи
-    cur.execute(
-        """
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER UNIQUE,
-            username TEXT,
-            first_name TEXT,
-            referrer_id INTEGER,
-            balance REAL DEFAULT 0,
-            total_earned REAL DEFAULT 0,
-            reg_date TEXT,
-            full_access INTEGER DEFAULT 0,   -- 0/1, полный пакет за 100$
-            is_blocked INTEGER DEFAULT 0     -- 0/1, блокировка
-        )
-        """
-    )
 
-    # Покупки (пакет / продления)
-    cur.execute(
-        """
-        CREATE TABLE IF NOT EXISTS purchases (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            product_code TEXT,              -- "package" / "renewal"
-            amount REAL,
-            status TEXT,                    -- "pending" / "paid"
-            created_at TEXT,
-            paid_at TEXT,
-            tx_id TEXT
-        )
-        """
-    )
+# Миграции схемы: (версия, описание, шаги). Применяются при старте по порядку,
+# текущая версия хранится в таблице schema_version. Новые изменения схемы —
+# только новой миграцией с очередным номером, уже применённые не редактируем.
+MIGRATIONS = [
+    (
+        1,
+        "base schema",
+        [
+            # Пользователи
+            """
+            CREATE TABLE IF NOT EXISTS users (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER UNIQUE,
+                username TEXT,
+                first_name TEXT,
+                referrer_id INTEGER,
+                balance REAL DEFAULT 0,
+                total_earned REAL DEFAULT 0,
+                reg_date TEXT,
+                full_access INTEGER DEFAULT 0,   -- 0/1, полный пакет за 100$
+                is_blocked INTEGER DEFAULT 0     -- 0/1, блокировка
+            )
+            """,
+            # Покупки (пакет / продления)
+            """
+            CREATE TABLE IF NOT EXISTS purchases (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER,
+                product_code TEXT,              -- "package" / "renewal"
+                amount REAL,
+                status TEXT,                    -- "pending" / "paid"
+                created_at TEXT,
+                paid_at TEXT,
+                tx_id TEXT
+            )
+            """,
+            # Подписка на сигналы
+            """
+            CREATE TABLE IF NOT EXISTS signals_access (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER UNIQUE,      -- ссылка на users.id
+                active_until TEXT            -- UTC datetime (YYYY-mm-dd HH:MM:SS)
+            )
+            """,
+            # Прогресс по курсам (отдельно трейдинг и трафик)
+            """
+            CREATE TABLE IF NOT EXISTS progress (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER,
+                course TEXT,                -- "crypto" / "traffic"
+                module_index INTEGER,
+                UNIQUE (user_id, course)
+            )
+            """,
+        ],
+    ),
+    (
+        2,
+        "hot-path indexes",
+        [
+            # count_referrals, топ партнёров, цепочка рефералов
+            "CREATE INDEX IF NOT EXISTS idx_users_referrer_id ON users (referrer_id)",
+            # поиск по @username в админ-командах
+            "CREATE INDEX IF NOT EXISTS idx_users_username ON users (username)",
+            # поиск заявок по статусу и сумме с хвостом
+            "CREATE INDEX IF NOT EXISTS idx_purchases_status_amount ON purchases (status, amount)",
+            # signals_watcher: у кого истекла подписка
+            "CREATE INDEX IF NOT EXISTS idx_signals_access_active_until ON signals_access (active_until)",
+        ],
+    ),
+    (
+        3,
+        "materialized referral counters",
+        [
+            "ALTER TABLE users ADD COLUMN ref_count_l1 INTEGER NOT NULL DEFAULT 0",
+            "ALTER TABLE users ADD COLUMN ref_count_l2 INTEGER NOT NULL DEFAULT 0",
+            "CREATE INDEX IF NOT EXISTS idx_users_ref_count_l1 ON users (ref_count_l1)",
+            lambda cur: _recount_referrals(cur),
+        ],
+    ),
+    (
+        4,
+        "unique purchases.tx_id",
+        [
+            lambda cur: _ensure_unique_tx_ids(cur),
+            """
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_purchases_tx_id
+            ON purchases (tx_id) WHERE tx_id IS NOT NULL
+            """,
+        ],
+    ),
+    (
+        5,
+        "local trc20 transfer ledger",
+        [
+            # Входящие/исходящие TRC20-переводы по нашим кошелькам, как их отдал TronGrid
+            """
+            CREATE TABLE IF NOT EXISTS trc20_transfers (
+                transaction_id TEXT PRIMARY KEY,
+                from_address TEXT,
+                to_address TEXT,
+                token_address TEXT,
+                value INTEGER,               -- сумма в минимальных единицах токена
+                decimals INTEGER,
+                block_timestamp INTEGER      -- мс с эпохи
+            )
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS idx_trc20_transfers_to_ts
+            ON trc20_transfers (to_address, block_timestamp)
+            """,
+            # Курсоры синхронизаций: ключ -> значение (например, последний block_timestamp)
+            """
+            CREATE TABLE IF NOT EXISTS sync_state (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            )
+            """,
+        ],
+    ),
+    (
+        6,
+        "integer micro-usdt amounts",
+        [
+            "ALTER TABLE purchases ADD COLUMN amount_units INTEGER",
+            "UPDATE purchases SET amount_units = CAST(ROUND(amount * 1000000) AS INTEGER)",
+            # индекс ожидающих заявок по точной сумме
+            """
+            CREATE INDEX IF NOT EXISTS idx_purchases_pending_units
+            ON purchases (amount_units) WHERE status = 'pending'
+            """,
+            "ALTER TABLE trc20_transfers ADD COLUMN amount_units INTEGER",
+            lambda cur: _backfill_transfer_units(cur),
+        ],
+    ),
+    (
+        7,
+        "purchase expiry and archive",
+        [
+            # Истёкшие заявки, вынесенные из горячей таблицы purchases
+            """
+            CREATE TABLE IF NOT EXISTS purchases_archive (
+                id INTEGER PRIMARY KEY,
+                user_id INTEGER,
+                product_code TEXT,
+                amount REAL,
+                amount_units INTEGER,
+                status TEXT,
+                created_at TEXT,
+                paid_at TEXT,
+                tx_id TEXT,
+                archived_at TEXT
+            )
+            """,
+            # открытая заявка пользователя на продукт (повторное нажатие «оплатить»)
+            """
+            CREATE INDEX IF NOT EXISTS idx_purchases_pending_user
+            ON purchases (user_id, product_code) WHERE status = 'pending'
+            """,
+            # чистка: ожидающие и истёкшие по возрасту
+            "CREATE INDEX IF NOT EXISTS idx_purchases_status_created ON purchases (status, created_at)",
+        ],
+    ),
+    (
+        8,
+        "receiving wallet per purchase",
+        [
+            "ALTER TABLE purchases ADD COLUMN wallet_address TEXT",
+            "ALTER TABLE purchases_archive ADD COLUMN wallet_address TEXT",
+            # всё, что было до пула кошельков, принималось на WALLET_ADDRESS
+            lambda cur: cur.execute("UPDATE purchases SET wallet_address = ?", (WALLET_ADDRESS,)),
+            lambda cur: cur.execute("UPDATE purchases_archive SET wallet_address = ?", (WALLET_ADDRESS,)),
+            "DROP INDEX IF EXISTS idx_purchases_pending_units",
+            """
+            CREATE INDEX IF NOT EXISTS idx_purchases_pending_wallet_units
+            ON purchases (wallet_address, amount_units) WHERE status = 'pending'
+            """,
+        ],
+    ),
+    (
+        9,
+        "event outbox",
+        [
+            # Доставки событий подписчикам (events.EventBus): строка на пару событие–подписчик,
+            # доставленные удаляются, dead остаются для разбора
+            """
+            CREATE TABLE IF NOT EXISTS event_outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                event TEXT NOT NULL,
+                subscriber TEXT NOT NULL,
+                payload TEXT NOT NULL,                    -- JSON
+                status TEXT NOT NULL DEFAULT 'pending',   -- "pending" / "dead"
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL,            -- unix-время
+                last_error TEXT,
+                created_at TEXT
+            )
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS idx_event_outbox_due
+            ON event_outbox (next_attempt_at) WHERE status = 'pending'
+            """,
+        ],
+    ),
+]
 
-    # Подписка на сигналы
+
+def _ensure_unique_tx_ids(cur):
+    # один перевод уже зачтён в нескольких покупках — это надо разбирать руками,
+    # молча чинить платёжные записи миграцией нельзя
     cur.execute(
         """
-        CREATE TABLE IF NOT EXISTS signals_access (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER UNIQUE,      -- ссылка на users.id
-            active_until TEXT            -- UTC datetime (YYYY-mm-dd HH:MM:SS)
-        )
+        SELECT tx_id, GROUP_CONCAT(id) FROM purchases
+        WHERE tx_id IS NOT NULL
+        GROUP BY tx_id HAVING COUNT(*) > 1
         """
     )
+    duplicates = cur.fetchall()
+    if duplicates:
+        details = "; ".join(f"{tx_id}: purchases {ids}" for tx_id, ids in duplicates)
+        raise RuntimeError(f"Duplicate tx_id in purchases, resolve manually before upgrade: {details}")
 
-    # Прогресс по курсам (отдельно трейдинг и трафик)
-    cur.execute(
-        """
-        CREATE TABLE IF NOT EXISTS progress (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            course TEXT,                -- "crypto" / "traffic"
-            module_index INTEGER,
-            UNIQUE (user_id, course)
-        )
-        """
+
+def _backfill_transfer_units(cur):
+    cur.execute("SELECT transaction_id, value, decimals FROM trc20_transfers")
+    cur.executemany(
+        "UPDATE trc20_transfers SET amount_units = ? WHERE transaction_id = ?",
+        [(token_to_units(value, decimals), tx_id) for tx_id, value, decimals in cur.fetchall()],
     )
 
-    conn.commit()
-    conn.close()
+
+def usdt_to_units(amount: Decimal) -> int:
+    """Сумма в USDT -> целые микро-USDT."""
+    return int((Decimal(amount) * USDT_UNIT).to_integral_value(rounding=ROUND_DOWN))
+
+
+def units_to_usdt(units: int) -> Decimal:
+    """Целые микро-USDT -> Decimal для показа пользователю."""
+    return Decimal(units) / USDT_UNIT
+
+
+def token_to_units(value: int, decimals: int) -> Optional[int]:
+    """
+    Сумма перевода в минимальных единицах токена -> микро-USDT, без деления с остатком.
+    None, если сумма не выражается целым числом микро-USDT (такой перевод ни с чем не совпадёт).
+    """
+    if decimals <= USDT_DECIMALS:
+        return value * 10 ** (USDT_DECIMALS - decimals)
+    units, rest = divmod(value, 10 ** (decimals - USDT_DECIMALS))
+    return None if rest else units
+
+
+def init_db():
+    version = db.migrate(MIGRATIONS)
+    logger.info("DB schema version: %s", version)
 
 
 def get_or_create_user(message: types.Message, referrer_id_db: int = None) -> int:
-    user_id = message.from_user.id
-    username = message.from_user.username or ""
-    first_name = message.from_user.first_name or ""
+    return register_user(message, referrer_id_db)[0]
 
-    conn = db_connect()
-    cur = conn.cursor()
-    cur.execute(
-        "SELECT id FROM users WHERE user_id = ?",
-        (user_id,),
-    )
-    row = cur.fetchone()
 
-    if row:
-        user_db_id = row[0]
-        # на всякий случай обновляем логин / имя
-        cur.execute(
-            "UPDATE users SET username = ?, first_name = ? WHERE id = ?",
-            (username, first_name, user_db_id),
-        )
-        conn.commit()
-        conn.close()
-        return user_db_id
+def _profile_fields(message: types.Message) -> Tuple[int, str, str]:
+    return message.from_user.id, message.from_user.username or "", message.from_user.first_name or ""
+
+
+def _is_unchanged(row, username: str, first_name: str) -> bool:
+    return bool(row) and row[2] == username and row[3] == first_name
+
+
+def register_user(message: types.Message, referrer_id_db: int = None) -> Tuple[int, bool]:
+    """
+    Как get_or_create_user, но дополнительно говорит, был ли пользователь создан
+    только что: (id в БД, создан_сейчас).
+    Повторный /start с теми же ником и именем ничего не пишет в базу.
+    """
+    user_id, username, first_name = _profile_fields(message)
+    row = get_user_by_tg(user_id)
+    if _is_unchanged(row, username, first_name):
+        return row[0], False
+
+    try:
+        return _upsert_user(user_id, username, first_name, referrer_id_db)
+    finally:
+        user_cache.invalidate(user_id)
 
+
+async def register_user_async(message: types.Message, referrer_id_db: int = None) -> Tuple[int, bool]:
+    # быстрый путь (пользователь есть, данные не поменялись) — без очереди к потоку-писателю
+    user_id, username, first_name = _profile_fields(message)
+    row = await get_user_by_tg_async(user_id)
+    if _is_unchanged(row, username, first_name):
+        return row[0], False
+    return await db.write(register_user, message, referrer_id_db)
+
+
+def _upsert_user(user_id: int, username: str, first_name: str, referrer_id_db: Optional[int]):
     reg_date = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
-    cur.execute(
-        """
-        INSERT INTO users (user_id, username, first_name, referrer_id, reg_date)
-        VALUES (?, ?, ?, ?, ?)
-        """,
-        (user_id, username, first_name, referrer_id_db, reg_date),
-    )
-    conn.commit()
-    user_db_id = cur.lastrowid
-    conn.close()
-    return user_db_id
+    with db.transaction() as cur:
+        # RETURNING отдаёт строку только при настоящей вставке — так и отличаем регистрацию
+        row = cur.execute(
+            """
+            INSERT INTO users (user_id, username, first_name, referrer_id, reg_date)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(user_id) DO NOTHING
+            RETURNING id
+            """,
+            (user_id, username, first_name, referrer_id_db, reg_date),
+        ).fetchone()
+        if row is None:
+            # пользователь уже есть — пишем ник и имя, только если они поменялись
+            cur.execute(
+                """
+                UPDATE users SET username = ?, first_name = ?
+                WHERE user_id = ? AND (username IS NOT ? OR first_name IS NOT ?)
+                """,
+                (username, first_name, user_id, username, first_name),
+            )
+            row = cur.execute("SELECT id FROM users WHERE user_id = ?", (user_id,)).fetchone()
+            return row[0], False
+        user_db_id = row[0]
 
+        # счётчики рефералов у пригласившего (1 линия) и у его пригласившего (2 линия)
+        referrer = None
+        if referrer_id_db:
+            cur.execute(
+                "UPDATE users SET ref_count_l1 = ref_count_l1 + 1 WHERE id = ?",
+                (referrer_id_db,),
+            )
+            cur.execute(
+                """
+                UPDATE users SET ref_count_l2 = ref_count_l2 + 1
+                WHERE id = (SELECT referrer_id FROM users WHERE id = ?)
+                """,
+                (referrer_id_db,),
+            )
+            referrer = cur.execute(
+                "SELECT username, first_name FROM users WHERE id = ?", (referrer_id_db,)
+            ).fetchone()
+        event_bus.publish(
+            cur,
+            "user_registered",
+            {
+                "user_db_id": user_db_id,
+                "tg_id": user_id,
+                "referrer_id": referrer_id_db if referrer else None,
+                "referrer_username": referrer[0] if referrer else None,
+                "referrer_first_name": referrer[1] if referrer else None,
+                "reg_date": reg_date,
+            },
+        )
+        return user_db_id, True
 
-def get_user_by_tg(user_id: int):
-    conn = db_connect()
-    cur = conn.cursor()
-    cur.execute(
+
+def _select_user_by_tg(user_id: int):
+    return db.fetchone(
         """
         SELECT id, user_id, username, first_name,
                referrer_id, balance, total_earned, full_access
@@ -202,89 +543,342 @@ def get_user_by_tg(user_id: int):
         """,
         (user_id,),
     )
-    row = cur.fetchone()
-    conn.close()
+
+
+def get_user_by_tg(user_id: int):
+    row = user_cache.get(user_id)
+    if row is None:
+        token = user_cache.token()
+        row = _select_user_by_tg(user_id)
+        if row:
+            user_cache.put(user_id, row, token)
+    return row
+
+
+async def get_user_by_tg_async(user_id: int):
+    # попадание в кэш отдаём сразу, без похода в поток БД
+    row = user_cache.get(user_id)
+    if row is None:
+        token = user_cache.token()
+        row = await db.read(_select_user_by_tg, user_id)
+        if row:
+            user_cache.put(user_id, row, token)
     return row
 
 
+def get_tg_id(user_db_id: int) -> int | None:
+    row = db.fetchone("SELECT user_id FROM users WHERE id = ?", (user_db_id,))
+    return row[0] if row else None
+
+
+def invalidate_user(user_db_id: int):
+    """Сбросить кэш строки пользователя по id в БД (вызывать после коммита)."""
+    tg_id = get_tg_id(user_db_id)
+    if tg_id:
+        user_cache.invalidate(tg_id)
+
+
 def set_full_access(user_db_id: int, value: bool = True):
-    conn = db_connect()
-    cur = conn.cursor()
-    cur.execute(
-        "UPDATE users SET full_access = ? WHERE id = ?",
-        (1 if value else 0, user_db_id),
-    )
-    conn.commit()
-    conn.close()
+    with db.transaction() as cur:
+        cur.execute(
+            "UPDATE users SET full_access = ? WHERE id = ?",
+            (1 if value else 0, user_db_id),
+        )
+    invalidate_user(user_db_id)
 
 
 def has_full_access(user_db_id: int) -> bool:
-    conn = db_connect()
-    cur = conn.cursor()
-    cur.execute("SELECT full_access FROM users WHERE id = ?", (user_db_id,))
-    row = cur.fetchone()
-    conn.close()
+    row = db.fetchone("SELECT full_access FROM users WHERE id = ?", (user_db_id,))
     return bool(row and row[0])
 
 
 def create_purchase(user_db_id: int, product_code: str, base_price: Decimal) -> int:
     """
     Создаём покупку с уникальным хвостом (например 100.543).
+    Если у пользователя уже есть неистёкшая заявка на этот продукт — возвращаем её.
+    Хвост не совпадает ни с одной другой ожидающей заявкой на этот продукт;
+    если свободных хвостов нет — TailsExhausted.
     """
-    # уникальный хвост до 0.999
-    tail = Decimal(random.randint(1, 999)) / Decimal("1000")
-    amount = (base_price + tail).quantize(Decimal("0.000"), rounding=ROUND_DOWN)
+    now = datetime.utcnow()
+    fresh_after = (now - timedelta(hours=PURCHASE_TTL_HOURS)).strftime("%Y-%m-%d %H:%M:%S")
+    wallet = tail = None
+    try:
+        with db.transaction() as cur:
+            cur.execute(
+                """
+                SELECT id FROM purchases
+                WHERE user_id = ? AND product_code = ? AND status = 'pending' AND created_at >= ?
+                ORDER BY id DESC LIMIT 1
+                """,
+                (user_db_id, product_code, fresh_after),
+            )
+            row = cur.fetchone()
+            if row:
+                return row[0]
 
-    conn = db_connect()
-    cur = conn.cursor()
-    created_at = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
-    cur.execute(
-        """
-        INSERT INTO purchases (user_id, product_code, amount, status, created_at)
-        VALUES (?, ?, ?, 'pending', ?)
-        """,
-        (user_db_id, product_code, float(amount), created_at),
-    )
-    conn.commit()
-    purchase_id = cur.lastrowid
-    conn.close()
+            wallet, tail = _allocate_tail(product_code)
+            amount_units = usdt_to_units(base_price) + tail * TAIL_UNIT
+            cur.execute(
+                """
+                INSERT INTO purchases
+                    (user_id, product_code, amount, amount_units, wallet_address, status, created_at)
+                VALUES (?, ?, ?, ?, ?, 'pending', ?)
+                """,
+                (
+                    user_db_id,
+                    product_code,
+                    float(units_to_usdt(amount_units)),
+                    amount_units,
+                    wallet,
+                    now.strftime("%Y-%m-%d %H:%M:%S"),
+                ),
+            )
+            purchase_id = cur.lastrowid
+    except BaseException:
+        if tail is not None:
+            tails.release((wallet, product_code), tail)
+        raise
     return purchase_id
 
 
+def _wallet_order(product_code: str) -> list:
+    """Кошельки пула в порядке, в котором пробуем выдать на них заявку."""
+    wallets = list(WALLET_ADDRESSES)
+    if WALLET_ASSIGNMENT == "round_robin":
+        start = next(_wallet_rr) % len(wallets)
+        return wallets[start:] + wallets[:start]
+    return sorted(wallets, key=lambda wallet: tails.held((wallet, product_code)))
+
+
+def _allocate_tail(product_code: str) -> Tuple[str, int]:
+    """
+    (кошелёк, хвост) для новой заявки: свободный хвост на первом кошельке пула, где он есть.
+    Просроченные заявки здесь не истекают — их истекает только purchases_janitor после
+    финальной сверки кошелька (иначе не успевший синхронизироваться перевод не будет зачтён,
+    а новая заявка получит ту же сумму). Если хвостов нет нигде — TailsExhausted.
+    """
+    for wallet in _wallet_order(product_code):
+        try:
+            return wallet, tails.allocate((wallet, product_code))
+        except TailsExhausted:
+            continue
+    raise TailsExhausted(f"No free amount tails for {product_code} on any wallet")
+
+
+def expire_purchases(now: Optional[datetime] = None, wallets: Optional[Sequence[str]] = None) -> Tuple[int, int]:
+    """
+    Чистка заявок: ожидающие дольше PURCHASE_TTL_HOURS + PURCHASE_GRACE_MINUTES
+    помечаются expired (их хвосты освобождаются), истёкшие старше PURCHASE_ARCHIVE_DAYS
+    переносятся в purchases_archive. wallets — истекать только заявки на этих кошельках
+    (по которым только что прошла финальная сверка). Возвращает (истекло, перенесено в архив).
+    """
+    now = now or datetime.utcnow()
+    expire_before = purchase_stale_before(now)
+    archive_before = (now - timedelta(days=PURCHASE_ARCHIVE_DAYS)).strftime("%Y-%m-%d %H:%M:%S")
+    wallet_filter, params = "", [expire_before]
+    if wallets is not None:
+        wallet_filter = f"AND wallet_address IN ({','.join('?' * len(wallets))})"
+        params.extend(wallets)
+    with db.transaction() as cur:
+        expired = []
+        if wallets is None or wallets:
+            cur.execute(
+                f"""
+                UPDATE purchases SET status = 'expired'
+                WHERE status = 'pending' AND created_at < ? {wallet_filter}
+                RETURNING wallet_address, product_code, amount_units
+                """,
+                params,
+            )
+            expired = cur.fetchall()
+
+        cur.execute(
+            """
+            INSERT INTO purchases_archive
+                (id, user_id, product_code, amount, amount_units, wallet_address,
+                 status, created_at, paid_at, tx_id, archived_at)
+            SELECT id, user_id, product_code, amount, amount_units, wallet_address,
+                   status, created_at, paid_at, tx_id, ?
+            FROM purchases
+            WHERE status = 'expired' AND created_at < ?
+            """,
+            (now.strftime("%Y-%m-%d %H:%M:%S"), archive_before),
+        )
+        archived = cur.rowcount
+        cur.execute("DELETE FROM purchases WHERE status = 'expired' AND created_at < ?", (archive_before,))
+
+    for wallet, product_code, amount_units in expired:
+        tail = purchase_tail(product_code, amount_units)
+        if tail is not None:
+            tails.release((wallet, product_code), tail)
+    return len(expired), archived
+
+
+def purchase_stale_before(now: datetime) -> str:
+    """created_at, раньше которого ожидающая заявка истекает (показанный срок + грейс)."""
+    return (now - timedelta(hours=PURCHASE_TTL_HOURS, minutes=PURCHASE_GRACE_MINUTES)).strftime(
+        "%Y-%m-%d %H:%M:%S"
+    )
+
+
+def purchase_payable_until(created_at: str) -> datetime:
+    """До какого момента перевод ещё засчитывается заявке (показанный срок + грейс)."""
+    return purchase_expires_at(created_at) + timedelta(minutes=PURCHASE_GRACE_MINUTES)
+
+
+def purchase_expires_at(created_at: str) -> datetime:
+    return datetime.strptime(created_at, "%Y-%m-%d %H:%M:%S") + timedelta(hours=PURCHASE_TTL_HOURS)
+
+
+def purchase_tail(product_code: str, amount_units: int) -> Optional[int]:
+    """Хвост суммы заявки в тысячных (100.543 -> 543), None для неизвестного продукта."""
+    base_price = PRODUCT_PRICES.get(product_code)
+    if base_price is None or amount_units is None:
+        return None
+    return (amount_units - usdt_to_units(base_price)) // TAIL_UNIT
+
+
+def load_pending_tails():
+    """Пересобрать занятые хвосты по ожидающим заявкам (при старте)."""
+    rows = db.fetchall("SELECT wallet_address, product_code, amount_units FROM purchases WHERE status = 'pending'")
+    tails.load(
+        ((wallet, product_code), purchase_tail(product_code, amount_units))
+        for wallet, product_code, amount_units in rows
+        if purchase_tail(product_code, amount_units) is not None
+    )
+
+
 def get_purchase(purchase_id: int):
-    conn = db_connect()
-    cur = conn.cursor()
-    cur.execute(
+    """Заявка по id, в том числе уже перенесённая в архив."""
+    return db.fetchone(
         """
-        SELECT id, user_id, product_code, amount, status, created_at, tx_id
+        SELECT id, user_id, product_code, amount, status, created_at, tx_id, amount_units, wallet_address
         FROM purchases WHERE id = ?
+        UNION ALL
+        SELECT id, user_id, product_code, amount, status, created_at, tx_id, amount_units, wallet_address
+        FROM purchases_archive WHERE id = ?
+        LIMIT 1
         """,
-        (purchase_id,),
+        (purchase_id, purchase_id),
     )
-    row = cur.fetchone()
-    conn.close()
-    return row
 
 
-def mark_purchase_paid(purchase_id: int, tx_id: str):
-    conn = db_connect()
-    cur = conn.cursor()
-    paid_at = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
-    cur.execute(
+def get_pending_purchases():
+    """{кошелёк: [(id, сумма в микро-USDT, created_at), ...]} всех неоплаченных заявок."""
+    by_wallet = {}
+    for purchase_id, wallet, amount_units, created_at in db.fetchall(
+        "SELECT id, wallet_address, amount_units, created_at FROM purchases WHERE status = 'pending'"
+    ):
+        by_wallet.setdefault(wallet, []).append(
+            (purchase_id, amount_units, datetime.strptime(created_at, "%Y-%m-%d %H:%M:%S"))
+        )
+    return by_wallet
+
+
+def get_sync_state(key: str) -> Optional[str]:
+    row = db.fetchone("SELECT value FROM sync_state WHERE key = ?", (key,))
+    return row[0] if row else None
+
+
+def save_trc20_transfers(txs: list, cursor_key: str, cursor_value: str) -> int:
+    """
+    Сохраняем страницу переводов из TronGrid и сдвигаем курсор синхронизации
+    одной транзакцией. Уже известные переводы пропускаются. Возвращает, сколько новых.
+    """
+    rows = []
+    for tx in txs:
+        try:
+            token_info = tx.get("token_info") or {}
+            value = int(tx.get("value", "0"))
+            decimals = int(token_info.get("decimals", USDT_DECIMALS))
+            rows.append(
+                (
+                    tx["transaction_id"],
+                    tx.get("from"),
+                    tx.get("to"),
+                    token_info.get("address"),
+                    value,
+                    decimals,
+                    token_to_units(value, decimals),
+                    int(tx["block_timestamp"]),
+                )
+            )
+        except Exception as e:
+            logger.exception("Error while parsing Tron tx: %s", e)
+
+    with db.transaction() as cur:
+        before = db.conn().total_changes
+        cur.executemany(
+            """
+            INSERT OR IGNORE INTO trc20_transfers
+                (transaction_id, from_address, to_address, token_address, value, decimals,
+                 amount_units, block_timestamp)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            rows,
+        )
+        inserted = db.conn().total_changes - before
+        cur.execute(
+            """
+            INSERT INTO sync_state (key, value) VALUES (?, ?)
+            ON CONFLICT(key) DO UPDATE SET value = excluded.value
+            """,
+            (cursor_key, cursor_value),
+        )
+    return inserted
+
+
+def get_unclaimed_transfers(to_address: str, since_ms: int) -> list:
+    """
+    Входящие переводы на кошелёк начиная с since_ms, которые ещё не зачтены
+    ни в одной покупке: [(transaction_id, сумма в микро-USDT, block_timestamp), ...]
+    """
+    return db.fetchall(
         """
-        UPDATE purchases
-        SET status = 'paid', paid_at = ?, tx_id = ?
-        WHERE id = ?
+        SELECT t.transaction_id, t.amount_units, t.block_timestamp
+        FROM trc20_transfers t
+        WHERE t.to_address = ? AND t.block_timestamp >= ? AND t.amount_units IS NOT NULL
+          AND NOT EXISTS (SELECT 1 FROM purchases p WHERE p.tx_id = t.transaction_id)
+        ORDER BY t.block_timestamp
         """,
-        (paid_at, tx_id, purchase_id),
+        (to_address, since_ms),
     )
-    conn.commit()
-    conn.close()
+
+
+def get_transfer_info(transaction_id: str):
+    """Перевод из локального журнала + покупка, в которой он зачтён (если есть)."""
+    return db.fetchone(
+        """
+        SELECT t.transaction_id, t.from_address, t.to_address, t.value, t.decimals,
+               t.block_timestamp, p.id, p.status, u.user_id
+        FROM trc20_transfers t
+        LEFT JOIN purchases p ON p.tx_id = t.transaction_id
+        LEFT JOIN users u ON u.id = p.user_id
+        WHERE t.transaction_id = ?
+        """,
+        (transaction_id,),
+    )
+
+
+def mark_purchase_paid(purchase_id: int, tx_id: str):
+    paid_at = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+    with db.transaction() as cur:
+        cur.execute(
+            """
+            UPDATE purchases
+            SET status = 'paid', paid_at = ?, tx_id = ?
+            WHERE id = ?
+            """,
+            (paid_at, tx_id, purchase_id),
+        )
 
 
 def extend_signals(user_db_id: int, days: int = 30):
-    conn = db_connect()
-    cur = conn.cursor()
+    with db.transaction() as cur:
+        _extend_signals(cur, user_db_id, days)
+
+
+def _extend_signals(cur, user_db_id: int, days: int):
     now = datetime.utcnow()
     cur.execute("SELECT active_until FROM signals_access WHERE user_id = ?", (user_db_id,))
     row = cur.fetchone()
@@ -305,16 +899,10 @@ def extend_signals(user_db_id: int, days: int = 30):
             "INSERT INTO signals_access (user_id, active_until) VALUES (?, ?)",
             (user_db_id, new_until_str),
         )
-    conn.commit()
-    conn.close()
 
 
 def get_signals_until(user_db_id: int):
-    conn = db_connect()
-    cur = conn.cursor()
-    cur.execute("SELECT active_until FROM signals_access WHERE user_id = ?", (user_db_id,))
-    row = cur.fetchone()
-    conn.close()
+    row = db.fetchone("SELECT active_until FROM signals_access WHERE user_id = ?", (user_db_id,))
     if not row or not row[0]:
         return None
     try:
@@ -324,8 +912,12 @@ def get_signals_until(user_db_id: int):
 
 
 def add_balance(user_db_id: int, amount: Decimal):
-    conn = db_connect()
-    cur = conn.cursor()
+    with db.transaction() as cur:
+        _add_balance(cur, user_db_id, amount)
+    invalidate_user(user_db_id)
+
+
+def _add_balance(cur, user_db_id: int, amount: Decimal):
     cur.execute(
         """
         UPDATE users
@@ -334,78 +926,306 @@ def add_balance(user_db_id: int, amount: Decimal):
         """,
         (float(amount), float(amount), user_db_id),
     )
-    conn.commit()
-    conn.close()
 
 
 def get_referrer_chain(user_db_id: int):
     """
     id первого и второго уровня (в таблице users)
     """
-    conn = db_connect()
-    cur = conn.cursor()
-    cur.execute("SELECT referrer_id FROM users WHERE id = ?", (user_db_id,))
-    row = cur.fetchone()
+    row = db.fetchone("SELECT referrer_id FROM users WHERE id = ?", (user_db_id,))
     lvl1_id = row[0] if row else None
 
     lvl2_id = None
     if lvl1_id:
-        cur.execute("SELECT referrer_id FROM users WHERE id = ?", (lvl1_id,))
-        row2 = cur.fetchone()
+        row2 = db.fetchone("SELECT referrer_id FROM users WHERE id = ?", (lvl1_id,))
         if row2:
             lvl2_id = row2[0]
 
-    conn.close()
     return lvl1_id, lvl2_id
 
 
+class Settlement(NamedTuple):
+    """Итог зачисления оплаты: кому и что сообщить после коммита (payload события purchase_paid)."""
+
+    product_code: str
+    buyer_tg_id: Optional[int]
+    lvl1_tg_id: Optional[int]
+    lvl2_tg_id: Optional[int]
+    lvl1_bonus: Optional[Decimal]
+    lvl2_bonus: Optional[Decimal]
+
+
+def settle_purchase(purchase_id: int, tx_id: str) -> Optional[Settlement]:
+    """
+    Всё зачисление оплаты одной транзакцией: покупка помечается оплаченной,
+    открывается доступ / продлеваются сигналы, начисляется партнёрка.
+    Падение посередине откатывает всё целиком.
+
+    Покупка переводится в paid только из pending (compare-and-set), поэтому
+    повторный вызов для той же покупки ничего не начисляет и возвращает None.
+    Исключение — заявка, которую истекли, пока шло сопоставление: её перевод всё равно
+    зачитывается, если он пришёл до purchase_payable_until (иначе её хвост мог уже
+    достаться новой заявке, и перевод принадлежит той).
+    Если tx_id уже зачтён в другой покупке — sqlite3.IntegrityError
+    (уникальный индекс по purchases.tx_id), транзакция откатывается.
+    """
+    paid_at = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+    with db.transaction() as cur:
+        current = cur.execute("SELECT status, created_at FROM purchases WHERE id = ?", (purchase_id,)).fetchone()
+        if not current:
+            return None
+        was_pending = current[0] == "pending"
+        if not was_pending:
+            if current[0] != "expired":
+                return None
+            tx = cur.execute(
+                "SELECT block_timestamp FROM trc20_transfers WHERE transaction_id = ?", (tx_id,)
+            ).fetchone()
+            if not tx or tx[0] >= _to_ms(purchase_payable_until(current[1])):
+                return None
+
+        cur.execute(
+            """
+            UPDATE purchases
+            SET status = 'paid', paid_at = ?, tx_id = ?
+            WHERE id = ? AND status = ?
+            RETURNING user_id, product_code, amount_units, wallet_address
+            """,
+            (paid_at, tx_id, purchase_id, current[0]),
+        )
+        row = cur.fetchone()
+        if not row:
+            return None
+        user_db_id, product_code, amount_units, wallet = row
+
+        # покупатель и оба уровня рефереров одним запросом
+        cur.execute(
+            """
+            SELECT b.user_id, l1.id, l1.user_id, l2.id, l2.user_id
+            FROM users b
+            LEFT JOIN users l1 ON l1.id = b.referrer_id
+            LEFT JOIN users l2 ON l2.id = l1.referrer_id
+            WHERE b.id = ?
+            """,
+            (user_db_id,),
+        )
+        buyer_tg_id, lvl1_id, lvl1_tg_id, lvl2_id, lvl2_tg_id = cur.fetchone() or (None,) * 5
+
+        lvl1_bonus = lvl2_bonus = None
+        if product_code == "package":
+            # открываем полный доступ и продлеваем сигналы на месяц
+            cur.execute("UPDATE users SET full_access = 1 WHERE id = ?", (user_db_id,))
+            _extend_signals(cur, user_db_id, 30)
+
+            # реферальные начисления считаем от базовой цены (100$), а не от суммы с хвостом
+            if lvl1_id:
+                lvl1_bonus = (PRICE_PACKAGE * LEVEL1_PERCENT).quantize(Decimal("0.01"))
+                _add_balance(cur, lvl1_id, lvl1_bonus)
+            if lvl2_id:
+                lvl2_bonus = (PRICE_PACKAGE * LEVEL2_PERCENT).quantize(Decimal("0.01"))
+                _add_balance(cur, lvl2_id, lvl2_bonus)
+        elif product_code == "renewal":
+            # только продление сигналов, без партнёрки
+            _extend_signals(cur, user_db_id, 30)
+
+        settlement = Settlement(
+            product_code,
+            buyer_tg_id,
+            lvl1_tg_id if lvl1_bonus else None,
+            lvl2_tg_id if lvl2_bonus else None,
+            lvl1_bonus,
+            lvl2_bonus,
+        )
+        # уведомления уйдут подписчикам после коммита (at-least-once через outbox)
+        event_bus.publish(cur, "purchase_paid", {"purchase_id": purchase_id, "tx_id": tx_id, **settlement._asdict()})
+
+    for tg_id in (buyer_tg_id, lvl1_tg_id, lvl2_tg_id):
+        if tg_id:
+            user_cache.invalidate(tg_id)
+
+    # у истёкшей заявки хвост уже освобождён и, возможно, занят новой заявкой
+    tail = purchase_tail(product_code, amount_units)
+    if was_pending and tail is not None:
+        tails.release((wallet, product_code), tail)
+
+    return settlement
+
+
 def save_progress(user_db_id: int, course: str, module_index: int):
-    conn = db_connect()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        INSERT INTO progress (user_id, course, module_index)
-        VALUES (?, ?, ?)
-        ON CONFLICT(user_id, course) DO UPDATE SET module_index = excluded.module_index
-        """,
-        (user_db_id, course, module_index),
-    )
-    conn.commit()
-    conn.close()
+    with db.transaction() as cur:
+        cur.execute(
+            """
+            INSERT INTO progress (user_id, course, module_index)
+            VALUES (?, ?, ?)
+            ON CONFLICT(user_id, course) DO UPDATE SET module_index = excluded.module_index
+            """,
+            (user_db_id, course, module_index),
+        )
 
 
 def get_progress(user_db_id: int, course: str) -> int:
-    conn = db_connect()
-    cur = conn.cursor()
-    cur.execute(
+    row = db.fetchone(
         "SELECT module_index FROM progress WHERE user_id = ? AND course = ?",
         (user_db_id, course),
     )
-    row = cur.fetchone()
-    conn.close()
     return row[0] if row else -1
 
 
 def count_referrals(user_db_id: int):
-    conn = db_connect()
-    cur = conn.cursor()
-    # 1 линия
-    cur.execute("SELECT COUNT(*) FROM users WHERE referrer_id = ?", (user_db_id,))
-    lvl1 = cur.fetchone()[0]
-    # 2 линия
+    row = db.fetchone("SELECT ref_count_l1, ref_count_l2 FROM users WHERE id = ?", (user_db_id,))
+    return (row[0], row[1]) if row else (0, 0)
+
+
+def _recount_referrals(cur) -> list:
+    """
+    Пересчитать счётчики рефералов с нуля по referrer_id.
+    Возвращает расхождения: [(id, было_l1, было_l2, стало_l1, стало_l2), ...]
+    """
     cur.execute(
         """
-        SELECT COUNT(*)
-        FROM users
-        WHERE referrer_id IN (
-            SELECT id FROM users WHERE referrer_id = ?
+        WITH l1 AS (
+            SELECT referrer_id AS id, COUNT(*) AS n
+            FROM users WHERE referrer_id IS NOT NULL
+            GROUP BY referrer_id
+        ),
+        l2 AS (
+            SELECT r1.referrer_id AS id, COUNT(*) AS n
+            FROM users r2
+            JOIN users r1 ON r2.referrer_id = r1.id
+            WHERE r1.referrer_id IS NOT NULL
+            GROUP BY r1.referrer_id
         )
-        """,
-        (user_db_id,),
+        SELECT u.id, u.ref_count_l1, u.ref_count_l2, COALESCE(l1.n, 0), COALESCE(l2.n, 0)
+        FROM users u
+        LEFT JOIN l1 ON l1.id = u.id
+        LEFT JOIN l2 ON l2.id = u.id
+        WHERE u.ref_count_l1 != COALESCE(l1.n, 0) OR u.ref_count_l2 != COALESCE(l2.n, 0)
+        """
+    )
+    drift = cur.fetchall()
+    cur.executemany(
+        "UPDATE users SET ref_count_l1 = ?, ref_count_l2 = ? WHERE id = ?",
+        [(l1, l2, user_db_id) for user_db_id, _, _, l1, l2 in drift],
     )
-    lvl2 = cur.fetchone()[0]
-    conn.close()
-    return lvl1, lvl2
+    return drift
+
+
+def rebuild_referral_counters() -> list:
+    with db.transaction() as cur:
+        return _recount_referrals(cur)
+
+
+def load_leaderboard_data():
+    """
+    Данные для топа партнёров: счётчики всех партнёров,
+    регистрации рефералов за самое длинное окно (по возрастанию даты)
+    и последний users.id — всё из одного снимка базы.
+    """
+    conn = db.conn()
+    conn.execute("BEGIN")  # читающая транзакция: все три запроса видят один снимок
+    try:
+        totals = db.fetchall(
+            "SELECT id, username, first_name, ref_count_l1 FROM users WHERE ref_count_l1 > 0"
+        )
+        longest = max(w for w in LEADERBOARD_PERIODS.values() if w is not None)
+        since = (datetime.utcnow() - longest).strftime("%Y-%m-%d %H:%M:%S")
+        recent = [
+            (referrer_id, datetime.strptime(reg_date, "%Y-%m-%d %H:%M:%S"))
+            for referrer_id, reg_date in db.fetchall(
+                """
+                SELECT referrer_id, reg_date FROM users
+                WHERE referrer_id IS NOT NULL AND reg_date >= ?
+                ORDER BY reg_date
+                """,
+                (since,),
+            )
+        ]
+        last_user_id = db.fetchone("SELECT COALESCE(MAX(id), 0) FROM users")[0]
+    finally:
+        conn.commit()
+    return totals, recent, last_user_id
+
+
+class ProfileSnapshot(NamedTuple):
+    """Всё, что нужно экранам профиля / статистики, одним запросом."""
+
+    id: int
+    user_id: int
+    username: str
+    first_name: str
+    referrer_id: Optional[int]
+    balance: float
+    total_earned: float
+    full_access: int
+    lvl1: int
+    lvl2: int
+    signals_until: Optional[datetime]
+    crypto_progress: int    # индекс последнего открытого модуля, -1 — не начинал
+    traffic_progress: int
+
+
+_PROFILE_SQL = """
+    SELECT u.id, u.user_id, u.username, u.first_name,
+           u.referrer_id, u.balance, u.total_earned, u.full_access,
+           u.ref_count_l1, u.ref_count_l2,
+           sa.active_until,
+           COALESCE(pc.module_index, -1),
+           COALESCE(pt.module_index, -1)
+    FROM users u
+    LEFT JOIN signals_access sa ON sa.user_id = u.id
+    LEFT JOIN progress pc ON pc.user_id = u.id AND pc.course = 'crypto'
+    LEFT JOIN progress pt ON pt.user_id = u.id AND pt.course = 'traffic'
+    WHERE {where}
+"""
+
+
+def _profile_from_row(row) -> Optional[ProfileSnapshot]:
+    if not row:
+        return None
+    signals_until = None
+    if row[10]:
+        try:
+            signals_until = datetime.strptime(row[10], "%Y-%m-%d %H:%M:%S")
+        except Exception:
+            signals_until = None
+    return ProfileSnapshot(*row[:10], signals_until, *row[11:])
+
+
+def get_profile(tg_id: int) -> Optional[ProfileSnapshot]:
+    return _profile_from_row(db.fetchone(_PROFILE_SQL.format(where="u.user_id = ?"), (tg_id,)))
+
+
+def get_profile_by_db_id(user_db_id: int) -> Optional[ProfileSnapshot]:
+    return _profile_from_row(db.fetchone(_PROFILE_SQL.format(where="u.id = ?"), (user_db_id,)))
+
+
+# Асинхронные версии хелперов для хэндлеров: запросы выполняются в потоках БД
+# (чтения — в пуле читателей, записи — в потоке-писателе) и не блокируют event loop.
+get_or_create_user_async = db.writer(get_or_create_user)
+get_tg_id_async = db.reader(get_tg_id)
+set_full_access_async = db.writer(set_full_access)
+has_full_access_async = db.reader(has_full_access)
+create_purchase_async = db.writer(create_purchase)
+expire_purchases_async = db.writer(expire_purchases)
+get_purchase_async = db.reader(get_purchase)
+mark_purchase_paid_async = db.writer(mark_purchase_paid)
+get_pending_purchases_async = db.reader(get_pending_purchases)
+get_sync_state_async = db.reader(get_sync_state)
+save_trc20_transfers_async = db.writer(save_trc20_transfers)
+get_unclaimed_transfers_async = db.reader(get_unclaimed_transfers)
+get_transfer_info_async = db.reader(get_transfer_info)
+extend_signals_async = db.writer(extend_signals)
+get_signals_until_async = db.reader(get_signals_until)
+add_balance_async = db.writer(add_balance)
+get_referrer_chain_async = db.reader(get_referrer_chain)
+save_progress_async = db.writer(save_progress)
+get_progress_async = db.reader(get_progress)
+count_referrals_async = db.reader(count_referrals)
+settle_purchase_async = db.writer(settle_purchase)
+rebuild_referral_counters_async = db.writer(rebuild_referral_counters)
+load_leaderboard_data_async = db.reader(load_leaderboard_data)
+get_profile_async = db.reader(get_profile)
+get_profile_by_db_id_async = db.reader(get_profile_by_db_id)
 
 
 # ---------------------------------------------------------------------------
@@ -424,171 +1244,400 @@ def is_spam(user_id: int) -> bool:
     return (now - last) < timedelta(seconds=ANTISPAM_SECONDS)
 
 
+# ---------------------------------------------------------------------------
+# ТОП ПАРТНЁРОВ (В ПАМЯТИ)
+# ---------------------------------------------------------------------------
+
+leaderboard = ReferralLeaderboard()
+# Последний users.id, вошедший в загруженный топ: более ранние регистрации
+# подписчик user_registered уже не добавляет
+leaderboard_last_user_id = 0
+
+
+async def refresh_leaderboard():
+    global leaderboard_last_user_id
+    totals, recent, last_user_id = await load_leaderboard_data_async()
+    leaderboard.load(totals, recent)
+    leaderboard_last_user_id = last_user_id
+
+
+async def leaderboard_refresher():
+    """
+    Периодически перезагружаем топ из БД, чтобы он не расходился с базой
+    (смена ников, ручные правки, /recount_refs и т.п.).
+    """
+    while True:
+        await asyncio.sleep(LEADERBOARD_REFRESH_SECONDS)
+        try:
+            await refresh_leaderboard()
+        except Exception as e:
+            logger.error("Leaderboard refresh error: %s", e)
+
+
 # ---------------------------------------------------------------------------
 # ТРАНЗАКЦИИ TRONGRID
 # ---------------------------------------------------------------------------
 
 
-async def fetch_trc20_transactions() -> list:
+trongrid_requests = SingleFlight(TRONGRID_CACHE_TTL)
+trongrid_api = ApiGovernor("trongrid", TRONGRID_RATE, TRONGRID_BURST)
+# Опрос кошелька (payments_watcher и финальная сверка janitor) идёт по одному за раз
+wallet_poll_locks: Dict[str, asyncio.Lock] = {}
+
+
+def _to_ms(dt: datetime) -> int:
+    """UTC datetime -> миллисекунды с эпохи (как block_timestamp в TronGrid)."""
+    return int((dt - datetime(1970, 1, 1)).total_seconds() * 1000)
+
+
+async def fetch_trc20_page(address: str, min_timestamp: int, fingerprint: str = None):
     """
-    Получаем последние TRC20-транзакции по нашему кошельку.
+    Одна страница TRC20-переводов по кошельку, от старых к новым, начиная с min_timestamp.
+    Возвращает (переводы, fingerprint следующей страницы или None).
+    Параллельные одинаковые запросы идут в TronGrid одним запросом (trongrid_requests).
     """
+    return await trongrid_requests.do(
+        ("trc20", address, min_timestamp, fingerprint),
+        lambda: _fetch_trc20_page(address, min_timestamp, fingerprint),
+    )
+
+
+async def _fetch_trc20_page(address: str, min_timestamp: int, fingerprint: str = None):
     headers = {"TRON-PRO-API-KEY": TRONGRID_API_KEY} if TRONGRID_API_KEY else {}
-    url = f"https://api.trongrid.io/v1/accounts/{WALLET_ADDRESS}/transactions/trc20"
+    url = f"{TRONGRID_API_URL}/v1/accounts/{address}/transactions/trc20"
     params = {
-        "limit": 50,
+        "limit": TRC20_PAGE_LIMIT,
         "contract_address": USDT_CONTRACT,
         "only_confirmed": "true",
+        "order_by": "block_timestamp,asc",
+        "min_timestamp": min_timestamp,
     }
+    if fingerprint:
+        params["fingerprint"] = fingerprint
 
-    async with aiohttp.ClientSession(headers=headers) as session:
-        async with session.get(url, params=params, timeout=20) as resp:
+    async def request():
+        async with http_client.session().get(url, params=params, headers=headers) as resp:
+            check_response(resp)  # 429/5xx — повтор через trongrid_api
             if resp.status != 200:
+                # 401/403 (ключ, квота) — это не «новых переводов нет»: сверка кошелька
+                # должна провалиться, иначе janitor истечёт его заявки без проверки
                 text = await resp.text()
                 logger.error("TronGrid error %s: %s", resp.status, text)
-                return []
+                raise RuntimeError(f"TronGrid HTTP {resp.status}")
             data = await resp.json()
-            return data.get("data", [])
+            meta = data.get("meta") or {}
+            return data.get("data", []), meta.get("fingerprint")
 
+    return await trongrid_api.call(request)
 
-async def find_payment_for_purchase(amount: Decimal, created_at: datetime) -> str | None:
+
+async def sync_trc20_transfers(address: str) -> int:
     """
-    Ищем транзакцию по сумме (с хвостиком) и времени создания.
-    Возвращаем tx_id или None.
+    Докачиваем в локальный журнал переводы, появившиеся после курсора.
+    Курсор — block_timestamp последнего сохранённого перевода (включительно,
+    дубли отсекает PRIMARY KEY). Без курсора подтягиваем историю за TRC20_BACKFILL_DAYS.
+    Возвращает, сколько новых переводов сохранено.
     """
-    txs = await fetch_trc20_transactions()
-    if not txs:
-        return None
+    cursor_key = f"trc20:{address}"
+    cursor = await get_sync_state_async(cursor_key)
+    if cursor:
+        min_ts = int(cursor)
+    else:
+        min_ts = _to_ms(datetime.utcnow() - timedelta(days=TRC20_BACKFILL_DAYS))
 
-    for tx in txs:
-        try:
-            to_addr = tx.get("to")
-            if to_addr != WALLET_ADDRESS:
-                continue
+    inserted = 0
+    fingerprint = None
+    while True:
+        txs, fingerprint = await fetch_trc20_page(address, min_ts, fingerprint)
+        if not txs:
+            break
+        page_max_ts = max(int(tx.get("block_timestamp") or 0) for tx in txs)
+        cursor_value = str(max(page_max_ts, int(cursor or 0)))
+        inserted += await save_trc20_transfers_async(txs, cursor_key, cursor_value)
+        cursor = cursor_value
+        if not fingerprint:
+            break
+    return inserted
+
+
+def index_pending(pending: list) -> dict:
+    """
+    Индекс ожидающих заявок по точной сумме:
+    {сумма в микро-USDT: [(purchase_id, created_at), ...] от старых к новым}
+    """
+    index = {}
+    for purchase_id, amount_units, created_at in sorted(pending, key=lambda p: p[2]):
+        index.setdefault(amount_units, []).append((purchase_id, created_at))
+    return index
 
-            token_info = tx.get("token_info") or {}
-            decimals = int(token_info.get("decimals", 6))
-            raw_value = Decimal(tx.get("value", "0"))
-            value = raw_value / (Decimal(10) ** decimals)
 
-            # чуть-чуть допускаем плавающую точку
-            if abs(value - amount) > Decimal("0.0005"):
+def match_payments(transfers: list, pending: list) -> list:
+    """
+    Сопоставляем пачку переводов со всеми ожидающими заявками за один проход:
+    на каждый перевод — один поиск в словаре по точной сумме, без допусков.
+    transfers: [(transaction_id, сумма в микро-USDT, block_timestamp), ...] из журнала
+    pending: [(purchase_id, сумма в микро-USDT, created_at), ...]
+    Возвращаем [(purchase_id, tx_id), ...]; каждый перевод и каждая заявка
+    попадают не более чем в одну пару.
+    """
+    index = index_pending(pending)
+    matches = []
+
+    for tx_id, amount_units, ts_ms in transfers:
+        candidates = index.get(amount_units)
+        if not candidates:
+            continue
+        tx_time = datetime.utcfromtimestamp(ts_ms / 1000.0)
+        for i, (purchase_id, created_at) in enumerate(candidates):
+            # перевод не может быть раньше заявки: сумму до её создания не узнать.
+            # Так и перевод по истёкшей заявке не уйдёт новой заявке с тем же хвостом
+            if tx_time < created_at - timedelta(minutes=PAYMENT_CLOCK_SKEW_MINUTES):
                 continue
+            matches.append((purchase_id, tx_id))
+            del candidates[i]
+            break
 
-            ts_ms = tx.get("block_timestamp")
-            tx_time = datetime.utcfromtimestamp(ts_ms / 1000.0)
+    return matches
 
-            # проверяем, что платёж не сильно старше заявки (например, не старше 24 часов)
-            if tx_time + timedelta(hours=24) < created_at:
-                continue
 
-            tx_id = tx.get("transaction_id")
-            return tx_id
-        except Exception as e:
-            logger.exception("Error while parsing Tron tx: %s", e)
-            continue
+async def poll_payments() -> int:
+    """
+    Один проход фонового поиска оплат: кошельки, на которые есть ожидающие заявки,
+    опрашиваются параллельно, каждый со своим курсором. Ошибка одного кошелька
+    не мешает остальным. Возвращает, сколько покупок зачислено.
+    """
+    pending = await get_pending_purchases_async()
+    if not pending:
+        # ждать нечего — TronGrid не дёргаем, курсоры догонят историю позже
+        return 0
+
+    results = await asyncio.gather(
+        *(poll_wallet(wallet, wallet_pending) for wallet, wallet_pending in pending.items()),
+        return_exceptions=True,
+    )
+    settled = 0
+    for wallet, result in zip(pending, results):
+        if isinstance(result, Exception):
+            logger.error("Payments poll error for %s: %s", wallet, result)
+        else:
+            settled += result
+    return settled
+
 
+async def poll_wallet(address: str, pending: list) -> int:
+    """
+    Докачиваем свежие переводы кошелька в локальный журнал и сопоставляем
+    незачтённые сразу со всеми ожидающими заявками этого кошелька.
+    Параллельный опрос того же кошелька ждёт окончания текущего (wallet_poll_locks).
+    """
+    lock = wallet_poll_locks.setdefault(address, asyncio.Lock())
+    async with lock:
+        return await _poll_wallet(address, pending)
+
+
+async def _poll_wallet(address: str, pending: list) -> int:
+    await sync_trc20_transfers(address)
+
+    # платёж не может быть раньше самой старой заявки (с допуском на часы)
+    oldest = min(created_at for _, _, created_at in pending) - timedelta(minutes=PAYMENT_CLOCK_SKEW_MINUTES)
+    since_ms = _to_ms(oldest)
+    transfers = await get_unclaimed_transfers_async(address, since_ms)
+
+    settled = 0
+    claimed = set()
+    for purchase_id, tx_id in match_payments(transfers, pending):
+        # "already_paid"/"tx_used" — перевод уже зачтён (в том числе этой же заявке), это не «перевод без заявки»
+        claimed.add(tx_id)
+        if await process_successful_payment(purchase_id, tx_id) == "paid":
+            settled += 1
+            logger.info("Purchase %s paid by tx %s", purchase_id, tx_id)
+    await report_unmatched_transfers(address, [tx for tx in transfers if tx[0] not in claimed])
+    return settled
+
+
+def invoice_product(amount_units: int) -> Optional[str]:
+    """Продукт, на оплату которого похожа сумма (цена + хвост), иначе None."""
+    for product_code, base_price in PRODUCT_PRICES.items():
+        tail, rest = divmod(amount_units - usdt_to_units(base_price), TAIL_UNIT)
+        if not rest and tails.tail_min <= tail <= tails.tail_max:
+            return product_code
     return None
 
 
-async def process_successful_payment(purchase_row):
+async def report_unmatched_transfers(address: str, transfers: list):
     """
-    purchase_row: (id, user_id, product_code, amount, status, created_at, tx_id)
-    Начисляет доступ, продление, партнёрку.
+    Переводы на кошелёк, не зачтённые ни одной заявке. Сумма вида «цена + хвост» —
+    почти наверняка оплата по истёкшей заявке: пишем предупреждение и сообщаем админу.
+    Каждый перевод показывается один раз (unmatched_reported).
     """
-    purchase_id, user_db_id, product_code, amount_f, status, created_at_str, _ = purchase_row
-    amount = Decimal(str(amount_f))
-
-    # Помечаем как оплачено (tx_id уже определили до вызова)
-    # tx_id мы передадим из проверяющей функции
-    # Здесь только логика начислений
-
-    # Если это пакет за 100$
-    if product_code == "package":
-        # открываем полный доступ
-        set_full_access(user_db_id, True)
-        # продлеваем сигналы на месяц
-        extend_signals(user_db_id, days=30)
-
-        # реферальные начисления считаем от базовой цены (100$), а не от суммы с хвостом
-        base = PRICE_PACKAGE
-        lvl1_id, lvl2_id = get_referrer_chain(user_db_id)
-        lvl1_bonus = (base * LEVEL1_PERCENT).quantize(Decimal("0.01"))
-        lvl2_bonus = (base * LEVEL2_PERCENT).quantize(Decimal("0.01"))
-
-        # 1 уровень
-        if lvl1_id:
-            add_balance(lvl1_id, lvl1_bonus)
-            # уведомление
-            conn = db_connect()
-            cur = conn.cursor()
-            cur.execute("SELECT user_id FROM users WHERE id = ?", (lvl1_id,))
-            r = cur.fetchone()
-            conn.close()
-            if r:
-                try:
-                    await bot.send_message(
-                        r[0],
-                        f"💰 <b>Начислено {lvl1_bonus}$</b> за личную рекомендацию.\n"
-                        f"Твой партнёр совершил покупку полного доступа.",
-                    )
-                except Exception:
-                    pass
-
-        # 2 уровень
-        if lvl2_id:
-            add_balance(lvl2_id, lvl2_bonus)
-            conn = db_connect()
-            cur = conn.cursor()
-            cur.execute("SELECT user_id FROM users WHERE id = ?", (lvl2_id,))
-            r = cur.fetchone()
-            conn.close()
-            if r:
-                try:
-                    await bot.send_message(
-                        r[0],
-                        f"💸 <b>Начислено {lvl2_bonus}$</b> со второго уровня.\n"
-                        f"Партнёр второй линии купил полный доступ.",
-                    )
-                except Exception:
-                    pass
-
-        # уведомляем покупателя
-        conn = db_connect()
-        cur = conn.cursor()
-        cur.execute("SELECT user_id FROM users WHERE id = ?", (user_db_id,))
-        r = cur.fetchone()
-        conn.close()
-        if r:
-            tg_id = r[0]
-            try:
-                await bot.send_message(
-                    tg_id,
-                    "✅ <b>Оплата подтверждена!</b>\n\n"
-                    "Полный доступ к обучению, партнёрке и сигналам (на 1 месяц) открыт.\n"
-                    f"Сигналы приходят в канале: {SIGNALS_CHANNEL_LINK}",
-                )
-            except Exception:
-                pass
-
-    elif product_code == "renewal":
-        # только продление сигналов, без партнёрки
-        extend_signals(user_db_id, days=30)
-        conn = db_connect()
-        cur = conn.cursor()
-        cur.execute("SELECT user_id FROM users WHERE id = ?", (user_db_id,))
-        r = cur.fetchone()
-        conn.close()
-        if r:
-            tg_id = r[0]
-            try:
-                await bot.send_message(
-                    tg_id,
-                    "✅ <b>Продление сигналов оплачено!</b>\n\n"
-                    "Подписка на сигнальный канал продлена ещё на 30 дней.",
-                )
-            except Exception:
-                pass
+    for tx_id, amount_units, ts_ms in transfers:
+        if unmatched_reported.get(tx_id):
+            continue
+        unmatched_reported.put(tx_id, True)
+        product_code = invoice_product(amount_units)
+        if product_code is None:
+            logger.info("Unmatched transfer %s to %s: %s units", tx_id, address, amount_units)
+            continue
+        logger.warning(
+            "Unmatched %s payment %s to %s: %s units at %s", product_code, tx_id, address, amount_units, ts_ms
+        )
+        await _notify(
+            ADMIN_ID,
+            "⚠️ <b>Перевод без заявки</b>\n\n"
+            f"Кошелёк: <code>{address}</code>\n"
+            f"Сумма: <b>{units_to_usdt(amount_units)} USDT</b> (похоже на оплату «{product_code}»)\n"
+            f"Хэш: <code>{tx_id}</code>\n\n"
+            "Ни одна ожидающая заявка не подошла — возможно, заявка уже истекла. "
+            f"Подробности: /tx {tx_id}",
+        )
+
+
+async def payments_watcher():
+    """
+    Фоновая задача: раз в PAYMENTS_POLL_SECONDS ищем оплаты по всем заявкам.
+    Количество запросов к TronGrid зависит только от времени, а не от нажатий,
+    а пользователь получает подтверждение сам, без кнопки.
+    """
+    await asyncio.sleep(5)
+    # при старте догоняем журналы переводов (или делаем первичную загрузку истории)
+    results = await asyncio.gather(
+        *(sync_trc20_transfers(wallet) for wallet in WALLET_ADDRESSES),
+        return_exceptions=True,
+    )
+    for wallet, result in zip(WALLET_ADDRESSES, results):
+        if isinstance(result, Exception):
+            logger.error("TRC20 backfill error for %s: %s", wallet, result)
+
+    while True:
+        try:
+            await poll_payments()
+        except Exception as e:
+            logger.error("Payments watcher error: %s", e)
+
+        await asyncio.sleep(PAYMENTS_POLL_SECONDS)
+
+
+async def poll_expiring_wallets(now: datetime) -> list:
+    """
+    Финальная сверка перед истечением: кошельки, на которых есть заявки к истечению,
+    докачивают журнал и сопоставляют переводы. Возвращает кошельки, где сверка
+    прошла (или истекать нечего); заявки остальных ждут следующего прохода.
+    """
+    pending = await get_pending_purchases_async()
+    stale_before = datetime.strptime(purchase_stale_before(now), "%Y-%m-%d %H:%M:%S")
+    due = [
+        wallet
+        for wallet, items in pending.items()
+        if any(created_at < stale_before for _, _, created_at in items)
+    ]
+    results = await asyncio.gather(*(poll_wallet(wallet, pending[wallet]) for wallet in due), return_exceptions=True)
+    failed = set()
+    for wallet, result in zip(due, results):
+        if isinstance(result, Exception):
+            logger.error("Final payments check failed for %s, not expiring its purchases: %s", wallet, result)
+            failed.add(wallet)
+    return [wallet for wallet in set(WALLET_ADDRESSES) | set(pending) if wallet not in failed]
+
+
+async def purchases_janitor():
+    """
+    Фоновая задача: раз в PURCHASE_EXPIRY_INTERVAL истекают старые неоплаченные
+    заявки (после финальной сверки их кошельков), а давно истёкшие уезжают в архив —
+    purchases не растёт бесконечно.
+    """
+    while True:
+        try:
+            now = datetime.utcnow()
+            wallets = await poll_expiring_wallets(now)
+            expired, archived = await expire_purchases_async(now, wallets)
+            if expired or archived:
+                logger.info("Purchases expired: %s, archived: %s", expired, archived)
+        except Exception as e:
+            logger.error("Purchases janitor error: %s", e)
+
+        await asyncio.sleep(PURCHASE_EXPIRY_INTERVAL)
+
+
+async def process_successful_payment(purchase_id: int, tx_id: str) -> str:
+    """
+    Зачисляет оплату (доступ, продление, партнёрка) одной транзакцией.
+    Уведомления не ждём: событие purchase_paid записано в outbox вместе с оплатой,
+    подписчики отработают в фоне.
+    Возвращает "paid", "already_paid" (покупка уже не pending) или "tx_used".
+    """
+    try:
+        settlement = await settle_purchase_async(purchase_id, tx_id)
+    except sqlite3.IntegrityError:
+        logger.warning("Tx %s is already used by another purchase (purchase %s)", tx_id, purchase_id)
+        return "tx_used"
+    if not settlement:
+        return "already_paid"
+
+    event_bus.wake()
+    return "paid"
+
+
+# ---------------------------------------------------------------------------
+# СОБЫТИЯ (ПОДПИСЧИКИ EVENT BUS)
+# ---------------------------------------------------------------------------
+
+# Каждый подписчик может быть вызван повторно (доставка «хотя бы один раз»),
+# падение подписчика — повтор с паузой, см. events.py.
+
+
+async def _notify(tg_id: Optional[int], text: str):
+    if not tg_id:
+        return
+    try:
+        await bot.send_message(tg_id, text)
+    except (BotBlocked, ChatNotFound, UserDeactivated) as e:
+        # повторять бессмысленно — считаем доставленным
+        logger.info("Notification to %s skipped: %s", tg_id, e)
+
+
+@event_bus.subscribe("purchase_paid", "notify_buyer")
+async def on_purchase_paid_notify_buyer(event: dict):
+    if event["product_code"] == "package":
+        await _notify(
+            event["buyer_tg_id"],
+            "✅ <b>Оплата подтверждена!</b>\n\n"
+            "Полный доступ к обучению, партнёрке и сигналам (на 1 месяц) открыт.\n"
+            f"Сигналы приходят в канале: {SIGNALS_CHANNEL_LINK}",
+        )
+    elif event["product_code"] == "renewal":
+        await _notify(
+            event["buyer_tg_id"],
+            "✅ <b>Продление сигналов оплачено!</b>\n\n"
+            "Подписка на сигнальный канал продлена ещё на 30 дней.",
+        )
+
+
+@event_bus.subscribe("purchase_paid", "notify_lvl1")
+async def on_purchase_paid_notify_lvl1(event: dict):
+    await _notify(
+        event["lvl1_tg_id"],
+        f"💰 <b>Начислено {event['lvl1_bonus']}$</b> за личную рекомендацию.\n"
+        f"Твой партнёр совершил покупку полного доступа.",
+    )
+
+
+@event_bus.subscribe("purchase_paid", "notify_lvl2")
+async def on_purchase_paid_notify_lvl2(event: dict):
+    await _notify(
+        event["lvl2_tg_id"],
+        f"💸 <b>Начислено {event['lvl2_bonus']}$</b> со второго уровня.\n"
+        f"Партнёр второй линии купил полный доступ.",
+    )
+
+
+@event_bus.subscribe("user_registered", "leaderboard")
+async def on_user_registered_leaderboard(event: dict):
+    referrer_id = event["referrer_id"]
+    # регистрация уже учтена, если топ загружался из БД после неё (перезапуск, сверка)
+    if not referrer_id or event["user_db_id"] <= leaderboard_last_user_id:
+        return
+    leaderboard.set_name(referrer_id, event["referrer_username"], event["referrer_first_name"])
+    leaderboard.record_referral(referrer_id, datetime.strptime(event["reg_date"], "%Y-%m-%d %H:%M:%S"))
 
 
 # ---------------------------------------------------------------------------
@@ -875,22 +1924,21 @@ async def cmd_start(message: types.Message):
 
     # Парсим реферальный код: /start ref_123456789
     args = message.get_args()
-    referrer_db_id = None
-    if args and args.startswith("ref_"):
+    referrer_row = None
+    # реферера ищем только для новых пользователей — старым он уже не нужен
+    known = await get_user_by_tg_async(message.from_user.id)
+    if not known and args and args.startswith("ref_"):
         try:
             ref_tg_id = int(args.split("_", 1)[1])
             if ref_tg_id != message.from_user.id:
-                conn = db_connect()
-                cur = conn.cursor()
-                cur.execute("SELECT id FROM users WHERE user_id = ?", (ref_tg_id,))
-                row = cur.fetchone()
-                conn.close()
-                if row:
-                    referrer_db_id = row[0]
+                referrer_row = await get_user_by_tg_async(ref_tg_id)
         except Exception:
             pass
+    referrer_db_id = referrer_row[0] if referrer_row else None
 
-    user_db_id = get_or_create_user(message, referrer_db_id)
+    user_db_id, created = await register_user_async(message, referrer_db_id)
+    if created:
+        event_bus.wake()
 
     text = (
         "👋 Привет! Здесь команда, которая уже много лет живёт рынком и онлайном 📈💻\n\n"
@@ -1043,12 +2091,15 @@ def _get_user_db_id(tg_id: int) -> int | None:
     return row[0] if row else None
 
 
+_get_user_db_id_async = db.reader(_get_user_db_id)
+
+
 @dp.callback_query_handler(lambda c: c.data == "edu_crypto")
 async def cb_edu_crypto(call: CallbackQuery):
-    user_row = get_user_by_tg(call.from_user.id)
+    user_row = await get_user_by_tg_async(call.from_user.id)
     if not user_row:
-        get_or_create_user(call.message)
-        user_row = get_user_by_tg(call.from_user.id)
+        await get_or_create_user_async(call.message)
+        user_row = await get_user_by_tg_async(call.from_user.id)
     user_db_id = user_row[0]
     full = bool(user_row[7])
 
@@ -1079,10 +2130,10 @@ async def cb_edu_crypto(call: CallbackQuery):
 
 @dp.callback_query_handler(lambda c: c.data == "edu_traffic")
 async def cb_edu_traffic(call: CallbackQuery):
-    user_row = get_user_by_tg(call.from_user.id)
+    user_row = await get_user_by_tg_async(call.from_user.id)
     if not user_row:
-        get_or_create_user(call.message)
-        user_row = get_user_by_tg(call.from_user.id)
+        await get_or_create_user_async(call.message)
+        user_row = await get_user_by_tg_async(call.from_user.id)
     user_db_id = user_row[0]
     full = bool(user_row[7])
 
@@ -1117,13 +2168,13 @@ async def cb_crypto_mod(call: CallbackQuery):
         await call.answer("Модуль не найден", show_alert=True)
         return
 
-    user_row = get_user_by_tg(call.from_user.id)
+    user_row = await get_user_by_tg_async(call.from_user.id)
     if not user_row or not user_row[7]:
         await call.answer("Курс доступен только после покупки полного доступа.", show_alert=True)
         return
 
     user_db_id = user_row[0]
-    save_progress(user_db_id, "crypto", idx)
+    await save_progress_async(user_db_id, "crypto", idx)
 
     title, text_body = COURSE_CRYPTO[idx]
     text = f"{text_body}\n\nПрогресс: модуль {idx+1} из {len(COURSE_CRYPTO)}."
@@ -1142,13 +2193,13 @@ async def cb_traffic_mod(call: CallbackQuery):
         await call.answer("Модуль не найден", show_alert=True)
         return
 
-    user_row = get_user_by_tg(call.from_user.id)
+    user_row = await get_user_by_tg_async(call.from_user.id)
     if not user_row or not user_row[7]:
         await call.answer("Курс доступен только после покупки полного доступа.", show_alert=True)
         return
 
     user_db_id = user_row[0]
-    save_progress(user_db_id, "traffic", idx)
+    await save_progress_async(user_db_id, "traffic", idx)
 
     title, text_body = COURSE_TRAFFIC[idx]
     text = f"{text_body}\n\nПрогресс: модуль {idx+1} из {len(COURSE_TRAFFIC)}."
@@ -1213,13 +2264,14 @@ async def cb_earn_more(call: CallbackQuery):
 
 @dp.callback_query_handler(lambda c: c.data == "earn_stats")
 async def cb_earn_stats(call: CallbackQuery):
-    user_row = get_user_by_tg(call.from_user.id)
-    if not user_row:
+    profile = await get_profile_async(call.from_user.id)
+    if not profile:
         await call.answer("Сначала запусти бота через /start.", show_alert=True)
         return
 
-    user_db_id, _, username, first_name, _, balance, total_earned, full_access = user_row
-    lvl1, lvl2 = count_referrals(user_db_id)
+    username, first_name = profile.username, profile.first_name
+    balance, total_earned, full_access = profile.balance, profile.total_earned, profile.full_access
+    lvl1, lvl2 = profile.lvl1, profile.lvl2
     total_refs = lvl1 + lvl2
 
     text = (
@@ -1246,35 +2298,36 @@ async def cb_earn_stats(call: CallbackQuery):
     await call.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data == "earn_top")
+LEADERBOARD_TITLES = {
+    "all": "🏆 <b>Топ партнёров по количеству приглашённых</b>\n",
+    "week": "🏆 <b>Топ партнёров за 7 дней</b>\n",
+    "month": "🏆 <b>Топ партнёров за 30 дней</b>\n",
+}
+
+
+@dp.callback_query_handler(lambda c: c.data == "earn_top" or c.data.startswith("earn_top:"))
 async def cb_earn_top(call: CallbackQuery):
-    # Топ по количеству рефералов 1 уровня
-    conn = db_connect()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        SELECT u.username, u.first_name, COUNT(r.id) as cnt
-        FROM users u
-        LEFT JOIN users r ON r.referrer_id = u.id
-        GROUP BY u.id
-        HAVING cnt > 0
-        ORDER BY cnt DESC
-        LIMIT 10
-        """
-    )
-    rows = cur.fetchall()
-    conn.close()
+    # Топ по количеству рефералов 1 уровня — из памяти, без запросов к БД
+    period = call.data.split(":", 1)[1] if ":" in call.data else "all"
+    if period not in LEADERBOARD_TITLES:
+        period = "all"
+    rows = leaderboard.top(period)
 
     if not rows:
         text = "🏆 Пока ещё нет партнёров в топе. Стань первым!"
     else:
-        lines = ["🏆 <b>Топ партнёров по количеству приглашённых</b>\n"]
+        lines = [LEADERBOARD_TITLES[period]]
         for i, (username, first_name, cnt) in enumerate(rows, start=1):
             name = f"@{username}" if username else first_name or "Без имени"
             lines.append(f"{i}. {name} — {cnt} приглашённых")
         text = "\n".join(lines)
 
     kb = InlineKeyboardMarkup()
+    kb.row(
+        InlineKeyboardButton("За всё время", callback_data="earn_top:all"),
+        InlineKeyboardButton("7 дней", callback_data="earn_top:week"),
+        InlineKeyboardButton("30 дней", callback_data="earn_top:month"),
+    )
     kb.add(InlineKeyboardButton("📊 Моя статистика", callback_data="earn_stats"))
     kb.add(InlineKeyboardButton("⬅️ Назад к разделу «Заработок»", callback_data="home_earn"))
 
@@ -1287,7 +2340,7 @@ async def cb_earn_top(call: CallbackQuery):
 
 @dp.callback_query_handler(lambda c: c.data == "my_ref")
 async def cb_my_ref(call: CallbackQuery):
-    user_row = get_user_by_tg(call.from_user.id)
+    user_row = await get_user_by_tg_async(call.from_user.id)
     if not user_row:
         await call.answer("Сначала запусти бота через /start.", show_alert=True)
         return
@@ -1329,13 +2382,13 @@ async def cb_my_ref(call: CallbackQuery):
  
 @dp.callback_query_handler(lambda c: c.data == "signals_channel")
 async def cb_signals_channel(call: CallbackQuery):
-    user_row = get_user_by_tg(call.from_user.id)
-    if not user_row:
+    profile = await get_profile_async(call.from_user.id)
+    if not profile:
         await call.answer("Сначала запусти бота через /start.", show_alert=True)
         return
 
-    user_db_id, user_tg_id, username, first_name, _, _, _, full_access = user_row
-    signals_until = get_signals_until(user_db_id)
+    full_access = profile.full_access
+    signals_until = profile.signals_until
 
     # 1) Полного доступа ещё нет → предлагаем купить пакет за $100
     if not full_access:
@@ -1400,18 +2453,19 @@ async def cb_signals_channel(call: CallbackQuery):
 
 
 async def send_profile(message: types.Message, edit: bool = False):
-    user_row = get_user_by_tg(message.from_user.id)
-    if not user_row:
-        get_or_create_user(message)
-        user_row = get_user_by_tg(message.from_user.id)
+    profile = await get_profile_async(message.from_user.id)
+    if not profile:
+        await get_or_create_user_async(message)
+        profile = await get_profile_async(message.from_user.id)
 
-    user_db_id, user_tg_id, username, first_name, _, balance, total_earned, full_access = user_row
-    lvl1, lvl2 = count_referrals(user_db_id)
-    signals_until = get_signals_until(user_db_id)
+    user_tg_id, username = profile.user_id, profile.username
+    balance, total_earned, full_access = profile.balance, profile.total_earned, profile.full_access
+    lvl1, lvl2 = profile.lvl1, profile.lvl2
+    signals_until = profile.signals_until
 
     # Прогресс обучения
-    crypto_idx = get_progress(user_db_id, "crypto")
-    traffic_idx = get_progress(user_db_id, "traffic")
+    crypto_idx = profile.crypto_progress
+    traffic_idx = profile.traffic_progress
     crypto_done = max(0, crypto_idx + 1) if crypto_idx >= 0 else 0
     traffic_done = max(0, traffic_idx + 1) if traffic_idx >= 0 else 0
 
@@ -1502,18 +2556,25 @@ async def cb_support(call: CallbackQuery):
 
 # ---------------------- ОПЛАТА ПОЛНОГО ДОСТУПА -----------------------
 
+TAILS_EXHAUSTED_TEXT = "Сейчас слишком много открытых заявок на оплату. Попробуй ещё раз через пару минут."
+
 
 @dp.callback_query_handler(lambda c: c.data == "open_access")
 async def cb_open_access(call: CallbackQuery):
-    user_row = get_user_by_tg(call.from_user.id)
+    user_row = await get_user_by_tg_async(call.from_user.id)
     if not user_row:
-        get_or_create_user(call.message)
-        user_row = get_user_by_tg(call.from_user.id)
+        await get_or_create_user_async(call.message)
+        user_row = await get_user_by_tg_async(call.from_user.id)
     user_db_id = user_row[0]
 
-    purchase_id = create_purchase(user_db_id, "package", PRICE_PACKAGE)
-    purchase_row = get_purchase(purchase_id)
-    amount = Decimal(str(purchase_row[3]))
+    try:
+        purchase_id = await create_purchase_async(user_db_id, "package", PRICE_PACKAGE)
+    except TailsExhausted:
+        await call.answer(TAILS_EXHAUSTED_TEXT, show_alert=True)
+        return
+    purchase_row = await get_purchase_async(purchase_id)
+    amount = units_to_usdt(purchase_row[7])
+    expires_at = purchase_expires_at(purchase_row[5])
 
     text = (
         "💳 <b>Открытие полного доступа за $100</b>\n\n"
@@ -1523,9 +2584,10 @@ async def cb_open_access(call: CallbackQuery):
         "• доступ к сигналам на 1 месяц\n"
         "• доступ к партнёрской программе 50% + 10%\n\n"
         f"Оплата принимается в USDT (TRC20) на кошелёк:\n"
-        f"<code>{WALLET_ADDRESS}</code>\n\n"
+        f"<code>{purchase_row[8]}</code>\n\n"
         f"Сумма к оплате: <b>{amount} USDT</b>\n"
-        "Важно: переводи <b>точно эту сумму</b> с учётом хвостика — по ней бот будет искать платёж.\n\n"
+        "Важно: переводи <b>точно эту сумму</b> с учётом хвостика — по ней бот будет искать платёж.\n"
+        f"Заявка действует до <b>{expires_at:%d.%m %H:%M} UTC</b>.\n\n"
         "После перевода нажми кнопку «Проверить оплату» ниже.\n"
         "Если оплата не подтянулась — не переживай, транзакции иногда доходят с задержкой, "
         "а также всегда есть ручная проверка через поддержку."
@@ -1542,7 +2604,7 @@ async def cb_open_access(call: CallbackQuery):
 
 @dp.callback_query_handler(lambda c: c.data == "renew_signals")
 async def cb_renew_signals(call: CallbackQuery):
-    user_row = get_user_by_tg(call.from_user.id)
+    user_row = await get_user_by_tg_async(call.from_user.id)
     if not user_row:
         await call.answer("Сначала запусти бота через /start.", show_alert=True)
         return
@@ -1553,15 +2615,21 @@ async def cb_renew_signals(call: CallbackQuery):
         await call.answer("Продление сигналов доступно только после покупки полного доступа.", show_alert=True)
         return
 
-    purchase_id = create_purchase(user_db_id, "renewal", PRICE_RENEWAL)
-    purchase_row = get_purchase(purchase_id)
-    amount = Decimal(str(purchase_row[3]))
+    try:
+        purchase_id = await create_purchase_async(user_db_id, "renewal", PRICE_RENEWAL)
+    except TailsExhausted:
+        await call.answer(TAILS_EXHAUSTED_TEXT, show_alert=True)
+        return
+    purchase_row = await get_purchase_async(purchase_id)
+    amount = units_to_usdt(purchase_row[7])
+    expires_at = purchase_expires_at(purchase_row[5])
 
     text = (
         "📈 <b>Продление сигналов на 1 месяц</b>\n\n"
         "Стоимость продления: <b>$50</b>.\n\n"
         f"Отправь <b>{amount} USDT</b> (TRC20) на кошелёк:\n"
-        f"<code>{WALLET_ADDRESS}</code>\n\n"
+        f"<code>{purchase_row[8]}</code>\n\n"
+        f"Заявка действует до <b>{expires_at:%d.%m %H:%M} UTC</b>.\n\n"
         "После перевода нажми «Проверить оплату». Реферальные начисления с продлений не идут — "
         "весь платёж идёт на поддержку проекта и развитие экосистемы."
     )
@@ -1584,34 +2652,33 @@ async def cb_check_pay(call: CallbackQuery):
         await call.answer("Некорректный ID покупки.", show_alert=True)
         return
 
-    purchase_row = get_purchase(purchase_id)
+    purchase_row = await get_purchase_async(purchase_id)
     if not purchase_row:
         await call.answer("Покупка не найдена. Напиши в поддержку.", show_alert=True)
         return
 
-    p_id, user_db_id, product_code, amount_f, status, created_at_str, tx_id = purchase_row
-    amount = Decimal(str(amount_f))
-    created_at = datetime.strptime(created_at_str, "%Y-%m-%d %H:%M:%S")
-
-    if status == "paid":
+    if purchase_row[4] == "paid":
         await call.answer("Эта покупка уже подтверждена ✅", show_alert=True)
         return
 
-    await call.answer("Ищу оплату в сети Tron, это может занять несколько секунд...")
-
-    tx_hash = await find_payment_for_purchase(amount, created_at)
-    if not tx_hash:
-        await call.message.answer(
-            "❌ Пока не вижу подходящий платёж.\n\n"
-            "Убедись, что отправил <b>точно</b> указанную сумму на правильный адрес и подожди 1–3 минуты.\n"
-            "Если вопрос не решится — напиши в поддержку, указав время и хэш транзакции.",
-            reply_markup=main_reply_kb(),
+    if purchase_row[4] == "expired":
+        await call.answer(
+            "Срок этой заявки истёк. Создай новую через меню оплаты. "
+            "Если ты уже отправил перевод — напиши в поддержку, указав хэш транзакции.",
+            show_alert=True,
         )
         return
 
-    # фиксируем оплату
-    mark_purchase_paid(purchase_id, tx_hash)
-    await process_successful_payment(get_purchase(purchase_id))
+    # сеть проверяет payments_watcher, здесь только читаем состояние заявки
+    await call.answer()
+    await call.message.answer(
+        "⏳ Пока не вижу подходящий платёж.\n\n"
+        f"Бот сам проверяет сеть Tron каждые {PAYMENTS_POLL_SECONDS} секунд и пришлёт сообщение, "
+        "как только увидит перевод — нажимать кнопку повторно не нужно.\n\n"
+        "Убедись, что отправил <b>точно</b> указанную сумму на правильный адрес и подожди 1–3 минуты.\n"
+        "Если вопрос не решится — напиши в поддержку, указав время и хэш транзакции.",
+        reply_markup=main_reply_kb(),
+    )
 
 
 # ---------------------------------------------------------------------------
@@ -1632,9 +2699,144 @@ async def cmd_admin(message: types.Message):
         "Доступные команды:\n"
         "/grant &lt;id или @username&gt; — выдать полный доступ + сигналы на 1 месяц\n"
         "/extend_signals &lt;id или @username&gt; — продлить сигналы на 1 месяц\n"
-        "/user &lt;id или @username&gt; — инфо по пользователю"
+        "/user &lt;id или @username&gt; — инфо по пользователю\n"
+        "/recount_refs — пересчитать счётчики рефералов и показать расхождения\n"
+        "/cache_stats — статистика кэшей (пользователи, TronGrid, CoinGecko)\n"
+        "/tails — занятость хвостов сумм по продуктам\n"
+        "/api_status — квоты, повторы и circuit breaker внешних API\n"
+        "/events — очередь доставки событий (outbox)\n"
+        "/tx &lt;хэш&gt; — перевод из локального журнала и по какой заявке он зачтён"
     )
     await message.answer(text)
+
+
+@dp.message_handler(commands=["tx"])
+async def cmd_tx_info(message: types.Message):
+    if not is_admin(message.from_user.id):
+        return
+    parts = message.text.split(maxsplit=1)
+    if len(parts) < 2:
+        await message.answer("Использование: <code>/tx хэш_транзакции</code>")
+        return
+
+    info = await get_transfer_info_async(parts[1].strip())
+    if not info:
+        await message.answer("Перевода нет в локальном журнале.")
+        return
+
+    tx_id, from_addr, to_addr, value, decimals, ts_ms, purchase_id, status, buyer_tg_id = info
+    amount = Decimal(value) / (Decimal(10) ** decimals)
+    tx_time = datetime.utcfromtimestamp(ts_ms / 1000.0).strftime("%Y-%m-%d %H:%M:%S")
+    purchase_text = (
+        f"заявка #{purchase_id} ({status}), TG ID покупателя <code>{buyer_tg_id}</code>"
+        if purchase_id
+        else "не зачтён ни в одной заявке"
+    )
+    await message.answer(
+        "🔎 <b>Перевод</b>\n\n"
+        f"Хэш: <code>{tx_id}</code>\n"
+        f"От: <code>{from_addr}</code>\n"
+        f"Кому: <code>{to_addr}</code>\n"
+        f"Сумма: <b>{amount} USDT</b>\n"
+        f"Время (UTC): {tx_time}\n"
+        f"Статус: {purchase_text}"
+    )
+
+
+@dp.message_handler(commands=["tails"])
+async def cmd_tails(message: types.Message):
+    if not is_admin(message.from_user.id):
+        return
+
+    lines = ["🔢 <b>Хвосты сумм ожидающих заявок</b>", ""]
+    for (wallet, product_code), (held, size) in sorted(tails.stats().items()):
+        lines.append(f"• {product_code} → <code>{wallet}</code>: {held} / {size} ({held / size * 100:.1f}%)")
+    if len(lines) == 2:
+        lines.append("Заявок ещё не было с момента запуска.")
+    await message.answer("\n".join(lines))
+
+
+@dp.message_handler(commands=["events"])
+async def cmd_events(message: types.Message):
+    if not is_admin(message.from_user.id):
+        return
+
+    counts = await db.read(event_bus.counts)
+    await message.answer(
+        "📬 <b>События (outbox)</b>\n\n"
+        f"Ждут доставки: {counts.get('pending', 0)}\n"
+        f"Не доставлены (dead): {counts.get('dead', 0)}\n\n"
+        f"С момента запуска доставлено: {event_bus.delivered}\n"
+        f"Неудачных попыток: {event_bus.failures}"
+    )
+
+
+@dp.message_handler(commands=["api_status"])
+async def cmd_api_status(message: types.Message):
+    if not is_admin(message.from_user.id):
+        return
+
+    lines = ["🌐 <b>Внешние API</b>"]
+    for api in (trongrid_api, coingecko_api, binance_api):
+        st = api.stats()
+        lines.append("")
+        lines.append(f"<b>{api.name}</b>: {st['state']}, токенов {st['tokens']:.1f} / {api.burst}, в очереди {st['queued']}")
+        if st["paused_for"]:
+            lines.append(f"Пауза по Retry-After: ещё {st['paused_for']:.0f} с")
+        lines.append(
+            f"Вызовов: {st['calls']}, повторов: {st['retried']}, 429: {st['throttled']}, "
+            f"сбоев: {st['failed']}, отклонено: {st['rejected']}, размыканий: {st['trips']}"
+        )
+    await message.answer("\n".join(lines))
+
+
+@dp.message_handler(commands=["cache_stats"])
+async def cmd_cache_stats(message: types.Message):
+    if not is_admin(message.from_user.id):
+        return
+
+    stats = user_cache.stats()
+    tron = trongrid_requests.stats()
+    market = market_cache.stats()
+    gecko = coingecko_requests.stats()
+    await message.answer(
+        "🗂 <b>Кэш пользователей</b>\n\n"
+        f"Записей: {stats['size']} / {stats['maxsize']}\n"
+        f"Попаданий: {stats['hits']}\n"
+        f"Промахов: {stats['misses']}\n"
+        f"Вытеснено: {stats['evictions']}\n"
+        f"Hit rate: {stats['hit_rate'] * 100:.1f}%\n\n"
+        "🌐 <b>Запросы к TronGrid</b>\n\n"
+        f"Всего вызовов: {tron['calls']}\n"
+        f"Реально ушло в API: {tron['upstream']}\n"
+        f"Склеено с запросом в полёте: {tron['coalesced']}\n"
+        f"Отдано из кэша: {tron['cache_hits']}\n\n"
+        "📈 <b>Рыночные данные CoinGecko</b>\n\n"
+        f"Отдано без запроса (свежие): {market['fresh_hits']}\n"
+        f"Докачек дельты: {market['delta_fetches']}\n"
+        f"Полных загрузок: {market['full_fetches']}\n"
+        f"Дописано закрытий: {market['appended']}\n"
+        f"Склеено с обновлением в полёте: {gecko['coalesced']}"
+    )
+
+
+@dp.message_handler(commands=["recount_refs"])
+async def cmd_recount_refs(message: types.Message):
+    if not is_admin(message.from_user.id):
+        return
+
+    drift = await rebuild_referral_counters_async()
+    await refresh_leaderboard()
+    if not drift:
+        await message.answer("✅ Счётчики рефералов сходятся, расхождений нет.")
+        return
+
+    lines = [f"🛠 Исправлено расхождений: <b>{len(drift)}</b>\n"]
+    for user_db_id, old_l1, old_l2, new_l1, new_l2 in drift[:20]:
+        lines.append(f"ID {user_db_id}: 1л {old_l1} → {new_l1}, 2л {old_l2} → {new_l2}")
+    if len(drift) > 20:
+        lines.append(f"… и ещё {len(drift) - 20}")
+    await message.answer("\n".join(lines))
     
 @dp.message_handler(commands=["test_signal"])
 async def cmd_test_signal(message: types.Message):
@@ -1647,10 +2849,11 @@ async def cmd_test_signal(message: types.Message):
     text = await build_auto_signal_text(
         AUTO_SIGNALS_SYMBOLS,
         True,  # включено принудительно
+        priority=PRIORITY_USER,
     )
 
     if not text:
-        await message.answer("❌ Не удалось сгенерировать авто-сигнал (нет данных от Binance или ошибка).")
+        await message.answer("❌ Не удалось сгенерировать авто-сигнал (ни одна пара не прошла фильтры или нет данных).")
         return
 
     try:
@@ -1659,6 +2862,9 @@ async def cmd_test_signal(message: types.Message):
     except Exception as e:
         await message.answer(f"❌ Ошибка при отправке в канал.\nПроверь права бота и ID канала.")
         
+binance_api = ApiGovernor("binance", BINANCE_RATE, BINANCE_BURST)
+
+
 @dp.message_handler(commands=["check_binance"])
 async def cmd_check_binance(message: types.Message):
     # Только админ
@@ -1670,11 +2876,15 @@ async def cmd_check_binance(message: types.Message):
     url = "https://api.binance.com/api/v3/ticker/24hr"
     params = {"symbol": "BTCUSDT"}
 
+    async def request():
+        async with http_client.session().get(
+            url, params=params, timeout=http_client.timeout(BINANCE_TIMEOUT)
+        ) as resp:
+            check_response(resp)
+            return resp.status, await resp.text()
+
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, params=params, timeout=10) as resp:
-                status = resp.status
-                text = await resp.text()
+        status, text = await binance_api.call(request, priority=PRIORITY_USER)
     except Exception as e:
         await message.answer(f"❌ Ошибка при запросе к Binance:\n<code>{e}</code>")
         return
@@ -1690,22 +2900,17 @@ async def cmd_check_binance(message: types.Message):
 
 
 def _find_user_by_any(identifier: str):
-    conn = db_connect()
-    cur = conn.cursor()
-    row = None
     if identifier.startswith("@"):
         username = identifier[1:]
-        cur.execute("SELECT id, user_id, username, first_name FROM users WHERE username = ?", (username,))
-        row = cur.fetchone()
-    else:
-        try:
-            tg_id = int(identifier)
-            cur.execute("SELECT id, user_id, username, first_name FROM users WHERE user_id = ?", (tg_id,))
-            row = cur.fetchone()
-        except ValueError:
-            row = None
-    conn.close()
-    return row
+        return db.fetchone("SELECT id, user_id, username, first_name FROM users WHERE username = ?", (username,))
+    try:
+        tg_id = int(identifier)
+    except ValueError:
+        return None
+    return db.fetchone("SELECT id, user_id, username, first_name FROM users WHERE user_id = ?", (tg_id,))
+
+
+_find_user_by_any_async = db.reader(_find_user_by_any)
 
 
 @dp.message_handler(commands=["grant"])
@@ -1718,14 +2923,14 @@ async def cmd_grant(message: types.Message):
         return
 
     ident = parts[1].strip()
-    row = _find_user_by_any(ident)
+    row = await _find_user_by_any_async(ident)
     if not row:
         await message.answer("Пользователь не найден в базе.")
         return
 
     user_db_id, tg_id, username, first_name = row
-    set_full_access(user_db_id, True)
-    extend_signals(user_db_id, days=30)
+    await set_full_access_async(user_db_id, True)
+    await extend_signals_async(user_db_id, days=30)
 
     await message.answer(f"✅ Полный доступ выдан пользователю @{username if username else tg_id} + сигналы на 30 дней.")
     try:
@@ -1750,13 +2955,13 @@ async def cmd_extend_signals(message: types.Message):
         return
 
     ident = parts[1].strip()
-    row = _find_user_by_any(ident)
+    row = await _find_user_by_any_async(ident)
     if not row:
         await message.answer("Пользователь не найден в базе.")
         return
 
     user_db_id, tg_id, username, first_name = row
-    extend_signals(user_db_id, days=30)
+    await extend_signals_async(user_db_id, days=30)
     await message.answer(f"✅ Сигналы продлены пользователю @{username if username else tg_id} на 30 дней.")
     try:
         await bot.send_message(
@@ -1777,24 +2982,21 @@ async def cmd_user_info(message: types.Message):
         return
 
     ident = parts[1].strip()
-    row = _find_user_by_any(ident)
+    row = await _find_user_by_any_async(ident)
     if not row:
         await message.answer("Пользователь не найден в базе.")
         return
 
     user_db_id, tg_id, username, first_name = row
-    conn = db_connect()
-    cur = conn.cursor()
-    cur.execute(
-        "SELECT referrer_id, balance, total_earned, full_access FROM users WHERE id = ?",
-        (user_db_id,),
+    profile = await get_profile_by_db_id_async(user_db_id)
+    referrer_id, balance, total_earned, full_access = (
+        profile.referrer_id,
+        profile.balance,
+        profile.total_earned,
+        profile.full_access,
     )
-    row2 = cur.fetchone()
-    conn.close()
-    referrer_id, balance, total_earned, full_access = row2
-
-    lvl1, lvl2 = count_referrals(user_db_id)
-    signals_until = get_signals_until(user_db_id)
+    lvl1, lvl2 = profile.lvl1, profile.lvl2
+    signals_until = profile.signals_until
 
     text = (
         f"👤 <b>Пользователь</b>\n\n"
@@ -1827,9 +3029,8 @@ async def signals_watcher():
     while True:
         try:
             now = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
-            conn = db_connect()
-            cur = conn.cursor()
-            cur.execute(
+            rows = await db.read(
+                db.fetchall,
                 """
                 SELECT sa.user_id, u.user_id
                 FROM signals_access sa
@@ -1838,8 +3039,6 @@ async def signals_watcher():
                 """,
                 (now,),
             )
-            rows = cur.fetchall()
-            conn.close()
 
             for user_db_id, tg_id in rows:
                 try:
@@ -1877,7 +3076,14 @@ async def fallback(message: types.Message):
 
 
 async def on_startup(dp: Dispatcher):
+    await http_client.start()
     init_db()
+    load_pending_tails()
+    await refresh_leaderboard()
+    asyncio.create_task(leaderboard_refresher())
+    asyncio.create_task(payments_watcher())
+    asyncio.create_task(purchases_janitor())
+    asyncio.create_task(event_bus.run())
     asyncio.create_task(signals_watcher())
     asyncio.create_task(
         auto_signals_worker(
@@ -1891,7 +3097,12 @@ async def on_startup(dp: Dispatcher):
     logger.info("Bot started and DB initialized.")
 
 
+async def on_shutdown(dp: Dispatcher):
+    await http_client.close()
+    close_eval_pool()
+    db.close()
+
 
 if __name__ == "__main__":
     init_db()
-    executor.start_polling(dp, skip_updates=True, on_startup=on_startup)
+    executor.start_polling(dp, skip_updates=True, on_startup=on_startup, on_shutdown=on_shutdown)
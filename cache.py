@@ -0,0 +1,129 @@
+# cache.py
+
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple
+
+
+class LRUCache:
+    """
+    Ограниченный LRU-кэш с TTL, безопасный для вызова из потоков БД.
+
+    Чтобы не положить в кэш устаревшее значение, прочитанное параллельно с записью,
+    перед чтением из БД берём token(), а кладём через put(..., token=...):
+    если с тех пор была хоть одна инвалидация, значение просто не кэшируется.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        now = time.monotonic()
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[1] < now:
+                if item is not None:
+                    del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def token(self) -> int:
+        with self._lock:
+            return self._generation
+
+    def put(self, key: Hashable, value: Any, token: Optional[int] = None) -> None:
+        with self._lock:
+            if token is not None and token != self._generation:
+                return
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key: Hashable) -> None:
+        with self._lock:
+            self._generation += 1
+            self._data.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._generation += 1
+            self._data.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
+
+
+class SingleFlight:
+    """
+    Склейка одинаковых async-запросов: пока запрос с ключом key в полёте,
+    остальные вызовы ждут его же результат, а не идут в API повторно.
+    Успешный результат ещё ttl секунд отдаётся из памяти.
+
+    Работает в одном event loop, потокобезопасность не нужна.
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+        self._results: Dict[Hashable, Tuple[Any, float]] = {}
+        self.calls = 0
+        self.upstream = 0
+        self.coalesced = 0
+        self.cache_hits = 0
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        self.calls += 1
+        item = self._results.get(key)
+        if item is not None and item[1] > time.monotonic():
+            self.cache_hits += 1
+            return item[0]
+
+        task = self._inflight.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            self.upstream += 1
+            task = asyncio.ensure_future(fn())
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._done(key, t))
+        # shield: отмена одного ждущего не отменяет запрос для остальных
+        return await asyncio.shield(task)
+
+    def _done(self, key: Hashable, task: asyncio.Future) -> None:
+        self._inflight.pop(key, None)
+        now = time.monotonic()
+        for k in [k for k, (_, expires) in self._results.items() if expires <= now]:
+            del self._results[k]
+        if not task.cancelled() and task.exception() is None:
+            self._results[key] = (task.result(), now + self.ttl)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "calls": self.calls,
+            "upstream": self.upstream,
+            "coalesced": self.coalesced,
+            "cache_hits": self.cache_hits,
+        }
@@ -0,0 +1,204 @@
+# db.py
+
+import asyncio
+import functools
+import logging
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Iterator, List, Optional, Sequence, Tuple, TypeVar, Union
+
+logger = logging.getLogger(__name__)
+
+# --- НАСТРОЙКИ SQLITE ---
+
+# PRAGMA, которые выставляются на каждом новом соединении
+SQLITE_PRAGMAS = (
+    ("journal_mode", "WAL"),       # читатели не блокируют писателя и наоборот
+    ("synchronous", "NORMAL"),     # в WAL это безопасно и без fsync на каждый коммит
+    ("cache_size", -16000),        # ~16 МБ страничного кэша (отрицательное значение — в КиБ)
+    ("mmap_size", 128 * 1024 * 1024),
+    ("busy_timeout", 5000),        # ждём блокировку до 5 секунд, а не падаем сразу
+    ("temp_store", "MEMORY"),
+)
+
+# Сколько подготовленных выражений sqlite3 держит в кэше на соединение
+STATEMENT_CACHE_SIZE = 256
+
+# Сколько потоков-читателей обслуживают асинхронные запросы (писатель всегда один)
+READER_THREADS = 4
+
+T = TypeVar("T")
+
+# Шаг миграции: SQL-строка или функция, получающая курсор
+MigrationStep = Union[str, Callable[[sqlite3.Cursor], None]]
+# Миграция: (версия, описание, шаги)
+Migration = Tuple[int, str, Sequence[MigrationStep]]
+
+
+class Database:
+    """
+    Менеджер долгоживущих соединений с SQLite.
+
+    На каждый поток открывается одно соединение (sqlite3 не любит делить
+    соединение между потоками), оно живёт до close(). Подготовленные выражения
+    переиспользуются через встроенный кэш sqlite3 (cached_statements).
+
+    Для async-кода есть read()/write(): чтения уходят в небольшой пул потоков,
+    все записи — в один выделенный поток-писатель, так что fsync коммита
+    не останавливает event loop, а писатели не толкаются за блокировку.
+    """
+
+    def __init__(self, path: str, readers: int = READER_THREADS):
+        self.path = path
+        self.readers = readers
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections: List[sqlite3.Connection] = []
+        self._reader_pool: Optional[ThreadPoolExecutor] = None
+        self._writer_pool: Optional[ThreadPoolExecutor] = None
+
+    def _open(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self.path,
+            cached_statements=STATEMENT_CACHE_SIZE,
+            check_same_thread=False,  # закрываем все соединения из главного потока
+        )
+        for name, value in SQLITE_PRAGMAS:
+            conn.execute(f"PRAGMA {name} = {value}")
+        with self._lock:
+            self._connections.append(conn)
+        return conn
+
+    def conn(self) -> sqlite3.Connection:
+        """Соединение текущего потока (открывается при первом обращении)."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._open()
+            self._local.conn = conn
+        return conn
+
+    def fetchone(self, sql: str, params: Sequence[Any] = ()) -> Optional[tuple]:
+        return self.conn().execute(sql, params).fetchone()
+
+    def fetchall(self, sql: str, params: Sequence[Any] = ()) -> List[tuple]:
+        return self.conn().execute(sql, params).fetchall()
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Cursor]:
+        """
+        Пишущая транзакция: BEGIN IMMEDIATE сразу берёт блокировку на запись,
+        коммит при выходе из блока, откат при исключении.
+        """
+        conn = self.conn()
+        cur = conn.cursor()
+        cur.execute("BEGIN IMMEDIATE")
+        try:
+            yield cur
+        except BaseException:
+            conn.rollback()
+            raise
+        else:
+            conn.commit()
+        finally:
+            cur.close()
+
+    # --- миграции ---
+
+    def schema_version(self) -> int:
+        self.conn().execute(
+            """
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                description TEXT,
+                applied_at TEXT
+            )
+            """
+        )
+        row = self.fetchone("SELECT MAX(version) FROM schema_version")
+        return row[0] or 0
+
+    def migrate(self, migrations: Sequence[Migration]) -> int:
+        """
+        Применить все миграции с версией выше текущей, по порядку.
+        Каждая миграция — отдельная транзакция вместе с записью в schema_version,
+        так что упавшая миграция не оставляет базу в промежуточном состоянии.
+        Возвращает итоговую версию схемы.
+        """
+        current = self.schema_version()
+        for version, description, steps in sorted(migrations, key=lambda m: m[0]):
+            if version <= current:
+                continue
+            logger.info("Applying DB migration %s: %s", version, description)
+            with self.transaction() as cur:
+                for step in steps:
+                    if callable(step):
+                        step(cur)
+                    else:
+                        cur.execute(step)
+                cur.execute(
+                    "INSERT INTO schema_version (version, description, applied_at) VALUES (?, ?, ?)",
+                    (version, description, datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")),
+                )
+            current = version
+        return current
+
+    # --- async-доступ ---
+
+    def _pools(self):
+        with self._lock:
+            if self._writer_pool is None:
+                self._writer_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+                self._reader_pool = ThreadPoolExecutor(
+                    max_workers=self.readers, thread_name_prefix="db-reader"
+                )
+            return self._reader_pool, self._writer_pool
+
+    async def read(self, fn: Callable[..., T], *args, **kwargs) -> T:
+        """Выполнить читающую функцию в пуле читателей."""
+        reader_pool, _ = self._pools()
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(reader_pool, functools.partial(fn, *args, **kwargs))
+
+    async def write(self, fn: Callable[..., T], *args, **kwargs) -> T:
+        """Выполнить пишущую функцию в потоке-писателе."""
+        _, writer_pool = self._pools()
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(writer_pool, functools.partial(fn, *args, **kwargs))
+
+    def reader(self, fn: Callable[..., T]) -> Callable[..., Awaitable[T]]:
+        """Асинхронная обёртка над синхронным читающим хелпером."""
+
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            return await self.read(fn, *args, **kwargs)
+
+        return wrapper
+
+    def writer(self, fn: Callable[..., T]) -> Callable[..., Awaitable[T]]:
+        """Асинхронная обёртка над синхронным пишущим хелпером."""
+
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            return await self.write(fn, *args, **kwargs)
+
+        return wrapper
+
+    def close(self) -> None:
+        """Остановить потоки БД и закрыть все соединения (вызывается при остановке бота)."""
+        with self._lock:
+            pools = (self._reader_pool, self._writer_pool)
+            self._reader_pool = self._writer_pool = None
+        for pool in pools:
+            if pool is not None:
+                pool.shutdown(wait=True)
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            try:
+                conn.close()
+            except Exception as e:
+                logger.error("Error closing sqlite connection: %s", e)
+        self._local = threading.local()
@@ -0,0 +1,179 @@
+# events.py
+
+import asyncio
+import json
+import logging
+import random
+import sqlite3
+import time
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from db import Database
+
+logger = logging.getLogger(__name__)
+
+# --- НАСТРОЙКИ ДОСТАВКИ СОБЫТИЙ ---
+
+EVENT_MAX_ATTEMPTS = 8         # после стольких неудач событие помечается dead
+EVENT_RETRY_BASE = 2.0         # первая пауза перед повтором, секунды (дальше x2)
+EVENT_RETRY_MAX = 600.0        # потолок паузы перед повтором
+EVENT_BATCH_SIZE = 100         # сколько доставок забирать за один проход
+EVENT_CONCURRENCY = 10         # сколько подписчиков выполняются одновременно
+EVENT_HANDLER_TIMEOUT = 30.0   # таймаут одного подписчика
+EVENT_POLL_SECONDS = 5.0       # как часто проверять outbox без явного wake()
+
+# Таблица outbox создаётся миграцией в bot.py:
+# event_outbox (id, event, subscriber, payload, status, attempts, next_attempt_at, last_error, created_at)
+
+Handler = Callable[[Dict[str, Any]], Awaitable[None]]
+
+
+class EventBus:
+    """
+    Внутренняя шина событий с доставкой «хотя бы один раз» через таблицу outbox.
+
+    • publish(cur, event, payload) — внутри той же транзакции, что и само изменение:
+      на каждого подписчика события пишется строка в event_outbox. Откат транзакции —
+      нет и событий; коммит — событие гарантированно будет доставлено.
+    • run() — фоновая задача: забирает созревшие строки, запускает подписчиков
+      параллельно, удачные доставки удаляет, неудачные откладывает с экспоненциальной
+      паузой, после EVENT_MAX_ATTEMPTS помечает dead.
+    • wake() — разбудить доставку сразу после коммита, не дожидаясь EVENT_POLL_SECONDS.
+
+    Подписчик может быть вызван повторно (упал после побочного эффекта, перезапуск),
+    поэтому подписчики должны спокойно переносить повторы.
+    """
+
+    def __init__(self, db: Database):
+        self.db = db
+        self._subscribers: Dict[str, Dict[str, Handler]] = {}
+        self._wakeup: Optional[asyncio.Event] = None
+        self.delivered = 0
+        self.failures = 0
+        self.dead = 0
+
+    def subscribe(self, event: str, name: str) -> Callable[[Handler], Handler]:
+        """
+        Декоратор подписчика. name — стабильное имя, по нему строки outbox
+        находят свой обработчик после перезапуска.
+        """
+
+        def decorator(handler: Handler) -> Handler:
+            self._subscribers.setdefault(event, {})[name] = handler
+            return handler
+
+        return decorator
+
+    def publish(self, cur: sqlite3.Cursor, event: str, payload: Dict[str, Any]) -> int:
+        """Записать событие в outbox в текущей транзакции. Возвращает число доставок."""
+        subscribers = self._subscribers.get(event, {})
+        if not subscribers:
+            return 0
+        body = json.dumps(payload, default=str, ensure_ascii=False)
+        now = time.time()
+        created_at = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+        cur.executemany(
+            """
+            INSERT INTO event_outbox (event, subscriber, payload, status, attempts, next_attempt_at, created_at)
+            VALUES (?, ?, ?, 'pending', 0, ?, ?)
+            """,
+            [(event, name, body, now, created_at) for name in subscribers],
+        )
+        return len(subscribers)
+
+    def wake(self) -> None:
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    # --- доставка ---
+
+    def _fetch_due(self, now: float) -> List[tuple]:
+        return self.db.fetchall(
+            """
+            SELECT id, event, subscriber, payload, attempts FROM event_outbox
+            WHERE status = 'pending' AND next_attempt_at <= ?
+            ORDER BY next_attempt_at LIMIT ?
+            """,
+            (now, EVENT_BATCH_SIZE),
+        )
+
+    def _record(self, done: List[int], failed: List[tuple]) -> None:
+        """done: id доставленных; failed: (id, attempts, next_attempt_at | None для dead, ошибка)."""
+        with self.db.transaction() as cur:
+            cur.executemany("DELETE FROM event_outbox WHERE id = ?", [(i,) for i in done])
+            cur.executemany(
+                """
+                UPDATE event_outbox
+                SET attempts = ?, next_attempt_at = COALESCE(?, next_attempt_at), last_error = ?,
+                    status = CASE WHEN ? IS NULL THEN 'dead' ELSE 'pending' END
+                WHERE id = ?
+                """,
+                [(attempts, next_at, error, next_at, i) for i, attempts, next_at, error in failed],
+            )
+
+    async def _deliver(self, row: tuple, limiter: asyncio.Semaphore) -> Optional[str]:
+        """Вызвать подписчика. Возвращает текст ошибки или None при успехе."""
+        _, event, subscriber, payload, _ = row
+        handler = self._subscribers.get(event, {}).get(subscriber)
+        if handler is None:
+            return f"no subscriber {subscriber} for {event}"
+        async with limiter:
+            try:
+                await asyncio.wait_for(handler(json.loads(payload)), EVENT_HANDLER_TIMEOUT)
+            except Exception as e:
+                logger.warning("Event %s -> %s failed: %r", event, subscriber, e)
+                return repr(e)[:500]
+        return None
+
+    async def deliver_due(self) -> int:
+        """Один проход доставки. Возвращает, сколько доставок обработано."""
+        now = time.time()
+        rows = await self.db.read(self._fetch_due, now)
+        if not rows:
+            return 0
+
+        limiter = asyncio.Semaphore(EVENT_CONCURRENCY)
+        errors = await asyncio.gather(*(self._deliver(row, limiter) for row in rows))
+
+        done, failed = [], []
+        for row, error in zip(rows, errors):
+            row_id, event, subscriber, _, attempts = row
+            if error is None:
+                done.append(row_id)
+                continue
+            attempts += 1
+            self.failures += 1
+            if attempts >= EVENT_MAX_ATTEMPTS:
+                self.dead += 1
+                logger.error("Event %s -> %s is dead after %s attempts: %s", event, subscriber, attempts, error)
+                failed.append((row_id, attempts, None, error))
+            else:
+                delay = min(EVENT_RETRY_MAX, EVENT_RETRY_BASE * 2 ** (attempts - 1))
+                failed.append((row_id, attempts, now + random.uniform(delay / 2, delay), error))
+        await self.db.write(self._record, done, failed)
+        self.delivered += len(done)
+        return len(rows)
+
+    async def run(self) -> None:
+        """Фоновая задача доставки (запускается в on_startup)."""
+        self._wakeup = asyncio.Event()
+        while True:
+            # wake() во время прохода оставит флаг поднятым — следующий проход начнётся сразу
+            self._wakeup.clear()
+            try:
+                handled = await self.deliver_due()
+            except Exception as e:
+                logger.error("Event bus error: %s", e)
+                handled = 0
+            if handled >= EVENT_BATCH_SIZE:
+                continue  # в очереди есть ещё — забираем сразу
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), EVENT_POLL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+
+    def counts(self) -> Dict[str, int]:
+        """Сколько доставок ждёт и сколько умерло (синхронно, для db.read)."""
+        rows = self.db.fetchall("SELECT status, COUNT(*) FROM event_outbox GROUP BY status")
+        return dict(rows)
@@ -0,0 +1,266 @@
+# governor.py
+
+import asyncio
+import heapq
+import itertools
+import logging
+import random
+import time
+from email.utils import parsedate_to_datetime
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+# Приоритеты: чем меньше число, тем раньше запрос получает квоту
+PRIORITY_USER = 0         # пользователь/админ ждёт ответа прямо сейчас
+PRIORITY_BACKGROUND = 1   # фоновые опросы и воркеры
+
+
+class RetryableError(Exception):
+    """Ответ, после которого запрос имеет смысл повторить (5xx, 429)."""
+
+    def __init__(self, message: str, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class Throttled(RetryableError):
+    """Провайдер ответил 429: нас ограничивают по квоте, это не авария."""
+
+
+class CircuitOpen(RuntimeError):
+    """Провайдер недоступен, запросы временно не отправляются."""
+
+    def __init__(self, provider: str, retry_in: float):
+        super().__init__(f"{provider} is unavailable, retry in {retry_in:.0f}s")
+        self.provider = provider
+        self.retry_in = retry_in
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Retry-After: число секунд или HTTP-дата."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def check_response(resp: aiohttp.ClientResponse) -> None:
+    """Бросить RetryableError/Throttled для ответов, которые надо повторить."""
+    if resp.status == 429:
+        raise Throttled("429 Too Many Requests", parse_retry_after(resp.headers.get("Retry-After")))
+    if resp.status >= 500:
+        raise RetryableError(f"HTTP {resp.status}", parse_retry_after(resp.headers.get("Retry-After")))
+
+
+class ApiGovernor:
+    """
+    Регулятор исходящих запросов к одному провайдеру (TronGrid, CoinGecko, ...).
+
+    • token bucket: не больше rate запросов в секунду, пачкой до burst;
+      квоту первыми получают запросы с меньшим приоритетом (PRIORITY_USER)
+    • 429 с Retry-After ставит на паузу весь провайдер, а не только один запрос
+    • повторы с экспоненциальной задержкой и джиттером
+    • circuit breaker: после failure_threshold сбоев подряд запросы cooldown секунд
+      сразу получают CircuitOpen, а не висят на таймаутах; затем (half-open) к провайдеру
+      уходит один пробный запрос, остальные получают CircuitOpen, пока он не пройдёт
+    • запрос с PRIORITY_USER не ждёт паузу или повтор дольше user_max_wait секунд,
+      а все его попытки вместе с самими запросами укладываются в user_timeout секунд
+    """
+
+    def __init__(
+        self,
+        name: str,
+        rate: float,
+        burst: int,
+        retries: int = 3,
+        backoff_base: float = 0.5,
+        backoff_max: float = 30.0,
+        failure_threshold: int = 5,
+        cooldown: float = 60.0,
+        user_max_wait: float = 5.0,
+        user_timeout: float = 8.0,
+    ):
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.user_max_wait = user_max_wait
+        self.user_timeout = user_timeout
+
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = []
+        self._seq = itertools.count()
+        self._dispatcher: Optional[asyncio.Task] = None
+
+        self._failures = 0
+        self._open_until = 0.0
+        self._probing = False  # в полуоткрытом состоянии уже идёт пробный запрос
+
+        self.calls = 0
+        self.retried = 0
+        self.throttled = 0
+        self.failed = 0
+        self.rejected = 0
+        self.trips = 0
+
+    # --- token bucket ---
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def _acquire(self, priority: int) -> None:
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), future))
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.ensure_future(self._dispatch())
+        await future
+
+    async def _dispatch(self) -> None:
+        """Раздаёт токены ждущим по приоритету, пока очередь не опустеет."""
+        while self._waiters:
+            now = time.monotonic()
+            self._refill(now)
+            if self._paused_until > now:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+            while self._waiters and self._tokens >= 1:
+                _, _, future = heapq.heappop(self._waiters)
+                if future.done():  # ждущего отменили
+                    continue
+                self._tokens -= 1
+                future.set_result(None)
+            if self._waiters:
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def _pause(self, seconds: float) -> None:
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    # --- circuit breaker ---
+
+    def _check_circuit(self) -> bool:
+        """CircuitOpen, если запрос слать нельзя; True — этот запрос и есть пробный."""
+        retry_in = self._open_until - time.monotonic()
+        if retry_in > 0:
+            self.rejected += 1
+            raise CircuitOpen(self.name, retry_in)
+        if self._failures < self.failure_threshold:
+            return False
+        if self._probing:
+            # после простоя весь накопившийся хвост не должен уйти к провайдеру разом
+            self.rejected += 1
+            raise CircuitOpen(self.name, 0.0)
+        self._probing = True
+        return True
+
+    def _record_failure(self) -> None:
+        self._failures += 1
+        if self._failures >= self.failure_threshold:
+            # и после первой неудачной пробы в полуоткрытом состоянии открываемся снова
+            if self._open_until <= time.monotonic():
+                self.trips += 1
+                logger.warning("%s circuit opened for %.0fs after %s failures", self.name, self.cooldown, self._failures)
+            self._open_until = time.monotonic() + self.cooldown
+
+    def _record_success(self) -> None:
+        self._failures = 0
+        self._open_until = 0.0
+
+    def _backoff(self, attempt: int) -> float:
+        # full jitter: случайная задержка от 0 до base * 2^attempt
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    # --- вызов ---
+
+    async def call(
+        self,
+        fn: Callable[[], Awaitable[Any]],
+        priority: int = PRIORITY_BACKGROUND,
+        retries: Optional[int] = None,
+    ) -> Any:
+        """
+        Выполнить запрос fn() с учётом квоты, повторов и circuit breaker.
+        fn сам делает HTTP-запрос и бросает RetryableError/Throttled (см. check_response);
+        сетевые ошибки и таймауты тоже повторяются. Если провайдер лежит — CircuitOpen.
+        """
+        if retries is None:
+            # пользователь не должен ждать серию повторов — один повтор и ответ
+            retries = self.retries if priority != PRIORITY_USER else min(self.retries, 1)
+
+        self.calls += 1
+        # пользователь ждёт ответа: общий срок на все попытки, включая сами запросы
+        deadline = time.monotonic() + self.user_timeout if priority == PRIORITY_USER else None
+        attempt = 0
+        while True:
+            paused_for = self._paused_until - time.monotonic()
+            if priority == PRIORITY_USER and paused_for > self.user_max_wait:
+                raise Throttled(f"{self.name} is rate limited", paused_for)
+            probe = self._check_circuit()
+            try:
+                await self._acquire(priority)
+                if deadline is None:
+                    result = await fn()
+                else:
+                    result = await asyncio.wait_for(fn(), max(0.0, deadline - time.monotonic()))
+            except Throttled as e:
+                self.throttled += 1
+                delay = e.retry_after if e.retry_after is not None else self._backoff(attempt)
+                self._pause(delay)
+                error: Exception = e
+            except (RetryableError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+                self.failed += 1
+                self._record_failure()
+                delay = getattr(e, "retry_after", None) or self._backoff(attempt)
+                error = e
+            else:
+                self._record_success()
+                return result
+            finally:
+                if probe:
+                    self._probing = False
+
+            if attempt >= retries or (priority == PRIORITY_USER and delay > self.user_max_wait):
+                raise error
+            if deadline is not None and time.monotonic() + delay >= deadline:
+                raise error
+            attempt += 1
+            self.retried += 1
+            logger.info("%s request failed (%s), retry %s in %.1fs", self.name, error, attempt, delay)
+            await asyncio.sleep(delay)
+
+    def stats(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        self._refill(now)
+        if self._open_until > now:
+            state = "open"
+        elif self._failures >= self.failure_threshold:
+            state = "half-open"
+        else:
+            state = "closed"
+        return {
+            "state": state,
+            "tokens": self._tokens,
+            "queued": len(self._waiters),
+            "paused_for": max(0.0, self._paused_until - now),
+            "calls": self.calls,
+            "retried": self.retried,
+            "throttled": self.throttled,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "trips": self.trips,
+        }
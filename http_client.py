@@ -0,0 +1,61 @@
+# http_client.py
+
+import logging
+from typing import Optional
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+# --- НАСТРОЙКИ HTTP-КЛИЕНТА ---
+
+HTTP_TIMEOUT = 20               # общий таймаут запроса, секунды
+HTTP_CONNECT_TIMEOUT = 5        # из них на установку соединения
+HTTP_POOL_LIMIT = 100           # всего открытых соединений
+HTTP_POOL_LIMIT_PER_HOST = 10   # соединений на один хост (TronGrid, CoinGecko, Binance)
+HTTP_KEEPALIVE_SECONDS = 30     # сколько держать простаивающее соединение
+HTTP_DNS_CACHE_SECONDS = 300    # сколько помнить DNS-ответ
+
+_session: Optional[aiohttp.ClientSession] = None
+
+
+def _create() -> aiohttp.ClientSession:
+    connector = aiohttp.TCPConnector(
+        limit=HTTP_POOL_LIMIT,
+        limit_per_host=HTTP_POOL_LIMIT_PER_HOST,
+        keepalive_timeout=HTTP_KEEPALIVE_SECONDS,
+        ttl_dns_cache=HTTP_DNS_CACHE_SECONDS,
+    )
+    timeout = aiohttp.ClientTimeout(total=HTTP_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT)
+    return aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+
+def timeout(total: float) -> aiohttp.ClientTimeout:
+    """Таймаут отдельного запроса, если ему нужен короче общего HTTP_TIMEOUT."""
+    return aiohttp.ClientTimeout(total=total, connect=min(total, HTTP_CONNECT_TIMEOUT))
+
+
+async def start() -> aiohttp.ClientSession:
+    """Создать общую сессию (вызывается в on_startup)."""
+    return session()
+
+
+def session() -> aiohttp.ClientSession:
+    """
+    Общая сессия приложения: пул keep-alive соединений, кэш DNS и единые таймауты
+    для всех исходящих запросов. Если start() ещё не вызывали (скрипты, бенчмарки),
+    сессия создаётся при первом обращении — это нужно делать внутри event loop.
+    """
+    global _session
+    if _session is None or _session.closed:
+        _session = _create()
+    return _session
+
+
+async def close() -> None:
+    """Закрыть общую сессию и все её соединения (вызывается в on_shutdown)."""
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+        logger.info("HTTP session closed")
+    _session = None
@@ -0,0 +1,283 @@
+# indicators.py
+
+import math
+from collections import deque
+from typing import Any, Deque, Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+# Индикаторы считаются во float64 на массивах NumPy. Относительно прежней
+# реализации на Decimal относительная ошибка EMA/ATR — порядка 1e-15, силы тренда
+# (разность близких чисел) — до 1e-12 (проверка: benchmarks/bench_indicators.py); решения фильтров совпадают
+# везде, кроме значений в пределах этой погрешности от порога.
+# В Decimal переводим только при форматировании цен в тексте сигнала.
+
+
+def as_series(values) -> np.ndarray:
+    """Цены в непрерывный массив float64."""
+    return np.ascontiguousarray(values, dtype=np.float64)
+
+
+def ema(values: np.ndarray, period: int) -> Optional[float]:
+    """
+    Классическая EMA (старт с первого значения), последнее значение.
+
+    Вместо цикла ema = (v - ema) * alpha + ema — та же сумма в явном виде:
+    ema_n = (1-a)^n * x_0 + Σ a * (1-a)^(n-k) * x_k, одним скалярным произведением.
+    """
+    n = len(values)
+    if n < period:
+        return None
+    alpha = 2.0 / (period + 1)
+    decay = 1.0 - alpha
+    # веса от нового к старому: a, a(1-a), a(1-a)^2, ... ; у x_0 — (1-a)^(n-1) без множителя a
+    weights = alpha * decay ** np.arange(n - 1, -1, -1, dtype=np.float64)
+    weights[0] = decay ** (n - 1)
+    return float(np.dot(weights, values))
+
+
+def atr_like(values: np.ndarray, period: int) -> Optional[float]:
+    """
+    Простейший ATR-подобный показатель:
+    среднее абсолютное изменение между соседними закрытиями за N последних интервалов.
+    """
+    if len(values) <= period:
+        return None
+    return float(np.abs(np.diff(values[-(period + 1):])).mean())
+
+
+class Setup(NamedTuple):
+    """Результат оценки серии: направление и всё, что нужно для текста сигнала."""
+
+    direction: str         # "long" / "short"
+    last_close: float
+    ema_fast: float
+    ema_slow: float
+    atr: float
+    trend_pct: float       # сила тренда относительно медленной EMA, %
+    atr_pct: float         # средняя волатильность за свечу, %
+
+
+def _classify(
+    last_close: float,
+    ema_fast: float,
+    ema_slow: float,
+    atr: float,
+    min_trend_pct: float,
+    min_atr_pct: float,
+    max_atr_pct: float,
+) -> Optional[Setup]:
+    """Фильтры стратегии по уже посчитанным индикаторам."""
+    if atr <= 0:
+        return None
+
+    trend_pct = (last_close - ema_slow) / last_close * 100.0
+    atr_pct = atr / last_close * 100.0
+
+    if atr_pct < min_atr_pct or atr_pct > max_atr_pct:
+        # либо слишком скучно, либо слишком бешено — пропускаем
+        return None
+
+    if trend_pct > min_trend_pct and ema_fast > ema_slow:
+        direction = "long"
+    elif trend_pct < -min_trend_pct and ema_fast < ema_slow:
+        direction = "short"
+    else:
+        # тренд слабый/размазанный — не даём сигнал
+        return None
+
+    return Setup(direction, last_close, ema_fast, ema_slow, atr, trend_pct, atr_pct)
+
+
+def evaluate(
+    closes: np.ndarray,
+    fast_period: int,
+    slow_period: int,
+    atr_period: int,
+    min_trend_pct: float,
+    min_atr_pct: float,
+    max_atr_pct: float,
+) -> Optional[Setup]:
+    """
+    Фильтры стратегии по серии закрытий. None — данных мало или фильтры не пройдены:
+    • волатильность в коридоре [min_atr_pct, max_atr_pct]
+    • цена, EMA fast и EMA slow смотрят в одну сторону, тренд сильнее min_trend_pct
+    """
+    if len(closes) < max(slow_period, atr_period) + 5:
+        # мало данных, лучше ничего не давать, чем городить мусор
+        return None
+
+    ema_fast = ema(closes, fast_period)
+    ema_slow = ema(closes, slow_period)
+    atr = atr_like(closes, atr_period)
+    if ema_fast is None or ema_slow is None or atr is None:
+        return None
+    return _classify(float(closes[-1]), ema_fast, ema_slow, atr, min_trend_pct, min_atr_pct, max_atr_pct)
+
+
+def score(
+    setup: Setup,
+    min_trend_pct: float,
+    min_atr_pct: float,
+    max_atr_pct: float,
+    ideal_atr_pct: float,
+    trend_cap: float = 10.0,
+) -> float:
+    """
+    Качество сетапа для выбора лучшей пары: сила тренда в долях порога
+    (не больше trend_cap) с поправкой на волатильность — 1 в ideal_atr_pct,
+    к краям коридора [min_atr_pct, max_atr_pct] множитель падает до 0.5
+    (расстояние меряется в логарифмах, коридор широкий).
+    """
+    trend = min(abs(setup.trend_pct) / min_trend_pct, trend_cap)
+    edge = max(math.log(ideal_atr_pct / min_atr_pct), math.log(max_atr_pct / ideal_atr_pct))
+    fit = max(0.0, 1.0 - abs(math.log(setup.atr_pct / ideal_atr_pct)) / edge)
+    return trend * (0.5 + 0.5 * fit)
+
+
+# ---------- ПОТОКОВОЕ СОСТОЯНИЕ ----------
+
+# Насколько может отличаться цена в точке стыка, чтобы считать историю той же самой
+STREAM_PRICE_TOLERANCE = 1e-9
+
+
+class StreamState:
+    """
+    Индикаторы одной пары, которые обновляются по одному закрытию за O(1):
+    две EMA и окно последних atr_period абсолютных изменений для ATR.
+
+    • sync(ts, closes) — докатить состояние по свежей серии: берутся только
+      закрытые точки новее last_ts. Последняя точка серии — текущая цена
+      (интервал ещё не закрыт), в состояние она не попадает.
+    • Если серия не стыкуется с состоянием (нет точки last_ts, цена в ней другая,
+      состояние пустое или от других периодов) — состояние пересобирается
+      по всей серии. Это и есть обнаружение разрыва.
+    • setup(live_close, ...) — фильтры стратегии с текущей ценой поверх состояния,
+      без изменения самого состояния.
+
+    EMA здесь стартует с первой точки, которую состояние когда-либо видело, а не
+    с начала скачанного окна, поэтому со временем она точнее пересчёта с нуля.
+    """
+
+    def __init__(self, fast_period: int, slow_period: int, atr_period: int):
+        self.fast_period = fast_period
+        self.slow_period = slow_period
+        self.atr_period = atr_period
+        self._fast_alpha = 2.0 / (fast_period + 1)
+        self._slow_alpha = 2.0 / (slow_period + 1)
+        self.reset()
+        self.reseeds = 0
+
+    def reset(self) -> None:
+        self.count = 0
+        self.last_ts: Optional[int] = None
+        self.last_close = 0.0
+        self.ema_fast = 0.0
+        self.ema_slow = 0.0
+        self.diffs: Deque[float] = deque(maxlen=self.atr_period)
+
+    def push(self, ts: int, close: float) -> None:
+        """Добавить одно закрытое значение."""
+        if self.count == 0:
+            self.ema_fast = self.ema_slow = close
+        else:
+            self.ema_fast += (close - self.ema_fast) * self._fast_alpha
+            self.ema_slow += (close - self.ema_slow) * self._slow_alpha
+            self.diffs.append(abs(close - self.last_close))
+        self.count += 1
+        self.last_ts = ts
+        self.last_close = close
+
+    def seed(self, ts: np.ndarray, closes: np.ndarray) -> None:
+        """Пересобрать состояние с нуля по закрытым точкам."""
+        self.reset()
+        self.reseeds += 1
+        for t, c in zip(ts.tolist(), closes.tolist()):
+            self.push(t, c)
+
+    def sync(self, ts: np.ndarray, closes: np.ndarray) -> int:
+        """
+        Догнать состояние по серии (ts по возрастанию, последняя точка — текущая цена).
+        Возвращает, сколько закрытий добавлено; при разрыве — пересборка по всей серии.
+        """
+        closed_ts, closed = ts[:-1], closes[:-1]
+        if self.last_ts is not None:
+            i = int(np.searchsorted(closed_ts, self.last_ts))
+            joined = (
+                i < len(closed_ts)
+                and int(closed_ts[i]) == self.last_ts
+                and abs(float(closed[i]) - self.last_close) <= STREAM_PRICE_TOLERANCE * abs(self.last_close)
+            )
+            if joined:
+                added = 0
+                for t, c in zip(closed_ts[i + 1:].tolist(), closed[i + 1:].tolist()):
+                    self.push(t, c)
+                    added += 1
+                return added
+        self.seed(closed_ts, closed)
+        return self.count
+
+    def setup(
+        self,
+        live_close: float,
+        min_trend_pct: float,
+        min_atr_pct: float,
+        max_atr_pct: float,
+    ) -> Optional[Setup]:
+        """Фильтры стратегии с текущей ценой live_close (состояние не меняется)."""
+        if self.count + 1 < max(self.slow_period, self.atr_period) + 5:
+            return None
+        ema_fast = self.ema_fast + (live_close - self.ema_fast) * self._fast_alpha
+        ema_slow = self.ema_slow + (live_close - self.ema_slow) * self._slow_alpha
+        # окно ATR со сдвигом на текущую цену: самое старое изменение выпадает
+        diffs = list(self.diffs)[1:] + [abs(live_close - self.last_close)]
+        atr = sum(diffs) / len(diffs)
+        return _classify(live_close, ema_fast, ema_slow, atr, min_trend_pct, min_atr_pct, max_atr_pct)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "periods": [self.fast_period, self.slow_period, self.atr_period],
+            "count": self.count,
+            "last_ts": self.last_ts,
+            "last_close": self.last_close,
+            "ema_fast": self.ema_fast,
+            "ema_slow": self.ema_slow,
+            "diffs": list(self.diffs),
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any], fast_period: int, slow_period: int, atr_period: int) -> "StreamState":
+        """Восстановить сохранённое состояние; сохранённое для других периодов отбрасывается."""
+        state = cls(fast_period, slow_period, atr_period)
+        if data.get("periods") != [fast_period, slow_period, atr_period]:
+            return state
+        state.count = int(data["count"])
+        state.last_ts = data["last_ts"]
+        state.last_close = float(data["last_close"])
+        state.ema_fast = float(data["ema_fast"])
+        state.ema_slow = float(data["ema_slow"])
+        state.diffs.extend(float(d) for d in data["diffs"])
+        return state
+
+
+def evaluate_batch(
+    jobs: List[Tuple[Optional[Dict[str, Any]], np.ndarray, np.ndarray]],
+    periods: Tuple[int, int, int],
+    filters: Tuple[float, float, float],
+) -> List[Tuple[Dict[str, Any], Optional[Setup], bool]]:
+    """
+    Пачка пар за один вызов — для пула процессов (функция верхнего уровня, всё на входе
+    и выходе сериализуется). jobs: (сохранённое состояние или None, ts, closes);
+    periods: (fast, slow, atr); filters: (min_trend_pct, min_atr_pct, max_atr_pct).
+    Возвращает на каждую пару (новое состояние, сетап или None, была ли пересборка).
+    """
+    results = []
+    for data, ts, closes in jobs:
+        if data is None:
+            state = StreamState(*periods)
+        else:
+            state = StreamState.from_dict(data, *periods)
+        state.sync(ts, closes)
+        setup = state.setup(float(closes[-1]), *filters)
+        results.append((state.to_dict(), setup, state.reseeds > 0))
+    return results
@@ -0,0 +1,145 @@
+# leaderboard.py
+
+import heapq
+from collections import deque
+from datetime import datetime, timedelta
+from typing import Deque, Dict, Iterable, List, Optional, Tuple
+
+# Сколько мест в топе партнёров
+LEADERBOARD_SIZE = 10
+
+# Периоды топа: ключ -> окно (None — за всё время)
+LEADERBOARD_PERIODS = {
+    "all": None,
+    "week": timedelta(days=7),
+    "month": timedelta(days=30),
+}
+
+
+class _Board:
+    """
+    Счётчики приглашённых по партнёрам + закэшированный топ-K.
+
+    Рост счётчика обновляет топ на месте (K маленький), уменьшение счётчика
+    у кого-то из топа помечает топ грязным — он пересчитается при следующем чтении.
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self.counts: Dict[int, int] = {}
+        self._top: Optional[List[Tuple[int, int]]] = []
+
+    def add(self, referrer_id: int, delta: int = 1) -> None:
+        n = self.counts.get(referrer_id, 0) + delta
+        if n > 0:
+            self.counts[referrer_id] = n
+        else:
+            self.counts.pop(referrer_id, None)
+
+        top = self._top
+        if top is None:
+            return
+        if delta < 0:
+            if any(r == referrer_id for r, _ in top):
+                self._top = None
+            return
+
+        for i, (r, _) in enumerate(top):
+            if r == referrer_id:
+                top[i] = (r, n)
+                break
+        else:
+            if len(top) < self.size:
+                top.append((referrer_id, n))
+            elif n > top[-1][1]:
+                top[-1] = (referrer_id, n)
+            else:
+                return
+        top.sort(key=lambda item: item[1], reverse=True)
+
+    def top(self) -> List[Tuple[int, int]]:
+        if self._top is None:
+            self._top = heapq.nlargest(self.size, self.counts.items(), key=lambda item: item[1])
+        return list(self._top)
+
+
+class _WindowBoard(_Board):
+    """Топ за скользящее окно: события старше окна вычитаются при чтении."""
+
+    def __init__(self, size: int, window: timedelta):
+        super().__init__(size)
+        self.window = window
+        self._events: Deque[Tuple[datetime, int]] = deque()
+
+    def add_event(self, referrer_id: int, at: datetime) -> None:
+        self._events.append((at, referrer_id))
+        self.add(referrer_id, 1)
+
+    def expire(self, now: datetime) -> None:
+        border = now - self.window
+        while self._events and self._events[0][0] < border:
+            _, referrer_id = self._events.popleft()
+            self.add(referrer_id, -1)
+
+
+class ReferralLeaderboard:
+    """
+    Топ партнёров по приглашённым 1-го уровня, целиком в памяти.
+
+    • load() — полная загрузка (при старте и периодически для сверки с БД)
+    • record_referral() — +1 партнёру при регистрации реферала
+    • top() — готовый топ без обращения к БД
+    """
+
+    def __init__(self, size: int = LEADERBOARD_SIZE):
+        self.size = size
+        self.loaded = False
+        self._names: Dict[int, Tuple[str, str]] = {}
+        self._all = _Board(size)
+        self._windows = {
+            period: _WindowBoard(size, window)
+            for period, window in LEADERBOARD_PERIODS.items()
+            if window is not None
+        }
+
+    def load(
+        self,
+        totals: Iterable[Tuple[int, str, str, int]],
+        recent: Iterable[Tuple[int, datetime]],
+    ) -> None:
+        """
+        totals: (id партнёра, username, first_name, всего приглашённых)
+        recent: (id партнёра, дата регистрации реферала) по возрастанию даты
+        """
+        names: Dict[int, Tuple[str, str]] = {}
+        board = _Board(self.size)
+        for referrer_id, username, first_name, count in totals:
+            names[referrer_id] = (username or "", first_name or "")
+            board.counts[referrer_id] = count
+        board._top = None
+
+        windows = {period: _WindowBoard(self.size, w.window) for period, w in self._windows.items()}
+        for referrer_id, at in recent:
+            for w in windows.values():
+                w.add_event(referrer_id, at)
+
+        self._names, self._all, self._windows = names, board, windows
+        self.loaded = True
+
+    def set_name(self, referrer_id: int, username: str, first_name: str) -> None:
+        self._names[referrer_id] = (username or "", first_name or "")
+
+    def record_referral(self, referrer_id: int, at: Optional[datetime] = None) -> None:
+        at = at or datetime.utcnow()
+        self._all.add(referrer_id, 1)
+        for w in self._windows.values():
+            w.add_event(referrer_id, at)
+
+    def top(self, period: str = "all", now: Optional[datetime] = None) -> List[Tuple[str, str, int]]:
+        """[(username, first_name, приглашённых), ...] по убыванию."""
+        if period == "all":
+            board = self._all
+        else:
+            board = self._windows[period]
+            board.expire(now or datetime.utcnow())
+        return [(*self._names.get(referrer_id, ("", "")), count) for referrer_id, count in board.top()]
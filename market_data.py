@@ -0,0 +1,172 @@
+# market_data.py
+
+import json
+import logging
+import os
+import time
+from typing import Any, Dict, Optional, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# --- НАСТРОЙКИ КЭША РЫНОЧНЫХ ДАННЫХ ---
+
+MARKET_DATA_DIR = "market_data"     # папка с файлами кэша (относительно запуска, как DB_PATH)
+MARKET_DATA_TTL = 300               # столько секунд данные свежие — в API не ходим вообще
+MARKET_DATA_KEEP_DAYS = 30          # точки старше обрезаются при очередном обновлении
+MARKET_DATA_STEP_MS = 3_600_000     # шаг хранимых закрытий — час, как у market_chart за 2–90 дней
+
+# Запись файла: метка времени в мс и цена. Файл только дописывается, читается через mmap.
+RECORD = np.dtype([("ts", "<i8"), ("price", "<f8")])
+
+
+class MarketDataCache:
+    """
+    Локальный кэш часовых закрытий по coin id: {coin_id}.bin — массив RECORD,
+    {coin_id}.json — когда обновляли и текущая (ещё не закрытая) цена.
+
+    • update(coin_id, ts, prices) — принять точки из API (последняя — текущая цена):
+      в файл дописываются только закрытые часы новее последней записи, по одной
+      точке на час (первая точка часа), так что и почасовой ответ, и 5-минутная
+      дельта ложатся в одну и ту же сетку
+    • series(coin_id, since_ms) — закрытия начиная с since_ms плюс текущая цена
+    • is_fresh(coin_id) — данные моложе ttl, можно отдавать без запроса
+
+    Оборванная при падении запись (хвост файла не кратен RECORD) отбрасывается.
+    """
+
+    def __init__(
+        self,
+        root: str = MARKET_DATA_DIR,
+        ttl: float = MARKET_DATA_TTL,
+        keep_days: int = MARKET_DATA_KEEP_DAYS,
+        step_ms: int = MARKET_DATA_STEP_MS,
+    ):
+        self.root = root
+        self.ttl = ttl
+        self.keep_days = keep_days
+        self.step_ms = step_ms
+        self._meta: Dict[str, Dict[str, Any]] = {}
+        self.fresh_hits = 0
+        self.delta_fetches = 0
+        self.full_fetches = 0
+        self.appended = 0
+
+    def _path(self, coin_id: str, ext: str) -> str:
+        return os.path.join(self.root, f"{coin_id}.{ext}")
+
+    def records(self, coin_id: str) -> np.ndarray:
+        """Все закрытия пары (только чтение, через mmap)."""
+        path = self._path(coin_id, "bin")
+        try:
+            count = os.path.getsize(path) // RECORD.itemsize
+        except OSError:
+            count = 0
+        if count == 0:
+            return np.empty(0, dtype=RECORD)
+        return np.memmap(path, dtype=RECORD, mode="r", shape=(count,))
+
+    def meta(self, coin_id: str) -> Dict[str, Any]:
+        meta = self._meta.get(coin_id)
+        if meta is None:
+            try:
+                with open(self._path(coin_id, "json"), encoding="utf-8") as f:
+                    meta = json.load(f)
+            except FileNotFoundError:
+                meta = {}
+            except (OSError, ValueError) as e:
+                logger.warning("Market data meta for %s is unreadable: %s", coin_id, e)
+                meta = {}
+            self._meta[coin_id] = meta
+        return meta
+
+    def last_ts(self, coin_id: str) -> Optional[int]:
+        recs = self.records(coin_id)
+        return int(recs["ts"][-1]) if len(recs) else None
+
+    def is_fresh(self, coin_id: str, now: Optional[float] = None) -> bool:
+        meta = self.meta(coin_id)
+        if "live" not in meta:
+            return False
+        now = time.time() if now is None else now
+        return now - meta.get("fetched_at", 0) < self.ttl
+
+    def update(self, coin_id: str, ts: np.ndarray, prices: np.ndarray, now: Optional[float] = None) -> int:
+        """Принять ответ API (ts по возрастанию, последняя точка — текущая цена). Возвращает, сколько дописано."""
+        now = time.time() if now is None else now
+        if len(ts) == 0:
+            return 0
+        os.makedirs(self.root, exist_ok=True)
+
+        buckets = ts // self.step_ms
+        last = self.last_ts(coin_id)
+        last_bucket = last // self.step_ms if last is not None else -1
+        # закрытые часы (текущий ещё идёт) новее кэша, по первой точке каждого часа
+        first_in_bucket = np.r_[True, buckets[1:] != buckets[:-1]]
+        mask = first_in_bucket & (buckets > last_bucket) & (buckets < buckets[-1])
+        new = np.empty(int(mask.sum()), dtype=RECORD)
+        new["ts"] = ts[mask]
+        new["price"] = prices[mask]
+
+        path = self._path(coin_id, "bin")
+        if len(new):
+            self._truncate_torn(path)
+            with open(path, "ab") as f:
+                f.write(new.tobytes())
+            self.appended += len(new)
+        self._trim(coin_id, now)
+
+        meta = {"fetched_at": now, "live": [int(ts[-1]), float(prices[-1])]}
+        self._meta[coin_id] = meta
+        tmp_path = self._path(coin_id, "json.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, self._path(coin_id, "json"))
+        return len(new)
+
+    def _truncate_torn(self, path: str) -> None:
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return
+        if size % RECORD.itemsize:
+            logger.warning("Market data file %s has a torn record, truncating", path)
+            with open(path, "r+b") as f:
+                f.truncate(size - size % RECORD.itemsize)
+
+    def _trim(self, coin_id: str, now: float) -> None:
+        """Переписать файл без старых точек, когда их набралось на четверть сверх keep_days."""
+        recs = self.records(coin_id)
+        if not len(recs):
+            return
+        keep_from = int((now - self.keep_days * 86400) * 1000)
+        stale = int(np.searchsorted(recs["ts"], keep_from))
+        if stale * 4 < len(recs) - stale:
+            return
+        kept = np.array(recs[stale:])
+        del recs
+        path = self._path(coin_id, "bin")
+        with open(path + ".tmp", "wb") as f:
+            f.write(kept.tobytes())
+        os.replace(path + ".tmp", path)
+
+    def series(self, coin_id: str, since_ms: int) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        """Закрытия с since_ms и текущая цена последней точкой (копии, не mmap)."""
+        meta = self.meta(coin_id)
+        if "live" not in meta:
+            return None
+        recs = self.records(coin_id)
+        start = int(np.searchsorted(recs["ts"], since_ms))
+        live_ts, live_price = meta["live"]
+        ts = np.append(recs["ts"][start:], np.int64(live_ts))
+        prices = np.append(recs["price"][start:], np.float64(live_price))
+        return ts, prices
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "fresh_hits": self.fresh_hits,
+            "delta_fetches": self.delta_fetches,
+            "full_fetches": self.full_fetches,
+            "appended": self.appended,
+        }
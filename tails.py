@@ -0,0 +1,77 @@
+# tails.py
+
+import threading
+from typing import Dict, Hashable, Iterable, Set, Tuple
+
+# Хвосты суммы: 0.001 … 0.999 USDT, в тысячных
+TAIL_MIN = 1
+TAIL_MAX = 999
+
+
+class TailsExhausted(RuntimeError):
+    """Все хвосты продукта заняты ожидающими заявками."""
+
+
+class TailAllocator:
+    """
+    Раздаёт уникальные хвосты сумм (100.543 -> хвост 543) по продуктам, чтобы
+    у двух ожидающих заявок на один продукт никогда не было одинаковой суммы.
+    «Продукт» — любой хэшируемый ключ пространства сумм, например (кошелёк, продукт).
+
+    • load() — пересобрать занятые хвосты по ожидающим заявкам из БД (при старте)
+    • allocate() — взять свободный хвост, O(1)
+    • release() — вернуть хвост (заявка оплачена или истекла)
+
+    Аллокатор только зеркалит ожидающие заявки: истекает заявку всегда БД,
+    и только после этого хвост освобождается здесь — иначе у двух ожидающих
+    заявок окажется одна сумма.
+    """
+
+    def __init__(self, tail_min: int = TAIL_MIN, tail_max: int = TAIL_MAX):
+        self.tail_min = tail_min
+        self.tail_max = tail_max
+        self._lock = threading.Lock()
+        self._free: Dict[Hashable, Set[int]] = {}
+
+    @property
+    def size(self) -> int:
+        return self.tail_max - self.tail_min + 1
+
+    def _free_set(self, product: Hashable) -> Set[int]:
+        free = self._free.get(product)
+        if free is None:
+            free = self._free[product] = set(range(self.tail_min, self.tail_max + 1))
+        return free
+
+    def load(self, held: Iterable[Tuple[Hashable, int]]) -> None:
+        """held: (продукт, хвост) ожидающих заявок."""
+        with self._lock:
+            self._free.clear()
+            for product, tail in held:
+                if self.tail_min <= tail <= self.tail_max:
+                    self._free_set(product).discard(tail)
+
+    def allocate(self, product: Hashable) -> int:
+        """Свободный хвост для продукта; если свободных нет — TailsExhausted."""
+        with self._lock:
+            free = self._free_set(product)
+            if not free:
+                raise TailsExhausted(f"No free amount tails for {product}")
+            return free.pop()
+
+    def release(self, product: Hashable, tail: int) -> None:
+        if not self.tail_min <= tail <= self.tail_max:
+            return
+        with self._lock:
+            self._free_set(product).add(tail)
+
+    def held(self, product: Hashable) -> int:
+        """Сколько хвостов продукта сейчас занято."""
+        with self._lock:
+            free = self._free.get(product)
+            return 0 if free is None else self.size - len(free)
+
+    def stats(self) -> Dict[Hashable, Tuple[int, int]]:
+        """{продукт: (занято, всего)}"""
+        with self._lock:
+            return {product: (self.size - len(free), self.size) for product, free in self._free.items()}
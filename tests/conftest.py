@@ -0,0 +1,30 @@
+import os
+import sys
+from types import SimpleNamespace
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def fake_message(tg_id: int, username: str = None, first_name: str = "Test"):
+    return SimpleNamespace(
+        from_user=SimpleNamespace(id=tg_id, username=username or f"u{tg_id}", first_name=first_name)
+    )
+
+
+@pytest.fixture
+def bot(tmp_path, monkeypatch):
+    """Модуль bot на чистой базе во временной папке."""
+    monkeypatch.chdir(tmp_path)  # файлы, которые бот пишет рядом с собой, — тоже во временную папку
+    import bot as bot_module
+    from tails import TailAllocator
+
+    bot_module.db.close()
+    monkeypatch.setattr(bot_module.db, "path", str(tmp_path / "database.db"))
+    monkeypatch.setattr(bot_module, "tails", TailAllocator())
+    bot_module.user_cache.clear()
+    bot_module.init_db()
+    yield bot_module
+    bot_module.db.close()
@@ -0,0 +1,93 @@
+import asyncio
+import time
+
+import pytest
+
+from governor import PRIORITY_BACKGROUND, PRIORITY_USER, ApiGovernor, CircuitOpen, RetryableError
+
+
+def _governor(**kwargs):
+    return ApiGovernor("test", rate=100, burst=10, backoff_base=0.01, **kwargs)
+
+
+def test_user_call_bounded_by_user_timeout():
+    api = _governor(user_timeout=0.2)
+
+    async def hang():
+        await asyncio.sleep(10)
+
+    started = time.monotonic()
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(api.call(hang, priority=PRIORITY_USER))
+    assert time.monotonic() - started < 1
+
+
+def test_user_call_retries_within_budget():
+    api = _governor(user_timeout=1)
+    attempts = []
+
+    async def flaky():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise RetryableError("HTTP 502")
+        return "ok"
+
+    assert asyncio.run(api.call(flaky, priority=PRIORITY_USER)) == "ok"
+    assert len(attempts) == 2
+
+
+def test_background_call_not_limited_by_user_timeout():
+    api = _governor(user_timeout=0.05)
+
+    async def slow():
+        await asyncio.sleep(0.2)
+        return "ok"
+
+    assert asyncio.run(api.call(slow, priority=PRIORITY_BACKGROUND)) == "ok"
+
+
+def test_half_open_lets_one_probe_through():
+    api = _governor(failure_threshold=1, cooldown=0.05)
+    sent = []
+
+    async def down():
+        raise RetryableError("HTTP 503")
+
+    async def up():
+        sent.append(1)
+        await asyncio.sleep(0.02)
+        return "ok"
+
+    async def scenario():
+        with pytest.raises(RetryableError):
+            await api.call(down, retries=0)
+        await asyncio.sleep(0.06)
+        assert api.stats()["state"] == "half-open"
+        results = await asyncio.gather(*(api.call(up, retries=0) for _ in range(5)), return_exceptions=True)
+        # после успешной пробы цепь закрыта и запросы снова идут
+        assert await api.call(up) == "ok"
+        return results
+
+    results = asyncio.run(scenario())
+    assert results.count("ok") == 1
+    assert all(isinstance(r, CircuitOpen) for r in results if r != "ok")
+    assert len(sent) == 2
+
+
+def test_failed_probe_reopens_circuit():
+    api = _governor(failure_threshold=1, cooldown=0.05)
+
+    async def down():
+        raise RetryableError("HTTP 503")
+
+    async def scenario():
+        with pytest.raises(RetryableError):
+            await api.call(down, retries=0)
+        await asyncio.sleep(0.06)
+        with pytest.raises(RetryableError):
+            await api.call(down, retries=0)
+        with pytest.raises(CircuitOpen):
+            await api.call(down, retries=0)
+
+    asyncio.run(scenario())
+    assert api.stats()["state"] == "open"
@@ -0,0 +1,52 @@
+import asyncio
+import time
+
+import numpy as np
+import pytest
+
+import auto_signals
+from market_data import MarketDataCache
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    cache = MarketDataCache(root=str(tmp_path / "market_data"))
+    monkeypatch.setattr(auto_signals, "market_cache", cache)
+    monkeypatch.setattr(auto_signals, "coingecko_requests", auto_signals.SingleFlight(ttl=0))
+    return cache
+
+
+class _EmptyChart:
+    """CoinGecko, у которого за запрошенный период нет точек: {"prices": []}."""
+
+    def __init__(self):
+        self.calls = 0
+
+    async def call(self, fn, priority=None):
+        self.calls += 1
+        return {"prices": []}
+
+
+def test_empty_delta_falls_back_to_cached_series(cache, monkeypatch):
+    step = cache.step_ms
+    now = time.time()
+    first = (int(now * 1000) // step - 20) * step
+    ts = np.arange(first, first + 21 * step, step, dtype=np.int64)
+    cache.update("bitcoin", ts, np.linspace(100.0, 120.0, len(ts)), now=now - cache.ttl - 1)
+    api = _EmptyChart()
+    monkeypatch.setattr(auto_signals, "coingecko_api", api)
+
+    series = asyncio.run(auto_signals.fetch_coingecko_market_chart("bitcoin", days=3))
+
+    assert (api.calls, cache.delta_fetches) == (1, 1)
+    assert series is not None
+    assert len(series[0]) == 21
+    assert series[1][-1] == 120.0
+
+
+def test_empty_response_without_cache_gives_up(cache, monkeypatch):
+    api = _EmptyChart()
+    monkeypatch.setattr(auto_signals, "coingecko_api", api)
+
+    assert asyncio.run(auto_signals.fetch_coingecko_market_chart("bitcoin", days=3)) is None
+    assert (api.calls, cache.full_fetches) == (1, 1)
@@ -0,0 +1,267 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+from conftest import fake_message
+from tails import TailAllocator, TailsExhausted
+
+
+@pytest.fixture
+def one_tail(bot, monkeypatch):
+    """Один кошелёк и один хвост на продукт — любая вторая заявка упирается в исчерпание."""
+    monkeypatch.setattr(bot, "WALLET_ADDRESSES", ["TWALLET"])
+    monkeypatch.setattr(bot, "tails", TailAllocator(1, 1))
+    return bot
+
+
+def _backdate(bot, purchase_id, hours):
+    created_at = (datetime.utcnow() - timedelta(hours=hours)).strftime("%Y-%m-%d %H:%M:%S")
+    with bot.db.transaction() as cur:
+        cur.execute("UPDATE purchases SET created_at = ? WHERE id = ?", (created_at, purchase_id))
+
+
+def _overdue(bot):
+    """Возраст заявки в часах, после которого она уже истекает (срок + грейс + час)."""
+    return bot.PURCHASE_TTL_HOURS + bot.PURCHASE_GRACE_MINUTES / 60 + 1
+
+
+def _buy(bot, tg_id, product="package"):
+    user_db_id = bot.get_or_create_user(fake_message(tg_id))
+    return bot.create_purchase(user_db_id, product, bot.PRODUCT_PRICES[product])
+
+
+def _status(bot, purchase_id):
+    return bot.get_purchase(purchase_id)[4]
+
+
+def test_exhausted_tails_do_not_expire_overdue_invoice(one_tail, monkeypatch):
+    bot = one_tail
+    monkeypatch.setattr(bot, "sync_trc20_transfers", _no_sync)
+    old = _buy(bot, 1)
+    _backdate(bot, old, _overdue(bot))
+
+    # без финальной сверки просроченная заявка не истекает и хвост не отдаёт
+    with pytest.raises(TailsExhausted):
+        _buy(bot, 2)
+    assert _status(bot, old) == "pending"
+    assert bot.tails.held(("TWALLET", "package")) == 1
+
+    now = datetime.utcnow()
+    wallets = asyncio.run(bot.poll_expiring_wallets(now))
+    assert bot.expire_purchases(now, wallets) == (1, 0)
+    new = _buy(bot, 2)
+
+    assert _status(bot, old) == "expired"
+    assert bot.get_purchase(new)[7] == bot.get_purchase(old)[7]
+    assert [p[0] for p in bot.get_pending_purchases()["TWALLET"]] == [new]
+    assert bot.tails.held(("TWALLET", "package")) == 1
+
+
+def test_exhausted_tails_leave_other_products_alone(one_tail):
+    bot = one_tail
+    renewal = _buy(bot, 1, "renewal")
+    package = _buy(bot, 2, "package")
+    _backdate(bot, renewal, _overdue(bot))
+
+    with pytest.raises(TailsExhausted):
+        _buy(bot, 3, "package")
+
+    assert _status(bot, renewal) == "pending"
+    assert _status(bot, package) == "pending"
+    assert bot.tails.held(("TWALLET", "renewal")) == 1
+    assert bot.tails.held(("TWALLET", "package")) == 1
+
+
+# --- истечение заявок и поздние переводы ---
+
+
+def _ms(dt):
+    return int((dt - datetime(1970, 1, 1)).total_seconds() * 1000)
+
+
+def _transfer(bot, tx_id, purchase_id, when):
+    """Перевод точной суммы заявки в локальный журнал, как его сохранил бы sync_trc20_transfers."""
+    row = bot.get_purchase(purchase_id)
+    tx = {
+        "transaction_id": tx_id,
+        "from": "TPAYER",
+        "to": row[8],
+        "value": str(row[7]),
+        "block_timestamp": _ms(when),
+        "token_info": {"address": "TUSDT", "decimals": 6},
+    }
+    bot.save_trc20_transfers([tx], f"test:{tx_id}", "0")
+
+
+async def _no_sync(address):
+    return 0
+
+
+def test_grace_period_before_expiry(bot):
+    in_grace = _buy(bot, 1)
+    overdue = _buy(bot, 2)
+    _backdate(bot, in_grace, bot.PURCHASE_TTL_HOURS + bot.PURCHASE_GRACE_MINUTES / 120)
+    _backdate(bot, overdue, _overdue(bot))
+
+    assert bot.expire_purchases() == (1, 0)
+    assert _status(bot, in_grace) == "pending"
+    assert _status(bot, overdue) == "expired"
+
+
+def test_janitor_settles_last_minute_payment_instead_of_expiring(bot, monkeypatch):
+    monkeypatch.setattr(bot, "sync_trc20_transfers", _no_sync)
+    purchase_id = _buy(bot, 1)
+    _backdate(bot, purchase_id, _overdue(bot))
+    # перевод отправлен до показанного срока, в журнал попал уже после
+    created_at = datetime.strptime(bot.get_purchase(purchase_id)[5], "%Y-%m-%d %H:%M:%S")
+    _transfer(bot, "tx-late", purchase_id, created_at + timedelta(hours=bot.PURCHASE_TTL_HOURS - 1))
+
+    async def janitor_pass():
+        now = datetime.utcnow()
+        wallets = await bot.poll_expiring_wallets(now)
+        return await bot.expire_purchases_async(now, wallets)
+
+    assert asyncio.run(janitor_pass()) == (0, 0)
+    assert _status(bot, purchase_id) == "paid"
+
+
+def test_janitor_keeps_purchases_when_final_check_fails(bot, monkeypatch):
+    async def broken_sync(address):
+        raise RuntimeError("TronGrid is down")
+
+    monkeypatch.setattr(bot, "sync_trc20_transfers", broken_sync)
+    purchase_id = _buy(bot, 1)
+    _backdate(bot, purchase_id, _overdue(bot))
+
+    now = datetime.utcnow()
+    wallets = asyncio.run(bot.poll_expiring_wallets(now))
+    assert bot.expire_purchases(now, wallets) == (0, 0)
+    assert _status(bot, purchase_id) == "pending"
+
+
+def test_expired_while_matching_still_settles(one_tail):
+    bot = one_tail
+    old = _buy(bot, 1)
+    _backdate(bot, old, _overdue(bot))
+    created_at = datetime.strptime(bot.get_purchase(old)[5], "%Y-%m-%d %H:%M:%S")
+    _transfer(bot, "tx-old", old, created_at + timedelta(hours=1))
+    # janitor успел раньше, чем poller зачёл перевод из своего снимка; хвост ушёл новой заявке
+    bot.expire_purchases()
+    new = _buy(bot, 2)
+
+    assert bot.settle_purchase(old, "tx-old") is not None
+    assert _status(bot, old) == "paid"
+    # хвост новой заявки не освобождён зачётом старой
+    assert bot.tails.held(("TWALLET", "package")) == 1
+    assert _status(bot, new) == "pending"
+
+
+def test_transfer_after_expiry_does_not_settle_old_invoice(one_tail):
+    bot = one_tail
+    old = _buy(bot, 1)
+    _backdate(bot, old, _overdue(bot))
+    bot.expire_purchases()
+    new = _buy(bot, 2)
+    # перевод нового покупателя той же суммы
+    _transfer(bot, "tx-new", new, datetime.utcnow())
+
+    assert bot.settle_purchase(old, "tx-new") is None
+    pending = bot.get_pending_purchases()["TWALLET"]
+    transfers = bot.get_unclaimed_transfers("TWALLET", 0)
+    assert bot.match_payments(transfers, pending) == [(new, "tx-new")]
+
+
+def test_transfer_before_invoice_is_not_matched(bot):
+    purchase_id = _buy(bot, 1)
+    row = bot.get_purchase(purchase_id)
+    created_at = datetime.strptime(row[5], "%Y-%m-%d %H:%M:%S")
+    early = ("tx-early", row[7], _ms(created_at - timedelta(hours=2)))
+    pending = bot.get_pending_purchases()[row[8]]
+
+    assert bot.match_payments([early], pending) == []
+
+
+def test_unmatched_invoice_like_transfer_reported_once(bot, monkeypatch):
+    sent = []
+
+    async def notify(tg_id, text):
+        sent.append((tg_id, text))
+
+    monkeypatch.setattr(bot, "_notify", notify)
+    bot.unmatched_reported.clear()
+    price = bot.usdt_to_units(bot.PRODUCT_PRICES["package"])
+    transfers = [("tx-invoice", price + 7 * bot.TAIL_UNIT, 0), ("tx-noise", 12345, 0)]
+
+    asyncio.run(bot.report_unmatched_transfers("TWALLET", transfers))
+    asyncio.run(bot.report_unmatched_transfers("TWALLET", transfers))
+
+    assert len(sent) == 1
+    assert sent[0][0] == bot.ADMIN_ID
+    assert "tx-invoice" in sent[0][1]
+
+
+class _Response:
+    def __init__(self, status):
+        self.status = status
+        self.headers = {}
+
+    async def text(self):
+        return "quota exceeded"
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+class _Session:
+    def __init__(self, status):
+        self.status = status
+
+    def get(self, url, **kwargs):
+        return _Response(self.status)
+
+
+def test_trongrid_error_fails_final_check(bot, monkeypatch):
+    monkeypatch.setattr(bot.http_client, "session", lambda: _Session(403))
+    purchase_id = _buy(bot, 1)
+    _backdate(bot, purchase_id, _overdue(bot))
+
+    now = datetime.utcnow()
+    wallets = asyncio.run(bot.poll_expiring_wallets(now))
+    assert bot.get_purchase(purchase_id)[8] not in wallets
+    assert bot.expire_purchases(now, wallets) == (0, 0)
+    assert _status(bot, purchase_id) == "pending"
+
+
+def test_concurrent_polls_settle_once_without_false_alert(bot, monkeypatch):
+    sent = []
+    syncing = []
+
+    async def notify(tg_id, text):
+        sent.append(text)
+
+    async def slow_sync(address):
+        syncing.append(address)
+        assert len(syncing) == 1, "wallet is synced by two polls at once"
+        await asyncio.sleep(0.01)
+        syncing.remove(address)
+        return 0
+
+    monkeypatch.setattr(bot, "_notify", notify)
+    monkeypatch.setattr(bot, "sync_trc20_transfers", slow_sync)
+    bot.unmatched_reported.clear()
+    purchase_id = _buy(bot, 1)
+    _transfer(bot, "tx-paid", purchase_id, datetime.utcnow())
+    wallet = bot.get_purchase(purchase_id)[8]
+
+    async def two_polls():
+        # payments_watcher и janitor с одним и тем же снимком ожидающих заявок
+        pending = (await bot.get_pending_purchases_async())[wallet]
+        return await asyncio.gather(bot.poll_wallet(wallet, pending), bot.poll_wallet(wallet, pending))
+
+    assert sorted(asyncio.run(two_polls())) == [0, 1]
+    assert _status(bot, purchase_id) == "paid"
+    assert sent == []
@@ -0,0 +1,50 @@
+from conftest import fake_message
+
+
+def _ref_counts(bot, user_db_id):
+    return bot.db.fetchone("SELECT ref_count_l1, ref_count_l2 FROM users WHERE id = ?", (user_db_id,))
+
+
+def _registered_events(bot):
+    return bot.db.fetchone("SELECT COUNT(*) FROM event_outbox WHERE event = 'user_registered'")[0]
+
+
+def test_register_after_other_inserts_on_same_connection(bot):
+    # покупки на том же соединении двигают last_insert_rowid(): новый пользователь
+    # может получить тот же id, что и последняя вставленная покупка
+    users = [bot.register_user(fake_message(tg_id))[0] for tg_id in (1, 2, 3)]
+    for user_db_id, product in zip(users + users[:1], ("package", "package", "package", "renewal")):
+        bot.create_purchase(user_db_id, product, bot.PRODUCT_PRICES[product])
+    assert bot.db.fetchone("SELECT last_insert_rowid()")[0] == 4
+    events_before = _registered_events(bot)
+
+    user_db_id, created = bot.register_user(fake_message(4), users[0])
+
+    assert created
+    assert user_db_id == 4
+    assert _ref_counts(bot, users[0]) == (1, 0)
+    assert _registered_events(bot) == events_before + 1
+
+
+def test_second_level_referral_counted(bot):
+    top, _ = bot.register_user(fake_message(1))
+    mid, _ = bot.register_user(fake_message(2), top)
+    bot.register_user(fake_message(3), mid)
+
+    assert _ref_counts(bot, top) == (1, 1)
+    assert _ref_counts(bot, mid) == (1, 0)
+
+
+def test_repeated_start_is_not_registration(bot):
+    first, _ = bot.register_user(fake_message(1))
+    user_db_id, created = bot.register_user(fake_message(7), first)
+    assert created
+
+    # повторный /start с новым ником: обновление профиля, не регистрация
+    bot.user_cache.clear()
+    again, created = bot.register_user(fake_message(7, username="renamed"), first)
+
+    assert (again, created) == (user_db_id, False)
+    assert bot.get_user_by_tg(7)[2] == "renamed"
+    assert _ref_counts(bot, first) == (1, 0)
+    assert _registered_events(bot) == 2